@@ -1,18 +1,38 @@
-from argparse import ArgumentParser
+from time import perf_counter
+_process_start = perf_counter()
+
+from argparse import ArgumentParser, ArgumentTypeError
+import json
 import logging
+import sys
 
 from workdocs_dr.cli_arguments import (
+    add_governor_arguments,
+    add_notification_arguments,
+    backup_options_from_input,
     clients_from_input,
+    governor_from_input,
     bucket_url_from_input,
+    add_profiling_arguments,
     logging_setup,
+    notifications_from_input,
     organization_id_from_input,
+    profiling_from_input,
+    reconcile_slices_from_input,
     run_style_from_input,
     wdfilter_from_input,
 )
 from workdocs_dr.directory_backup import DirectoryBackupRunner
+from workdocs_dr.directory_minder import RunStyle
+from workdocs_dr.document_packs import PackIndex
+from workdocs_dr.profiling import profiler
+from workdocs_dr.sync_plan import SyncPlanner
+from workdocs_dr.tree_snapshot import TreeSnapshot
+from workdocs_dr.verification import BackupVerifier
 
 rootlogger = logging.getLogger()
 rootlogger.setLevel(logging.DEBUG)
+_imports_done = perf_counter()
 
 
 def main():
@@ -28,13 +48,19 @@ def main():
     parser.add_argument("--bucket-name", help="Name of bucket", default=None)
     parser.add_argument("--prefix", help="Prefix for bucket access", default=None)
     parser.add_argument("--user-query", help="Query of user", default=None)
-    parser.add_argument("--folder", help="Folder(s) to backup up", default=None)
+    parser.add_argument("--folder", nargs="+", help="Folder path(s) to back up, e.g. \"Projects/Alpha\"", default=None)
     parser.add_argument(
         "--workdocs-role-arn", help="ARN of role that can access workdocs", default=None
     )
     parser.add_argument(
         "--run-style",
-        help="Run a FULL or ACTIVITIES (incremental) backup. Default is autodetect",
+        help="Run a FULL or ACTIVITIES (incremental) backup, FOLLOW activities continuously, or RECONCILE "
+        "activities and a slice of users. Default is autodetect",
+        default=None,
+    )
+    parser.add_argument(
+        "--reconcile-slices",
+        help="Reconcile the organization over this many runs, syncing activities and 1/N of the users in full each run",
         default=None,
     )
     parser.add_argument(
@@ -45,28 +71,153 @@ def main():
     parser.add_argument(
         "--verbose", help="Verbose output", dest="verbose", action="store_true"
     )
+    parser.add_argument(
+        "--plan-only",
+        help="Walk WorkDocs and the bucket and output a JSON plan of what a FULL run would do, without writing",
+        dest="plan_only",
+        action="store_true",
+    )
+    parser.add_argument("--plan-output", help="File to write the plan to. Default is stdout", default=None)
+    parser.add_argument(
+        "--priority",
+        help='Weights for ordering sync actions, e.g. "recency=1,size=0.5", or "fifo" for discovery order',
+        default=None,
+    )
+    parser.add_argument(
+        "--compress",
+        help="Compress compressible documents when storing them. Codec is auto (default), zstd or gzip",
+        nargs="?",
+        const="auto",
+        default=None,
+    )
+    parser.add_argument(
+        "--pack-small-documents",
+        help="Pack documents smaller than this many bytes (default 100000) into per folder pack objects",
+        dest="pack_small_documents",
+        nargs="?",
+        const=str(PackIndex.default_threshold),
+        default=None,
+    )
+    parser.add_argument(
+        "--version-history",
+        help="Also back up earlier versions of documents, fetching only versions not already stored",
+        dest="version_history",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--processes",
+        help='Back up users in this many processes, to use more than one CPU. "auto" is one per CPU. Default is 1',
+        default=None,
+    )
+    parser.add_argument(
+        "--tree-snapshot",
+        help="Only walk folders with signs of change since the last walk, plus this fraction (default 0.05) "
+        "of the rest",
+        dest="tree_snapshot",
+        nargs="?",
+        const=str(TreeSnapshot.default_verify_fraction),
+        default=None,
+    )
+    parser.add_argument(
+        "--verify",
+        help="Compare the bucket with WorkDocs and report missing, stale and orphaned documents, without writing",
+        dest="verify",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--verify-sample",
+        help="Fraction of documents to also download from both sides and compare checksums of, e.g. 0.01",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument("--verify-output", help="File to write findings to as JSON lines. Default is the log",
+                        default=None)
+    add_governor_arguments(parser)
+    add_notification_arguments(parser)
+    add_profiling_arguments(parser)
     args = parser.parse_args()
+    try:
+        options = backup_options_from_input(args.priority, args.compress, args.pack_small_documents,
+                                            args.version_history, args.processes, args.tree_snapshot)
+    except ArgumentTypeError as err:
+        parser.error(str(err))
+    profiling_from_input(args.profile_output)
     clients = clients_from_input(
         profile_name=args.profile,
         region_name=args.region,
         workdocs_role_arn=args.workdocs_role_arn,
         bucket_role_arn=args.bucket_role_arn,
+        governor=governor_from_input(args.max_bytes_per_second, args.max_requests_per_second, args.governor_file),
     )
     organization_id = organization_id_from_input(args.organization_id)
-    run_style = run_style_from_input(args.run_style)
+    notifications = notifications_from_input(clients, args.notification_queue_url, args.notification_url,
+                                             args.notification_port, args.notification_cert, args.notification_key)
+    # Notifications only drive FOLLOW runs, so they imply one
+    run_style = run_style_from_input(args.run_style) or (RunStyle.FOLLOW if notifications is not None else None)
     db = DirectoryBackupRunner(
         clients=clients,
         organization_id=organization_id,
         bucket_url=bucket_url_from_input(args.bucket_name, args.prefix),
         filter=wdfilter_from_input(args.user_query, args.folder),
         run_style=run_style,
+        options=options,
+        notifications=notifications,
+        reconcile_slices=reconcile_slices_from_input(args.reconcile_slices),
     )
     logging_setup(rootlogger=rootlogger, verbose=args.verbose)
     logging.info(f"orgid {db.organization_id} url {db.bucket_url}")
+    if args.plan_only:
+        planner = SyncPlanner(clients, organization_id, db.bucket_url, filter=db.filter, minder=db.get_minder(),
+                              options=db.options)
+        write_plan(planner.plan_all(), args.plan_output)
+        log_startup_timings(clients)
+        log_governor_report(clients)
+        logging.info("Finished planning run and exited normally")
+        return
+    if args.verify:
+        counts = verify(clients, organization_id, db, args.verify_sample, args.verify_output)
+        log_governor_report(clients)
+        logging.info(f"Finished verification run with {counts}")
+        return
     db.runall()
+    log_startup_timings(clients)
+    log_governor_report(clients)
     logging.info("Finished backup run and exited normally")
     return
 
 
+def write_plan(plan, plan_output=None):
+    if plan_output is None:
+        json.dump(plan, sys.stdout, indent=2, default=str)
+        sys.stdout.write("\n")
+        return
+    with open(plan_output, "w") as f:
+        json.dump(plan, f, indent=2, default=str)
+
+
+def verify(clients, organization_id, db, sample_rate=0.0, verify_output=None):
+    if verify_output is None:
+        return BackupVerifier(clients, organization_id, db.bucket_url, db.filter, sample_rate).verify_all()
+    with open(verify_output, "w") as f:
+        return BackupVerifier(clients, organization_id, db.bucket_url, db.filter, sample_rate, f).verify_all()
+
+
+def log_startup_timings(clients):
+    timings = {"imports": _imports_done - _process_start, **clients.startup_report()}
+    report = ", ".join(f"{k}={v:.3f}s" for k, v in timings.items())
+    logging.info(f"Startup timings: {report}")
+
+
+def log_governor_report(clients):
+    logging.info(f"Requests: {clients.request_summary()}")
+    logging.info(f"Governor: {clients.governor.report()}")
+
+
+def log_profile_report():
+    if profiler.enabled:
+        logging.info(f"Stage profile: {profiler.finish()}")
+
+
 if __name__ == "__main__":
     main()
+    log_profile_report()
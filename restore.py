@@ -1,10 +1,18 @@
 from argparse import ArgumentParser, ArgumentTypeError
+from contextlib import nullcontext
 from os.path import isdir
 from pathlib import Path
 import logging
+import sys
 
-from workdocs_dr.cli_arguments import clients_from_input, bucket_url_from_input, logging_setup, organization_id_from_input, wdfilter_from_input
+from workdocs_dr.cli_arguments import (add_governor_arguments, add_profiling_arguments, clients_from_input,
+                                       bucket_url_from_input, governor_from_input, logging_setup,
+                                       organization_id_from_input, profiling_from_input,
+                                       wdfilter_from_input)
+from workdocs_dr.archive_export import ArchiveExportRunner
 from workdocs_dr.directory_restore import DirectoryRestoreRunner
+from workdocs_dr.profiling import profiler
+from workdocs_dr.workdocs_restore import WorkDocsRestoreRunner
 rootlogger = logging.getLogger()
 rootlogger.setLevel(logging.INFO)
 
@@ -14,25 +22,54 @@ def main():
     parser.add_argument("--profile", help="AWS profile", default=None)
     parser.add_argument("--region", help="AWS region", default=None)
     parser.add_argument("--user-query", help="Query of user", default=None)
-    parser.add_argument("--folder", help="Folder(s) to restore", default=None)
+    parser.add_argument("--folder", nargs="+", help="Folder(s) to restore", default=None)
     parser.add_argument("--organization-id",
                         help="Workdocs organization id (directory id)", default=None)
     parser.add_argument(
         "--prefix", help="Prefix for bucket access", default=None)
     parser.add_argument("--bucket-name", help="Name of bucket", default=None)
     parser.add_argument("--path", type=dir_path, default=Path("."))
+    parser.add_argument("--export", help="Write a single archive instead of restoring to a directory",
+                        choices=["tar", "zip"], default=None)
+    parser.add_argument("--output", help="Archive file to export to, or - for stdout", default="-")
+    parser.add_argument("--to-workdocs", help="Restore into WorkDocs instead of to a directory",
+                        dest="to_workdocs", action="store_true")
+    parser.add_argument("--workdocs-folder-id",
+                        help="WorkDocs folder to restore into. Defaults to each user's root folder", default=None)
+    parser.add_argument(
+        "--workdocs-role-arn",
+        help="ARN of role that creates folders and documents in WorkDocs", default=None)
 
     parser.add_argument(
         "--bucket-role-arn",
         help="ARN of role that puts/gets disaster recovery documents", default=None)
     parser.add_argument("--verbose", help="Verbose output",
                         dest="verbose", action="store_true")
+    add_governor_arguments(parser)
+    add_profiling_arguments(parser)
     args = parser.parse_args()
+    profiling_from_input(args.profile_output)
+    governor = governor_from_input(args.max_bytes_per_second, args.max_requests_per_second, args.governor_file)
     clients = clients_from_input(profile_name=args.profile, region_name=args.region,
-                                 workdocs_role_arn=None, bucket_role_arn=args.bucket_role_arn)
+                                 workdocs_role_arn=args.workdocs_role_arn, bucket_role_arn=args.bucket_role_arn,
+                                 governor=governor)
     bucket = bucket_url_from_input(args.bucket_name, args.prefix)
     filter = wdfilter_from_input(args.user_query, args.folder)
     organization_id = organization_id_from_input(args.organization_id)
+    if args.export is not None:
+        # Keep stdout clean for the archive when streaming it there
+        is_stdout = args.output == "-"
+        logging_setup(rootlogger=rootlogger, verbose=args.verbose, stream=sys.stderr if is_stdout else None)
+        with (open(args.output, "wb") if not is_stdout else nullcontext(sys.stdout.buffer)) as output:
+            exporter = ArchiveExportRunner(clients, organization_id, bucket, filter, args.export, output)
+            exporter.runall()
+        logging.info(f"Governor: {clients.governor.report()}")
+        return
+    if args.to_workdocs:
+        logging_setup(rootlogger=rootlogger, verbose=args.verbose)
+        WorkDocsRestoreRunner(clients, organization_id, bucket, filter, args.workdocs_folder_id).runall()
+        logging.info(f"Governor: {clients.governor.report()}")
+        return
     # Restorer goes here
     drr = DirectoryRestoreRunner(
         clients,
@@ -41,8 +78,9 @@ def main():
         filter,
         args.path
     )
-    drr.runall()
     logging_setup(rootlogger=rootlogger, verbose=args.verbose)
+    drr.runall()
+    logging.info(f"Governor: {clients.governor.report()}")
 
 
 def dir_path(path):
@@ -54,3 +92,5 @@ def dir_path(path):
 
 if __name__ == '__main__':
     main()
+    if profiler.enabled:
+        logging.info(f"Stage profile: {profiler.finish()}")
@@ -1,5 +1,9 @@
+import io
+from datetime import datetime, timezone
 from os import environ
 
+from workdocs_dr.governor import Governor
+
 
 def get_complex_user() -> str:
     return environ.get("WD_COMPLEX_USER")
@@ -11,3 +15,86 @@ def get_known_workdocs_path() -> str:
     """A path from complex_user that we know exists"""
     return environ.get("KNOWN_PATH")
 
+
+class FakeBucket:
+    """Just enough of S3 for objects kept in memory. Listed objects all have `last_modified` as their time"""
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self, last_modified: datetime = None) -> None:
+        self.objects = {}  # Keyed by key, value is (body, metadata)
+        self.gets = []  # (key, range) of each get_object
+        self.last_modified = last_modified or datetime(2022, 5, 1, tzinfo=timezone.utc)
+
+    def put_object(self, Bucket, Key, Body, Metadata=None, **kwargs):
+        self.objects[Key] = (Body, Metadata or {})
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self.gets.append((Key, Range))
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey()
+        body, metadata = self.objects[Key]
+        if Range is not None:
+            start, end = Range[len("bytes="):].split("-")
+            body = body[int(start):int(end) + 1]
+        return {"Body": io.BytesIO(body), "Metadata": metadata}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey()
+        return {"Metadata": self.objects[Key][1]}
+
+    def list_objects_v2(self, Bucket, Prefix, MaxKeys=None, ContinuationToken=None, **kwargs):
+        return {"Contents": [{"Key": k, "Size": len(self.objects[k][0]), "LastModified": self.last_modified,
+                              "ETag": '"e"'} for k in sorted(self.objects) if k.startswith(Prefix)],
+                "IsTruncated": False}
+
+
+class FakeClients:
+    """Stands in for AwsClients, with a FakeBucket unless another bucket is given"""
+
+    def __init__(self, bucket=None, docs=None) -> None:
+        self.bucket = bucket if bucket is not None else FakeBucket()
+        self.docs = docs
+        self.governor = Governor()
+
+    def bucket_client(self):
+        return self.bucket
+
+    def docs_client(self):
+        return self.docs
+
+    def count_request(self, service, operation):
+        pass
+
+
+class FakeSession:
+    def __init__(self) -> None:
+        self.created = []
+
+    def client(self, service_name, config=None, endpoint_url=None):
+        self.created.append(service_name)
+        return object()
+
+
+class FakeDirectory:
+    def __init__(self) -> None:
+        self.activities = []
+
+    def generate_activities(self, start_time):
+        return [a for a in self.activities if a["TimeStamp"] >= start_time]
+
+
+class FakeMinder:
+    """Keeps the follow cursor of an activity follower"""
+
+    def __init__(self, cursor: datetime) -> None:
+        self.cursor = cursor
+
+    def get_follow_cursor(self):
+        return self.cursor
+
+    def update_follow_cursor(self, cursor):
+        self.cursor = cursor
@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from workdocs_dr.activity_backup import consolidate_activities
+from workdocs_dr.activity_follower import ActivityFollower
+from workdocs_dr.directory_minder import DirectoryBackupMinder
+from tests.helpers import FakeClients, FakeDirectory, FakeMinder
+
+T0 = datetime(2022, 5, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def activity(item_id, minutes, activity_type="DOCUMENT_VERSION_UPLOADED", **extra):
+    return {"Type": activity_type, "TimeStamp": T0 + timedelta(minutes=minutes),
+            "ResourceMetadata": {"Id": item_id, "Owner": {"Id": "owner"}}, **extra}
+
+
+class RecordingFollower(ActivityFollower):
+    def __init__(self, directory, minder) -> None:
+        super().__init__(None, "org", "s3://bucket", directory, minder)
+        self.synced = []
+
+    def sync(self, activities):
+        self.synced.append(sorted((a["ResourceMetadata"]["Id"], a["TimeStamp"]) for a in activities))
+
+
+class TestActivityFollower:
+
+    def test_consolidate_keeps_latest_activity(self):
+        updates = consolidate_activities([
+            activity("doc1", 2, "DOCUMENT_MOVED", OriginalParent={"Id": "folderA"}),
+            activity("doc1", 1),
+            activity("doc1", 3, "DOCUMENT_RENAMED"),
+        ])
+        assert updates["DocumentUpdates"] == [{"document_id": "doc1", "user": "owner",
+                                               "old_folder_ids": ["folderA"], "activity_type": "DOCUMENT_RENAMED"}]
+
+    def test_debounces_bursts_and_keeps_cursor_behind_pending(self):
+        directory, minder = FakeDirectory(), FakeMinder(T0 - timedelta(minutes=1))
+        follower = RecordingFollower(directory, minder)
+        follower.tasks.refresh_caches = lambda: None
+        directory.activities = [activity("doc1", 0), activity("doc2", 0)]
+        follower.run_once(T0)
+        assert follower.synced == []
+        assert minder.cursor == T0
+        # doc1 keeps being edited, doc2 goes quiet
+        directory.activities.append(activity("doc1", 0.25))
+        follower.run_once(T0 + timedelta(seconds=15))
+        assert follower.synced == [[("doc2", T0)]]
+        assert minder.cursor == T0
+        # Polling again doesn't resync what was already seen, and doc1 syncs once quiet
+        follower.run_once(T0 + timedelta(seconds=30))
+        assert follower.synced[1] == [("doc1", T0), ("doc1", T0 + timedelta(seconds=15))]
+        assert minder.cursor == T0 + timedelta(seconds=15)
+        follower.run_once(T0 + timedelta(seconds=45))
+        assert len(follower.synced) == 2
+
+    def test_first_poll_without_earlier_run_starts_from_now(self):
+        directory = FakeDirectory()
+        minder = DirectoryBackupMinder(FakeClients(), "d-123", "s3://bucket/prefix")
+        follower = RecordingFollower(directory, minder)
+        follower.tasks.refresh_caches = lambda: None
+        directory.activities = [activity("old", -60), activity("doc1", 0)]
+        follower.run_once(T0)
+        follower.run_once(T0 + timedelta(minutes=1))
+        assert follower.synced == [[("doc1", T0)]]
+        assert minder.get_follow_cursor() == T0
+
+    def test_failed_sync_is_tried_again(self):
+        directory, minder = FakeDirectory(), FakeMinder(T0 - timedelta(minutes=1))
+        follower = RecordingFollower(directory, minder)
+        follower.tasks.refresh_caches = lambda: None
+        recording_sync = follower.sync
+
+        def failing_sync(activities):
+            follower.sync = recording_sync
+            raise ConnectionError("Throttled")
+        follower.sync = failing_sync
+        directory.activities = [activity("d1", 0)]
+        follower.run_once(T0)
+        with pytest.raises(ConnectionError):
+            follower.run_once(T0 + timedelta(seconds=15))
+        # Still pending, so the cursor stays behind it and the next poll syncs it
+        assert minder.cursor == T0 and "d1" in follower.pending
+        follower.run_once(T0 + timedelta(seconds=30))
+        assert follower.synced == [[("d1", T0)]]
+        assert follower.pending == {}
@@ -0,0 +1,47 @@
+import io
+import tarfile
+import zipfile
+from datetime import datetime, timezone
+
+from workdocs_dr.archive_export import TarArchiveWriter, ZipArchiveWriter
+
+
+class UnseekableOutput(io.RawIOBase):
+    """Behaves like a pipe to stdout"""
+
+    def __init__(self) -> None:
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self.buffer.write(b)
+
+
+class TestArchiveWriters:
+    documents = {"report.csv": b"a,b\n1,2\n" * 1000, "sub folder/notes.txt": b"hello"}
+    mtime = datetime(2022, 3, 4, 5, 6, 7, tzinfo=timezone.utc)
+
+    def write_documents(self, writer):
+        for name, body in self.documents.items():
+            writer.add(name, len(body), self.mtime, io.BytesIO(body))
+        writer.close()
+
+    def test_tar_stream(self):
+        output = UnseekableOutput()
+        self.write_documents(TarArchiveWriter(output))
+        with tarfile.open(fileobj=io.BytesIO(output.buffer.getvalue())) as archive:
+            assert archive.getnames() == list(self.documents)
+            for name, body in self.documents.items():
+                assert archive.extractfile(name).read() == body
+            assert archive.getmember("report.csv").mtime == self.mtime.timestamp()
+
+    def test_zip_stream(self):
+        output = UnseekableOutput()
+        self.write_documents(ZipArchiveWriter(output))
+        with zipfile.ZipFile(io.BytesIO(output.buffer.getvalue())) as archive:
+            assert archive.namelist() == list(self.documents)
+            for name, body in self.documents.items():
+                assert archive.read(name) == body
+            assert archive.getinfo("report.csv").date_time == (2022, 3, 4, 5, 6, 6)
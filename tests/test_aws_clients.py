@@ -0,0 +1,36 @@
+from datetime import datetime, timezone, timedelta
+from tempfile import TemporaryDirectory
+
+from tests.helpers import FakeSession
+from workdocs_dr.aws_clients import AwsClients
+from workdocs_dr.boto_session import CredentialCache
+
+
+class TestAwsClients:
+
+    def test_nothing_created_until_used(self):
+        factory_calls = []
+        clients = AwsClients(lambda: factory_calls.append(1) or FakeSession())
+        assert factory_calls == []
+        clients.docs_client()
+        clients.bucket_client()
+        clients.bucket_client()
+        assert factory_calls == [1]
+        assert clients.basesession.created == ["workdocs", "s3"]
+        assert set(clients.startup_report().keys()) == {"session:base", "client:workdocs", "client:bucket"}
+
+    def test_same_role_shares_session(self):
+        clients = AwsClients(FakeSession(), workdocs_role_arn=None, bucket_role_arn=None)
+        assert clients.get_session("bucket") is clients.get_session("workdocs")
+
+    def test_credential_cache_honours_expiry(self):
+        with TemporaryDirectory() as tempdir:
+            cache = CredentialCache(tempdir, min_remaining=timedelta(minutes=20))
+            now = datetime.now(tz=timezone.utc)
+            fresh = {"access_key": "a", "expiry_time": (now + timedelta(hours=1)).isoformat()}
+            stale = {"access_key": "b", "expiry_time": (now + timedelta(minutes=5)).isoformat()}
+            cache.put(fresh, "arn:fresh", None)
+            cache.put(stale, "arn:stale", None)
+            assert cache.get("arn:fresh", None) == fresh
+            assert cache.get("arn:stale", None) is None
+            assert cache.get("arn:missing", None) is None
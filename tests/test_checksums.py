@@ -0,0 +1,40 @@
+import hashlib
+import io
+
+import pytest
+
+from workdocs_dr.checksums import ChecksumMismatch, ChecksumWriter
+from workdocs_dr.codec import Decoder, DecodingWriter, Encoder
+from workdocs_dr.version_index import VersionIndex
+
+
+class TestChecksums:
+    content = b"quarterly numbers\n" * 5000
+
+    def test_verified_while_decoding(self):
+        encoder = Encoder("gzip")
+        stored = encoder.encode(self.content) + encoder.finish()
+        metadata = {"codec": "gzip", "sha256": hashlib.sha256(self.content).hexdigest()}
+        restored = io.BytesIO()
+        checked = ChecksumWriter(restored)
+        with DecodingWriter(checked, Decoder.from_metadata(metadata)) as decoded:
+            for i in range(0, len(stored), 4096):
+                decoded.write(stored[i:i + 4096])
+        checked.verify(metadata)
+        assert restored.getvalue() == self.content
+
+    def test_mismatch_raises(self):
+        checked = ChecksumWriter(io.BytesIO())
+        checked.write(self.content[:-1])
+        checked.verify({})  # Older objects have no checksum to check against
+        with pytest.raises(ChecksumMismatch):
+            checked.verify({"sha256": hashlib.sha256(self.content).hexdigest()})
+
+    def test_index_keeps_checksum_of_same_version(self):
+        index = VersionIndex(None, type("Keys", (), {"bucket": "b", "bucket_folderprefix": lambda s, n: n})())
+        index.entries = {}
+        index.record("doc", "folder", {"Id": "v1", "Size": 3}, sha256="abc")
+        index.record("doc", "folder", {"Id": "v1", "Size": 3})
+        assert index.get("doc")["Sha256"] == "abc"
+        index.record("doc", "folder", {"Id": "v2", "Size": 4})
+        assert "Sha256" not in index.get("doc")
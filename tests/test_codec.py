@@ -0,0 +1,29 @@
+import io
+import os
+
+from workdocs_dr.codec import Compression, DecodingWriter, Decoder, Encoder
+
+
+class TestCodec:
+    text = b"date,amount,comment\n" + b"2022-01-01,100,nothing to see here\n" * 20_000
+
+    def test_choose_codec(self):
+        compression = Compression("gzip")
+        assert compression.choose_codec("text/csv", self.text) == "gzip"
+        assert compression.choose_codec("image/jpeg", self.text) is None
+        assert compression.choose_codec("application/pdf", os.urandom(100_000)) is None
+
+    def test_streaming_roundtrip(self):
+        encoder = Encoder("gzip")
+        stored = b"".join(encoder.encode(self.text[i:i + 8192]) for i in range(0, len(self.text), 8192))
+        stored += encoder.finish()
+        assert len(stored) * 3 < len(self.text)
+        restored = io.BytesIO()
+        with DecodingWriter(restored, Decoder.from_metadata({"codec": "gzip"})) as writer:
+            for i in range(0, len(stored), 1000):
+                writer.write(stored[i:i + 1000])
+        assert restored.getvalue() == self.text
+
+    def test_uncompressed_passthrough(self):
+        decoder = Decoder.from_metadata({})
+        assert decoder.decode(b"abc") + decoder.finish() == b"abc"
@@ -0,0 +1,150 @@
+import hashlib
+from datetime import datetime, timedelta, timezone
+
+from tests.helpers import FakeBucket, FakeClients
+from workdocs_dr.backup_options import BackupOptions
+from workdocs_dr.codec import Encoder
+from workdocs_dr.document import DocumentHelper
+from workdocs_dr.document_packs import PackBuilder, PackIndex, unpack_document
+from workdocs_dr.queue_restore import GenerateRestoreTasks, RunRestoreTasks
+from workdocs_dr.user import UserHelper, UserKeyHelper
+from workdocs_dr.version_index import VersionIndex
+from workdocs_dr.workdocs_bucket_sync import WorkDocs2BucketSync
+
+
+def packed_metadata(name, content, codec=None):
+    metadata = DocumentHelper.metadata_dict2s3({
+        "Id": f"id-{name}", "Name": name, "Size": len(content),
+        "ContentModifiedTimestamp": datetime(2022, 6, 1, tzinfo=timezone.utc)})
+    metadata["sha256"] = hashlib.sha256(content).hexdigest()
+    if codec is not None:
+        metadata["codec"] = codec
+    return metadata
+
+
+def stored_bytes(content, codec=None):
+    encoder = Encoder(codec)
+    return encoder.encode(content) + encoder.finish()
+
+
+class TestDocumentPacks:
+    now = datetime(2022, 6, 1, tzinfo=timezone.utc)
+    contents = {"a": b"alpha" * 100, "b": b"", "c": b"gamma\n" * 2000}
+
+    def make_index(self):
+        bucket = FakeBucket()
+        index = PackIndex(FakeClients(bucket), "bucket", "prefix/d-123/someone/f1")
+        builder = PackBuilder()
+        for name, content in self.contents.items():
+            codec = "gzip" if name == "c" else None
+            builder.add(name, stored_bytes(content, codec), len(content), self.now,
+                        packed_metadata(name, content, codec))
+        index.write_pack(builder)
+        return bucket, index
+
+    def test_documents_are_read_with_one_ranged_get(self):
+        bucket, index = self.make_index()
+        index.save()
+        reloaded = PackIndex(FakeClients(bucket), "bucket", "prefix/d-123/someone/f1")
+        packed = reloaded.as_s3objects()
+        assert packed["a"]["Key"] == "prefix/d-123/someone/f1/a"
+        bucket.gets.clear()
+        read = {d: unpack_document(e, stored) for d, e, stored in
+                reloaded.read_ranges([(d, o["Packed"]) for d, o in packed.items()])}
+        assert read == self.contents
+        assert len(bucket.gets) == 1 and bucket.gets[0][1] is not None
+
+    def test_far_apart_documents_are_separate_reads(self):
+        _, index = self.make_index()
+        index.max_gap = 0
+        entries = [("a", {"Offset": 0, "Length": 10}), ("b", {"Offset": 10, "Length": 5}),
+                   ("c", {"Offset": 100, "Length": 5})]
+        assert [[d for d, _ in run] for run in index.coalesce(entries)] == [["a", "b"], ["c"]]
+
+    def test_sparse_pack_is_repacked(self):
+        bucket, index = self.make_index()
+        [old_pack] = list(index.packs)
+        index.remove("a")
+        assert index.sparse_packs() == [old_pack]
+        emptied = index.repack(index.sparse_packs())
+        assert emptied == [index.pack_key(old_pack)]
+        assert old_pack not in index.packs and index.sparse_packs() == []
+        read = {d: unpack_document(e, stored) for d, e, stored in index.read_ranges(index.documents.items())}
+        assert read == {"b": b"", "c": self.contents["c"]}
+
+
+class TestPackPlanning:
+    now = datetime(2022, 6, 1, tzinfo=timezone.utc)
+    folder_def = {"Id": "f1", "ModifiedTimestamp": now - timedelta(days=10)}
+    prefix = "prefix/d-123/someone/f1"
+
+    def make_syncer(self):
+        user = UserHelper({"OrganizationId": "d-123", "Username": "someone",
+                           "RootFolderId": "root", "ModifiedTimestamp": self.now})
+        userkeys = UserKeyHelper(user, "s3://bucket/prefix")
+        version_index = VersionIndex(None, userkeys)
+        version_index.entries = {"kept": {"FolderId": "f1", "VersionId": "v-kept", "Signature": None, "Size": 10},
+                                 "loose": {"FolderId": "f1", "VersionId": "v-old", "Signature": None, "Size": 10}}
+        return WorkDocs2BucketSync(None, user, userkeys, version_index, BackupOptions(pack_threshold=100_000))
+
+    def wd_document(self, document_id, size):
+        return {"Id": document_id, "ParentFolderId": "f1",
+                "LatestVersionMetadata": {"Id": f"v-{document_id}", "Name": document_id, "Size": size,
+                                          "ModifiedTimestamp": self.now}}
+
+    def test_small_documents_are_packed(self):
+        packindex = PackIndex(None, "bucket", self.prefix)
+        packindex.packs = {"p1": 20}
+        packindex.documents = {
+            "kept": {"Pack": "p1", "Offset": 0, "Length": 10, "Size": 10,
+                     "LastModified": self.now.isoformat(), "Metadata": {}},
+            "gone": {"Pack": "p1", "Offset": 10, "Length": 10, "Size": 10,
+                     "LastModified": self.now.isoformat(), "Metadata": {}},
+        }
+        wddocuments = [self.wd_document("kept", 10), self.wd_document("new", 2_000),
+                       self.wd_document("loose", 10), self.wd_document("big", 20_000_000)]
+        s3documents = [
+            {"Key": f"{self.prefix}/loose", "Size": 10, "LastModified": self.now - timedelta(days=4)},
+            {"Key": f"{self.prefix}/.packindex", "Size": 1, "LastModified": self.now},
+            {"Key": f"{self.prefix}/.packs/p1", "Size": 20, "LastModified": self.now},
+        ]
+        records = self.make_syncer().plan_syncactions(self.folder_def, [], wddocuments, s3documents, packindex)
+        by_action = {}
+        for r in records:
+            by_action.setdefault(r["Action"], []).append(r)
+        assert "remove_from_bucket" not in by_action
+        assert [r["Args"]["document_id"] for r in by_action["copy_to_bucket"]] == ["big"]
+        [pack] = by_action["pack_documents"]
+        assert [d["document_id"] for d in pack["Args"]["documents"]] == ["loose", "new"]
+        assert pack["Args"]["forget_document_ids"] == ["gone"]
+        assert pack["Args"]["replaced_document_ids"] == ["loose"]
+
+
+class TestPackedRestore:
+    def test_pack_restored_with_one_get(self, tmp_path):
+        bucket = FakeBucket()
+        clients = FakeClients(bucket)
+        user = UserHelper({"OrganizationId": "d-123", "Username": "someone",
+                           "RootFolderId": "root", "ModifiedTimestamp": datetime.now(tz=timezone.utc)})
+        userkeys = UserKeyHelper(user, "s3://bucket/prefix")
+        index = PackIndex(clients, "bucket", userkeys.bucket_folderprefix("f1"))
+        builder = PackBuilder()
+        contents = {f"doc{i}": f"document {i}\n".encode("utf-8") * i for i in range(50)}
+        for name, content in contents.items():
+            builder.add(name, content, len(content), datetime.now(tz=timezone.utc), packed_metadata(name, content))
+        index.write_pack(builder)
+        packed = list(index.as_s3objects().values())
+        bucket.gets.clear()
+        runner = RunRestoreTasks(None, clients, userkeys)
+        [task] = GenerateRestoreTasks.create_pack_tasks(tmp_path, "f1", packed)
+        runner.restore_packed(task)
+        runner.file_writer.flush()
+        assert {r["Status"] for r in runner.results} == {"OK"}
+        assert {p.name: p.read_bytes() for p in tmp_path.iterdir()} == contents
+        assert len(bucket.gets) == 1
+        # Files already restored aren't read again
+        runner.results.clear()
+        bucket.gets.clear()
+        runner.restore_packed(task)
+        assert {r["DocumentInfo"]["Action"] for r in runner.results} == {"SkippedIdentical"}
+        assert bucket.gets == []
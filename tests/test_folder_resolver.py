@@ -0,0 +1,37 @@
+from tests.helpers import FakeClients
+from workdocs_dr.listings import FolderPathResolver
+
+
+class FakeDocs:
+    """Folder listings split into pages of one folder each"""
+
+    def __init__(self, tree) -> None:
+        self.tree = tree
+        self.calls = []
+
+    def describe_folder_contents(self, FolderId, Type, Marker=None, Limit=None):
+        self.calls.append((FolderId, Marker))
+        children = self.tree.get(FolderId, [])
+        page = int(Marker or 0)
+        response = {"Folders": [{"Id": child_id, "Name": name, "ResourceState": "ACTIVE"}
+                                for child_id, name in children[page:page + 1]]}
+        if page + 1 < len(children):
+            response["Marker"] = str(page + 1)
+        return response
+
+
+class TestFolderPathResolver:
+    tree = {
+        "root": [("personal", "Personal"), ("projects", "Projects")],
+        "projects": [("alpha", "Alpha"), ("beta", "Beta"), ("gamma", "Gamma")],
+    }
+
+    def test_resolves_across_pages_and_caches(self):
+        docs = FakeDocs(self.tree)
+        resolver = FolderPathResolver(FakeClients(docs=docs))
+        assert resolver.resolve("root", "Projects/Gamma")["Id"] == "gamma"
+        assert resolver.resolve("root", "/Projects/Beta/")["Id"] == "beta"
+        assert resolver.resolve("root", "Projects/Delta") is None
+        assert resolver.resolve("root", "")["Id"] == "root"
+        # Two pages for root and three for Projects, each listed once
+        assert len(docs.calls) == 5
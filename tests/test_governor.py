@@ -0,0 +1,47 @@
+import json
+import os
+from tempfile import TemporaryDirectory
+from time import monotonic
+
+from workdocs_dr.cli_arguments import governor_from_input
+from workdocs_dr.governor import Governor, TokenBucket
+
+
+class TestGovernor:
+
+    def test_unlimited_bucket_never_waits(self):
+        bucket = TokenBucket()
+        assert sum(bucket.acquire(1_000_000) for _ in range(100)) == 0
+
+    def test_bucket_limits_rate(self):
+        bucket = TokenBucket(rate=100)
+        start = monotonic()
+        for _ in range(120):
+            bucket.acquire(1)
+        # 100 tokens of burst, then 20 more at 100/s
+        assert 0.15 < monotonic() - start < 1.0
+
+    def test_report_and_per_service_limits(self):
+        governor = governor_from_input(max_bytes_per_second="1000000", max_requests_per_second="5,s3=50")
+        governor.throttle_request("s3")
+        governor.throttle_request("workdocs")
+        governor.throttle_bytes(1000)
+        report = governor.report()
+        assert report["requests:s3"]["Limit"] == 50
+        assert report["requests:workdocs"]["Limit"] == 5
+        assert report["bytes"] == {"Total": 1000, "WaitedSeconds": 0, "Limit": 1_000_000}
+
+    def test_limits_file_reload(self):
+        with TemporaryDirectory() as tempdir:
+            limits_file = os.path.join(tempdir, "limits.json")
+            with open(limits_file, "w") as f:
+                json.dump({"BytesPerSecond": 123}, f)
+            governor = Governor(limits_file=limits_file)
+            assert governor.bytes.rate == 123
+            with open(limits_file, "w") as f:
+                json.dump({"RequestsPerSecond": {"s3": 7}}, f)
+            os.utime(limits_file, (0, 0))
+            governor._next_reload = 0
+            governor.maybe_reload()
+            assert governor.bytes.rate is None
+            assert governor.requests["s3"].rate == 7
@@ -0,0 +1,44 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from workdocs_dr.item_restore import RestoreFileWriter
+from workdocs_dr.queue_restore import create_directories
+
+
+class TestRestoreFileWriter:
+
+    def test_failed_write_leaves_nothing_behind(self):
+        with TemporaryDirectory() as tempdir:
+            path = Path(tempdir) / "report.pdf"
+            path.write_bytes(b"previous version")
+
+            def broken_writer(f):
+                f.write(b"half of the new")
+                raise IOError("connection reset")
+            with pytest.raises(IOError):
+                RestoreFileWriter().write(path, 2_000_000, broken_writer)
+            assert path.read_bytes() == b"previous version"
+            assert [p.name for p in Path(tempdir).iterdir()] == ["report.pdf"]
+
+    def test_preallocated_file_is_trimmed_and_mtimes_batched(self):
+        with TemporaryDirectory() as tempdir:
+            writer = RestoreFileWriter()
+            path = Path(tempdir) / "data.bin"
+            # Size from metadata is larger than what arrives, e.g. a stale hint
+            writer.write(path, 2_000_000, lambda f: f.write(b"x" * 1000))
+            assert path.stat().st_size == 1000
+            writer.set_mtime(path, 1_600_000_000)
+            assert path.stat().st_mtime != 1_600_000_000
+            writer.flush()
+            assert path.stat().st_mtime == 1_600_000_000
+
+    def test_create_directories(self):
+        with TemporaryDirectory() as tempdir:
+            base = Path(tempdir)
+            (base / "existing").mkdir()
+            (base / "afile").write_bytes(b"")
+            folderdefs = [{"Path": base / "existing" / "new"}, {"Path": base / "existing"}, {"Path": base / "afile"}]
+            created = create_directories(folderdefs)
+            assert [(fd["Path"].name, fd["IsNew"]) for fd in created] == [("existing", False), ("new", True)]
@@ -0,0 +1,133 @@
+import json
+from datetime import datetime, timedelta, timezone
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import pytest
+
+from workdocs_dr.activity_follower import ActivityFollower
+from workdocs_dr.notification_ingest import (HttpsNotificationSource, NotificationFollower,
+                                             notification_to_activities, unwrap_sns)
+from tests.helpers import FakeDirectory, FakeMinder
+
+T0 = datetime(2022, 5, 1, 12, 0, tzinfo=timezone.utc)
+
+
+class FakeSource:
+    protocol = "SQS"
+
+    def __init__(self) -> None:
+        self.waiting = []
+        self.acknowledged = []
+        self.invisible = []
+
+    def start(self):
+        pass
+
+    def endpoint(self):
+        return "arn:aws:sqs:eu-west-1:123456789012:notifications"
+
+    def receive(self):
+        received, self.waiting = self.waiting, []
+        return received
+
+    def acknowledge(self, receipt_handles):
+        self.acknowledged.extend(receipt_handles)
+
+    def keep_invisible(self, receipt_handles):
+        self.invisible.append(receipt_handles)
+
+    def close(self):
+        pass
+
+
+class RecordingFollower(NotificationFollower):
+    def __init__(self, directory, minder, source) -> None:
+        super().__init__(None, "org", "s3://bucket", directory, minder, source)
+        self.subscription_id = "subscribed"
+        self.synced = []
+
+    def sync(self, activities):
+        self.synced.append(sorted({(a["Type"], a["ResourceMetadata"]["Id"]) for a in activities}))
+
+
+def notification(message_id, entity_id, action="upload_document_version", handle=None):
+    return (message_id, {"action": action, "entityType": "document", "entityId": entity_id,
+                         "parentEntityType": "folder", "parentEntityId": "folder1"}, handle or f"h-{message_id}")
+
+
+class TestNotificationIngest:
+
+    def test_document_notification_touches_its_folder(self):
+        activities = notification_to_activities(notification("m1", "doc1")[1], T0)
+        assert [(a["Type"], a["ResourceMetadata"]["Id"]) for a in activities] == [
+            ("DOCUMENT_UPDATED", "doc1"), ("FOLDER_UPDATED", "folder1")]
+        removed = notification_to_activities({"action": "delete_folder", "entityType": "folder",
+                                              "entityId": "folder2"}, T0)
+        assert [a["Type"] for a in removed] == ["FOLDER_RECYCLED"]
+        assert notification_to_activities({"entityType": "user", "entityId": "u1"}, T0) == []
+
+    def test_sns_envelope_is_unwrapped(self):
+        inner = {"entityType": "document", "entityId": "doc1"}
+        assert unwrap_sns({"Type": "Notification", "Message": json.dumps(inner)}) == inner
+        assert unwrap_sns(inner) == inner
+
+    def test_posts_without_the_token_are_rejected(self):
+        with pytest.raises(ValueError):
+            HttpsNotificationSource("https://example.com/notifications")
+        source = HttpsNotificationSource("https://example.com/notifications?token=0123456789abcdef", port=0)
+        source.start()
+        try:
+            url = f"http://localhost:{source.server.server_address[1]}/notifications"
+            body = json.dumps({"entityType": "document", "entityId": "doc1"}).encode("utf-8")
+            for query in ["", "?token=guess"]:
+                with pytest.raises(HTTPError) as rejected:
+                    urlopen(url + query, data=body)
+                assert rejected.value.code == 403
+            assert source.received.empty()
+            assert urlopen(url + "?token=0123456789abcdef", data=body).status == 200
+            assert source.receive()[0][1]["entityId"] == "doc1"
+        finally:
+            source.close()
+
+    def test_subscription_only_confirmed_with_aws(self):
+        with pytest.raises(RuntimeError):
+            HttpsNotificationSource.confirm_subscription("https://example.com/confirm?token=1")
+
+    def test_duplicates_skipped_and_acknowledged_after_sync(self):
+        directory, minder, source = FakeDirectory(), FakeMinder(T0 - timedelta(minutes=1)), FakeSource()
+        follower = RecordingFollower(directory, minder, source)
+        follower.tasks.refresh_caches = lambda: None
+        follower.run_once(T0)  # Catches up from the cursor
+        source.waiting = [notification("m1", "doc1"), notification("m1", "doc1", handle="h-again"),
+                          notification("m2", "doc2")]
+        follower.run_once(T0 + timedelta(seconds=1))
+        assert follower.synced == []
+        # Delivered again while waiting, so it's acknowledged later with the latest receipt handle
+        assert source.acknowledged == []
+        assert source.invisible == [["h-again", "h-m2"]]
+        follower.run_once(T0 + timedelta(seconds=20))
+        assert follower.synced == [[("DOCUMENT_UPDATED", "doc1"), ("DOCUMENT_UPDATED", "doc2"),
+                                    ("FOLDER_UPDATED", "folder1")]]
+        assert sorted(source.acknowledged) == ["h-again", "h-m2"]
+        assert minder.cursor == T0 + timedelta(seconds=1)
+        # Delivered again after syncing, it's only acknowledged
+        source.waiting = [notification("m2", "doc2", handle="h-late")]
+        follower.run_once(T0 + timedelta(seconds=21))
+        assert source.acknowledged[-1] == "h-late" and follower.pending == {}
+
+    def test_notifications_are_not_acknowledged_when_sync_fails(self, monkeypatch):
+        def failing_sync(follower, activities):
+            raise ConnectionError("Throttled")
+        monkeypatch.setattr(ActivityFollower, "sync", failing_sync)
+        directory, minder, source = FakeDirectory(), FakeMinder(T0 - timedelta(minutes=1)), FakeSource()
+        follower = NotificationFollower(None, "org", "s3://bucket", directory, minder, source)
+        follower.subscription_id = "subscribed"
+        follower.tasks.refresh_caches = lambda: None
+        follower.run_once(T0)
+        source.waiting = [notification("m1", "doc1")]
+        follower.run_once(T0 + timedelta(seconds=1))
+        with pytest.raises(ConnectionError):
+            follower.run_once(T0 + timedelta(seconds=20))
+        assert source.acknowledged == [] and ("NOTIFICATION", "m1") not in follower.seen
+        assert "doc1" in follower.pending
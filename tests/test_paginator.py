@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+from workdocs_dr.paginator import PrefetchPaginator
+
+
+class PagedOperation:
+    """Hands out `pages` pages, each fetch waiting until the test lets it go"""
+
+    def __init__(self, pages, fail_on=None) -> None:
+        self.pages = pages
+        self.fail_on = fail_on
+        self.requests = []
+        self.fetched = threading.Semaphore(0)
+
+    def __call__(self, **request):
+        self.requests.append(request)
+        page = int(request.get("Marker", 0))
+        self.fetched.release()
+        if page == self.fail_on:
+            raise ConnectionError("Connection reset")
+        response = {"Folders": [f"folder{page}"], "Documents": [f"doc{page}"]}
+        if page + 1 < self.pages:
+            response["Marker"] = str(page + 1)
+        return response
+
+
+class TestPrefetchPaginator:
+    def test_next_page_is_requested_while_current_is_processed(self):
+        operation = PagedOperation(3)
+        pages = PrefetchPaginator.workdocs(operation, {"FolderId": "f"}).pages()
+        assert next(pages)["Folders"] == ["folder0"]
+        # Page two is fetched without the caller asking for it
+        assert operation.fetched.acquire(timeout=5) and operation.fetched.acquire(timeout=5)
+        assert [r.get("Marker") for r in operation.requests[:2]] == [None, "1"]
+        assert operation.requests[0]["Limit"] == PrefetchPaginator.workdocs_page_size
+        assert [p["Folders"] for p in pages] == [["folder1"], ["folder2"]]
+
+    def test_streaming_and_batch_interfaces(self):
+        paginator = PrefetchPaginator.workdocs(PagedOperation(3), {"FolderId": "f"})
+        assert list(paginator.items("Folders", "Documents")) == [
+            "folder0", "doc0", "folder1", "doc1", "folder2", "doc2"]
+        assert paginator.collect("Folders", "Documents") == {
+            "Folders": ["folder0", "folder1", "folder2"], "Documents": ["doc0", "doc1", "doc2"]}
+
+    def test_single_page_listing_is_fetched_once(self):
+        operation = PagedOperation(1)
+        assert list(PrefetchPaginator.workdocs(operation, {}).items("Folders")) == ["folder0"]
+        assert len(operation.requests) == 1
+
+    def test_errors_while_prefetching_reach_the_caller(self):
+        items = PrefetchPaginator.workdocs(PagedOperation(5, fail_on=2), {}).items("Folders")
+        assert next(items) == "folder0" and next(items) == "folder1"
+        with pytest.raises(ConnectionError):
+            next(items)
+
+    def test_s3_listings_follow_continuation_tokens(self):
+        def list_objects_v2(**request):
+            token = request.get("ContinuationToken", None)
+            if token is None:
+                return {"Contents": [{"Key": "a"}], "IsTruncated": True, "NextContinuationToken": "t1"}
+            return {"Contents": [{"Key": "b"}], "IsTruncated": False}
+        paginator = PrefetchPaginator.s3(list_objects_v2, {"Bucket": "bucket", "Prefix": "p/"})
+        assert [o["Key"] for o in paginator.items("Contents")] == ["a", "b"]
+        assert paginator.request["MaxKeys"] == 1000
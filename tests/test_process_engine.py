@@ -0,0 +1,171 @@
+import io
+import pickle
+from collections import Counter
+from datetime import datetime, timezone
+from functools import partial
+
+from tests.helpers import FakeSession
+from workdocs_dr import process_engine
+from workdocs_dr.aws_clients import AwsClients
+from workdocs_dr.backup_options import BackupOptions
+from workdocs_dr.cli_arguments import processes_from_input
+from workdocs_dr.directory_minder import DirectoryBackupMinder
+from workdocs_dr.governor import Governor
+from workdocs_dr.process_engine import ProcessEngine
+from workdocs_dr.user import UserHelper
+
+NOW = datetime(2022, 6, 1, tzinfo=timezone.utc)
+
+
+class FakeService:
+    """Fires botocore's before-call event for each call, so requests are counted like with real clients"""
+
+    def __init__(self, service) -> None:
+        self.service = service
+        self.handlers = []
+        self.meta = type("Meta", (), {"events": type("Events", (), {"register": self.register})()})()
+
+    def register(self, event, handler):
+        self.handlers.append(handler)
+
+    def called(self, operation):
+        for handler in self.handlers:
+            handler(event_name=f"before-call.{self.service}.{operation}")
+
+
+class FakeS3(FakeService):
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self) -> None:
+        super().__init__("s3")
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.called("PutObject")
+        self.objects[Key] = Body
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.called("GetObject")
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey()
+        return {"Body": io.BytesIO(self.objects[Key]), "Metadata": {}}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        from botocore.exceptions import ClientError
+        self.called("HeadObject")
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {"Metadata": {}}
+
+    def list_objects_v2(self, Bucket, Prefix, Delimiter=None, **kwargs):
+        self.called("ListObjectsV2")
+        keys = sorted(k for k in self.objects if k.startswith(Prefix))
+        if Delimiter is None:
+            return {"Contents": [{"Key": k, "Size": len(self.objects[k]), "LastModified": NOW} for k in keys],
+                    "IsTruncated": False}
+        prefixes = sorted({Prefix + k[len(Prefix):].split(Delimiter)[0] + Delimiter
+                           for k in keys if Delimiter in k[len(Prefix):]})
+        return {"CommonPrefixes": [{"Prefix": p} for p in prefixes], "IsTruncated": False}
+
+
+class FakeDocs(FakeService):
+    """Each user has a root folder with one empty subfolder"""
+
+    def __init__(self) -> None:
+        super().__init__("workdocs")
+
+    @staticmethod
+    def folder(folder_id, parent_id):
+        return {"Id": folder_id, "ParentFolderId": parent_id, "Name": folder_id, "ResourceState": "ACTIVE",
+                "ModifiedTimestamp": NOW}
+
+    def get_folder(self, FolderId):
+        self.called("GetFolder")
+        return {"Metadata": self.folder(FolderId, None)}
+
+    def describe_folder_contents(self, FolderId, Type="ALL", **kwargs):
+        self.called("DescribeFolderContents")
+        folders = []
+        if FolderId.endswith("-root") and Type != "DOCUMENT":
+            folders = [self.folder(f"{FolderId}-sub", FolderId)]
+        return {"Folders": folders, "Documents": []}
+
+
+class FakeBackupSession:
+    """Session with fake clients, that can be handed to spawned worker processes"""
+
+    def __init__(self) -> None:
+        self.services = {"s3": FakeS3(), "workdocs": FakeDocs()}
+
+    def client(self, service_name, config=None, endpoint_url=None):
+        return self.services[service_name]
+
+
+def make_user(username):
+    return UserHelper({"Id": username, "OrganizationId": "d-123", "Username": username,
+                       "RootFolderId": f"{username}-root", "ModifiedTimestamp": NOW})
+
+
+class TestProcessEngine:
+    def test_worker_clients_take_a_share_of_the_limits(self):
+        governor = Governor(bytes_per_second=1000, requests_per_second={"*": 10, "s3": 100})
+        clients = AwsClients(partial(FakeSession), workdocs_role_arn="arn:workdocs",
+                             endpoint_urls={"workdocs": "http://localhost:8000"}, governor=governor)
+        spec = pickle.loads(pickle.dumps(clients.worker_spec(share=0.25)))
+        worker = AwsClients.from_worker_spec(spec)
+        assert worker.role_arns == {"workdocs": "arn:workdocs", "bucket": None}
+        assert worker.endpoint_urls == {"workdocs": "http://localhost:8000"}
+        assert worker.governor.bytes.rate == 250
+        assert worker.governor.report()["requests:s3"]["Limit"] == 25
+        assert worker.governor.default_requests_per_second == 2.5
+        # Limits handed on are the configured ones, not the scaled ones
+        assert worker.governor.worker_spec(1.0)["bytes_per_second"] == 1000
+        assert isinstance(worker.basesession, FakeSession)
+
+    def test_counts_from_workers_are_merged(self):
+        clients = AwsClients(FakeSession())
+        clients.count_request("s3", "PutObject")
+        clients.merge_request_counts(Counter({("s3", "PutObject"): 2, ("workdocs", "DescribeUsers"): 1}))
+        assert clients.request_summary() == {"s3": {"PutObject": 3}, "workdocs": {"DescribeUsers": 1}}
+        clients.governor.merge(Counter({"requests:s3": 2}), Counter({"requests:s3": 0.5}))
+        assert clients.governor.report()["requests:s3"] == {"Total": 3, "WaitedSeconds": 0.5, "Limit": None}
+
+    def test_processes_from_input(self, monkeypatch):
+        monkeypatch.delenv("PROCESSES", raising=False)
+        assert processes_from_input() == 1
+        assert processes_from_input("3") == 3
+        assert processes_from_input("auto") >= 1
+        monkeypatch.setenv("PROCESSES", "0")
+        assert processes_from_input() == 1
+
+    def test_backup_user_in_worker(self, monkeypatch):
+        monkeypatch.setattr(process_engine, "_worker", {})
+        clients = AwsClients(FakeBackupSession)
+        process_engine._init_worker(clients.worker_spec(share=0.5), "d-123", "s3://bucket/prefix", BackupOptions(),
+                                    None, None, 30)
+        outcome = process_engine._backup_user(make_user("someone"))
+        stored = process_engine._worker["clients"].bucket_client().objects
+        # The empty subfolder has no summary
+        assert sorted(stored) == ["prefix/d-123/someone/.userinfo", "prefix/d-123/someone/someone-root/.folderinfo"]
+        assert outcome["Stats"] == {"Actions": 1, "Bytes": 0} and outcome["Failed"] == []
+        assert outcome["Requests"][("workdocs", "DescribeFolderContents")] == 2
+        assert outcome["Requests"][("s3", "PutObject")] == 2
+        assert outcome["GovernorTotals"]["requests:workdocs"] == 4
+        # A second user's outcome only has what was counted backing it up
+        assert process_engine._backup_user(make_user("other"))["Requests"] == outcome["Requests"]
+
+    def test_backup_users_in_spawned_processes(self):
+        clients = AwsClients(FakeBackupSession)
+        minder = DirectoryBackupMinder(clients, "d-123", "s3://bucket/prefix")
+        engine = ProcessEngine(clients, "d-123", "s3://bucket/prefix", minder, BackupOptions(processes=2))
+        users = [make_user(name) for name in ["one", "two", "three"]]
+        results, stats = engine.backup_users(users)
+        assert results == [] and stats == {"Actions": 3, "Bytes": 0}
+        # Requests made in the workers are counted in this process
+        summary = clients.request_summary()
+        assert summary["workdocs"]["DescribeFolderContents"] == 6
+        assert summary["s3"]["PutObject"] == 6
+        assert clients.governor.report()["requests:workdocs"]["Total"] == 12
+        assert minder.get_retry_queue().failed == []
@@ -0,0 +1,46 @@
+import json
+import queue
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import sleep
+
+from workdocs_dr.profiling import profiled, profiler
+from workdocs_dr.queue_pool import QueueWorkPool
+
+
+@profiled("slow_step")
+def slow_step(seconds):
+    sleep(seconds)
+
+
+class SomeStage:
+    def _setup(self, task_queue):
+        def task_work(item, lock):
+            slow_step(item)
+        return QueueWorkPool(task_queue=task_queue, worker_count=2, worker_action=task_work)
+
+
+class TestProfiling:
+
+    def test_disabled_records_nothing(self):
+        slow_step(0)
+        assert profiler.report() == {}
+
+    def test_stages_and_samples(self):
+        with TemporaryDirectory() as tempdir:
+            prefix = str(Path(tempdir) / "run")
+            profiler.enable(prefix, sample_interval=0.001)
+            task_queue = queue.Queue()
+            pool = SomeStage()._setup(task_queue)
+            pool.start_tasks()
+            for _ in range(4):
+                task_queue.put(0.02)
+            pool.finish_tasks()
+            report = profiler.finish()
+            assert report["SomeStage"]["Calls"] == 4
+            assert report["slow_step"]["Calls"] == 4
+            assert json.loads(Path(f"{prefix}.stages.json").read_text()) == report
+            collapsed = Path(f"{prefix}.collapsed").read_text().splitlines()
+            assert any(line.startswith("slow_step;") and "test_profiling.py:slow_step" in line for line in collapsed)
+        profiler.stage_times.clear()
+        profiler.samples.clear()
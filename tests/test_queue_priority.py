@@ -0,0 +1,52 @@
+import threading
+from argparse import ArgumentTypeError
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+from workdocs_dr.cli_arguments import sync_priority_from_input
+from workdocs_dr.queue_priority import PriorityActionQueue, SyncPriority
+
+
+class Action:
+    def __init__(self, name, **record) -> None:
+        self.name = name
+        self.record = record
+
+
+class TestPriorityActionQueue:
+    now = datetime.now(tz=timezone.utc)
+
+    def test_recent_and_small_first(self):
+        q = PriorityActionQueue(SyncPriority(recency_weight=1.0, size_weight=0.5))
+        q.put(None)
+        q.put(Action("old", ModifiedTimestamp=self.now - timedelta(days=400), Size=1000))
+        q.put(Action("recent_large", ModifiedTimestamp=self.now - timedelta(hours=1), Size=5_000_000_000))
+        q.put(Action("recent_small", ModifiedTimestamp=self.now - timedelta(hours=1), Size=1000))
+        q.put(Action("activity"))
+        order = [q.get() for _ in range(5)]
+        assert [a.name for a in order[:4]] == ["activity", "recent_small", "recent_large", "old"]
+        assert order[4] is None
+
+    def test_bounded_queue_blocks_producer(self):
+        q = PriorityActionQueue(maxsize=2)
+        q.put(Action("a"))
+        q.put(Action("b"))
+        producer = threading.Thread(target=q.put, args=(Action("c"),), daemon=True)
+        producer.start()
+        producer.join(timeout=0.2)
+        assert producer.is_alive()
+        q.get()
+        producer.join(timeout=1)
+        assert not producer.is_alive()
+
+    def test_priority_from_input(self):
+        assert sync_priority_from_input("fifo") is None
+        weights = sync_priority_from_input("recency=2, size=0")
+        assert (weights.recency_weight, weights.size_weight) == (2.0, 0.0)
+
+    def test_unknown_priority_weights_are_rejected(self):
+        with pytest.raises(ArgumentTypeError, match="Weights are recency, size"):
+            sync_priority_from_input("recency=1,sise=2")
+        with pytest.raises(ArgumentTypeError, match="must be a number"):
+            sync_priority_from_input("size=big")
@@ -0,0 +1,88 @@
+import hashlib
+from datetime import datetime, timezone
+
+import pytest
+
+from tests.helpers import FakeClients
+from workdocs_dr.document import DocumentHelper
+from workdocs_dr.queue_restore import RunRestoreTasks
+from workdocs_dr.restore_journal import RestoreJournal
+from workdocs_dr.user import UserHelper, UserKeyHelper
+
+CONTENT = bytes(range(256)) * 8000
+
+
+class FlakyBody:
+    def __init__(self, data, fail_after=None) -> None:
+        self.data = data
+        self.fail_after = fail_after
+
+    def iter_chunks(self, chunk_size):
+        for i in range(0, len(self.data), chunk_size):
+            if self.fail_after is not None and i >= self.fail_after:
+                raise ConnectionError("Connection reset")
+            yield self.data[i:i + chunk_size]
+
+
+class FlakyBucket:
+    def __init__(self, metadata) -> None:
+        self.metadata = metadata
+        self.ranges = []
+        self.fail_after = None
+
+    def head_object(self, Bucket, Key):
+        return {"Metadata": self.metadata}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        self.ranges.append(Range)
+        start = int(Range[len("bytes="):].rstrip("-")) if Range is not None else 0
+        return {"Body": FlakyBody(CONTENT[start:], self.fail_after), "Metadata": self.metadata}
+
+
+def make_runner(tmp_path, bucket):
+    user = UserHelper({"OrganizationId": "d-123", "Username": "someone",
+                       "RootFolderId": "root", "ModifiedTimestamp": datetime.now(tz=timezone.utc)})
+    userkeys = UserKeyHelper(user, "s3://bucket/prefix")
+    return RunRestoreTasks(None, FakeClients(bucket), userkeys, RestoreJournal(tmp_path))
+
+
+class TestRestoreJournal:
+    s3obj = {"Key": "prefix/d-123/someone/f1/doc1", "ETag": '"abc"', "Size": len(CONTENT)}
+
+    def test_recorded_progress_survives_a_torn_line(self, tmp_path):
+        journal = RestoreJournal(tmp_path)
+        (tmp_path / "part").write_bytes(b"x" * 10)
+        journal.record_partial(self.s3obj, tmp_path / "part", 10)
+        journal.record_done({**self.s3obj, "Key": "other"})
+        journal.close()
+        with open(tmp_path / RestoreJournal.filename, "a") as f:
+            f.write('{"Key": "tor')
+        reloaded = RestoreJournal(tmp_path)
+        assert reloaded.is_done({**self.s3obj, "Key": "other"})
+        assert not reloaded.is_done({**self.s3obj, "Key": "other", "ETag": '"changed"'})
+        assert reloaded.get_partial(self.s3obj) == (tmp_path / "part", 10)
+        reloaded.close(remove=True)
+        assert not (tmp_path / RestoreJournal.filename).exists()
+
+    def test_interrupted_download_continues_with_range_request(self, tmp_path):
+        metadata = DocumentHelper.metadata_dict2s3({
+            "Id": "doc1", "Name": "big.bin", "Size": len(CONTENT),
+            "ContentModifiedTimestamp": datetime(2022, 6, 1, tzinfo=timezone.utc)})
+        metadata["sha256"] = hashlib.sha256(CONTENT).hexdigest()
+        bucket = FlakyBucket(metadata)
+        bucket.fail_after = 1024 * 1024
+        restoredef = {"Path": tmp_path, "S3Object": self.s3obj, "FolderId": "f1"}
+        runner = make_runner(tmp_path, bucket)
+        runner.journal.progress_bytes = 512 * 1024
+        with pytest.raises(ConnectionError):
+            runner.restore_resumable(restoredef)
+        runner.journal.close()
+        assert not (tmp_path / "big.bin").exists()
+
+        bucket.fail_after = None
+        runner = make_runner(tmp_path, bucket)
+        documentinfo = runner.restore_resumable(restoredef)
+        assert documentinfo["Action"] == "Restored"
+        assert (tmp_path / "big.bin").read_bytes() == CONTENT
+        assert bucket.ranges == [None, f"bytes={1024 * 1024}-"]
+        assert [p.name for p in tmp_path.iterdir() if p.name.endswith(".partial")] == []
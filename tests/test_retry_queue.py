@@ -0,0 +1,90 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from tests.helpers import FakeClients
+from workdocs_dr.retry_queue import RetryQueue
+from workdocs_dr.user import UserHelper
+from workdocs_dr.workdocs_bucket_sync import SyncAction
+
+NOW = datetime(2022, 6, 1, tzinfo=timezone.utc)
+
+
+class FlakySyncer:
+    def __init__(self, failures) -> None:
+        self.user = UserHelper({"OrganizationId": "d-123", "Username": "someone",
+                                "RootFolderId": "root", "ModifiedTimestamp": NOW})
+        self.failures = failures
+        self.calls = 0
+
+    def run_action(self, record):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise RuntimeError("Throttled")
+        return {"Done": record["Args"]}
+
+
+def make_queue(clients):
+    retry_queue = RetryQueue(clients, "bucket", "prefix/d-123/.retry_queue", "prefix/d-123/.dead_letters")
+    retry_queue.retry_delays = (0, 0)
+    return retry_queue
+
+
+class TestRetryQueue:
+    record = SyncAction.make_record("update_folder_summary", {"folder_id": "f1", "wdfolders": [], "wddocuments": []},
+                                    ModifiedTimestamp=NOW)
+
+    def test_transient_failures_are_retried_within_the_run(self):
+        retry_queue = make_queue(FakeClients())
+        syncer = FlakySyncer(failures=2)
+        assert retry_queue.run(SyncAction(syncer, self.record)) == {"Done": self.record["Args"]}
+        assert syncer.calls == 3 and retry_queue.failed == []
+
+    def test_failures_are_replayed_next_run_then_dead_lettered(self):
+        clients = FakeClients()
+        retry_queue = make_queue(clients)
+        with pytest.raises(RuntimeError):
+            retry_queue.run(SyncAction(FlakySyncer(failures=3), self.record))
+        retry_queue.save()
+        for run in range(2, RetryQueue.max_runs + 1):
+            retry_queue = make_queue(clients)
+            [entry] = retry_queue.take()
+            assert entry["Runs"] == run - 1 and entry["Error"] == "Throttled"
+            # Only what's needed to run it again is kept
+            assert entry["Args"] == {"folder_id": "f1"} and entry["User"]["Username"] == "someone"
+            with pytest.raises(RuntimeError):
+                retry_queue.run(SyncAction(FlakySyncer(failures=3), entry))
+            retry_queue.save()
+        assert make_queue(clients).take() == []
+        [dead] = make_queue(clients)._load("prefix/d-123/.dead_letters")
+        assert dead["Runs"] == RetryQueue.max_runs
+
+    def test_saving_keeps_entries_not_taken(self):
+        clients = FakeClients()
+        first = make_queue(clients)
+        with pytest.raises(RuntimeError):
+            first.run(SyncAction(FlakySyncer(failures=3), self.record))
+        first.save()
+        second = make_queue(clients)
+        with pytest.raises(RuntimeError):
+            second.run(SyncAction(FlakySyncer(failures=3), self.record))
+        second.save()
+        second.save()
+        assert len(make_queue(clients).take()) == 2
+
+    def test_overlapping_runs_keep_each_others_entries(self):
+        clients = FakeClients()
+        first = make_queue(clients)
+        with pytest.raises(RuntimeError):
+            first.run(SyncAction(FlakySyncer(failures=3), self.record))
+        first.save()
+        # A full run replays the stored entry while a subtree run saves one of its own
+        full, subtree = make_queue(clients), make_queue(clients)
+        [entry] = full.take()
+        full.run(SyncAction(FlakySyncer(failures=0), entry))
+        with pytest.raises(RuntimeError):
+            subtree.run(SyncAction(FlakySyncer(failures=3), self.record))
+        subtree.save()
+        full.save()
+        [kept] = make_queue(clients).take()
+        assert kept["Runs"] == 1 and kept["EntryId"] != entry["EntryId"]
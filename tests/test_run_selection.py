@@ -0,0 +1,155 @@
+from argparse import ArgumentParser
+from datetime import datetime, timedelta, timezone
+
+from tests.helpers import FakeClients
+from workdocs_dr.cli_arguments import wdfilter_from_input
+from workdocs_dr.directory_backup import DirectoryBackupRunner
+from workdocs_dr.directory_minder import DirectoryBackupMinder, RunEvent, RunStyle
+from workdocs_dr.listings import WdDirectory, WdFilter
+from workdocs_dr.run_ledger import RunStyleSelector
+from workdocs_dr.user import UserHelper, UserKeyHelper
+
+NOW = datetime(2022, 6, 1, 12, 0, tzinfo=timezone.utc)
+
+
+class FixedTimeMinder(DirectoryBackupMinder):
+    now = NOW
+
+    def get_now(self):
+        return self.now
+
+
+def run(style, days_ago, duration, **stats):
+    end = NOW - timedelta(days=days_ago)
+    return {"RunStyle": style, "StartTime": end - timedelta(seconds=duration), "EndTime": end,
+            "Duration": duration, **stats}
+
+
+class TestRunStyleSelector:
+    ledger = [run("full", 20, 3600, Actions=30), run("activities", 15, 50, Activities=49),
+              run("full", 10, 3600, Actions=40), run("activities", 2, 60, Activities=59),
+              run("activities", 1, 100, Activities=99)]
+
+    def test_activities_while_cheap_and_drift_is_low(self):
+        selector = RunStyleSelector(self.ledger, NOW)
+        style, predictions = selector.choose(199, NOW - timedelta(days=10))
+        assert style == "activities"
+        assert predictions["ActivitiesSeconds"] == 200
+        assert predictions["ExpectedDrift"] == 40
+
+    def test_full_when_activities_cost_more(self):
+        style, _ = RunStyleSelector(self.ledger, NOW).choose(4000, NOW - timedelta(days=10))
+        assert style == "full"
+
+    def test_full_when_expected_drift_is_too_high(self):
+        style, predictions = RunStyleSelector(self.ledger, NOW).choose(10, NOW - timedelta(days=13))
+        assert predictions["ExpectedDrift"] == 52
+        assert style == "full"
+
+    def test_back_to_back_full_runs_are_not_drift(self):
+        ledger = [run("full", 31, 3600, Actions=100), run("activities", 2, 60, Activities=59),
+                  run("full", 1, 3600, Actions=30), run("full", 0, 3600, Actions=100)]
+        selector = RunStyleSelector(ledger, NOW)
+        # The last FULL run made up for no activity runs, so only the one before tells drift
+        assert selector.drift_per_day() == 1
+        style, predictions = selector.choose(59, NOW - timedelta(days=7))
+        assert style == "activities" and predictions["ExpectedDrift"] == 7
+
+    def test_without_history_falls_back_on_age(self):
+        selector = RunStyleSelector([], NOW)
+        assert selector.choose(None, NOW - timedelta(days=29))[0] == "activities"
+        assert selector.choose(None, NOW - timedelta(days=31))[0] == "full"
+
+
+class TestRunLedger:
+    def test_runs_are_recorded_and_steer_the_run_style(self):
+        clients = FakeClients()
+        minder = FixedTimeMinder(clients, "d-123", "s3://bucket/prefix")
+        minder.update_last_event_time(RunStyle.FULL, RunEvent.START, event_time=NOW - timedelta(hours=1))
+        minder.update_last_event_time(RunStyle.FULL, RunEvent.END, event_time=NOW,
+                                      run_stats={"Actions": 3, "Bytes": 10, "Requests": 50})
+        reloaded = FixedTimeMinder(clients, "d-123", "s3://bucket/prefix")
+        [entry] = reloaded.get_run_ledger().get_entries()
+        assert entry["RunStyle"] == "full" and entry["Duration"] == 3600 and entry["Requests"] == 50
+        assert reloaded.get_best_run_style(pending_activities=10) is RunStyle.ACTIVITIES
+
+    def test_abort_while_full_run_is_unfinished(self):
+        clients = FakeClients()
+        minder = FixedTimeMinder(clients, "d-123", "s3://bucket/prefix")
+        minder.update_last_event_time(RunStyle.FULL, RunEvent.START, event_time=NOW - timedelta(hours=1))
+        assert FixedTimeMinder(clients, "d-123", "s3://bucket/prefix").get_best_run_style() is RunStyle.ABORT
+
+
+class TestRollingReconciliation:
+    def test_slices_are_taken_in_turn_until_all_are_covered(self):
+        minder = FixedTimeMinder(FakeClients(), "d-123", "s3://bucket/prefix")
+        assert minder.get_reconcile_state(3)["NextSlice"] == 0
+        for i in range(3):
+            assert minder.get_reconcile_coverage(3) is None
+            minder.complete_reconcile_slice(3, i, NOW + timedelta(days=i))
+        state = minder.get_reconcile_state(3)
+        assert state["NextSlice"] == 0
+        assert minder.get_reconcile_coverage(3) == NOW
+        # Changing the number of slices starts over
+        assert minder.get_reconcile_state(4) == {"Slices": 4, "NextSlice": 0, "SliceEnds": {}}
+
+    def test_users_spread_over_slices(self):
+        slices = [DirectoryBackupMinder.reconcile_slice(f"user-{i}", 4) for i in range(400)]
+        assert DirectoryBackupMinder.reconcile_slice("user-1", 4) == slices[1]
+        assert all(60 < slices.count(s) < 140 for s in range(4))
+
+    def test_rolling_mode_is_chosen_when_enabled(self):
+        minder = FixedTimeMinder(FakeClients(), "d-123", "s3://bucket/prefix")
+        assert minder.get_best_run_style(10, reconcile_slices=7) is RunStyle.RECONCILE
+
+    def test_full_when_too_many_activities_to_reconcile(self, monkeypatch):
+        minder = FixedTimeMinder(FakeClients(), "d-123", "s3://bucket/prefix")
+        assert minder.get_best_run_style(5001, reconcile_slices=7) is RunStyle.FULL
+        # Also when reconciling is asked for
+        backed_up = []
+        monkeypatch.setattr(WdDirectory, "generate_activities", lambda directory, start: [{}] * 5001)
+        monkeypatch.setattr(WdDirectory, "generate_users", lambda directory, filter: iter([]))
+        monkeypatch.setattr(DirectoryBackupRunner, "reconcile", lambda runner, *args: backed_up.append("reconcile"))
+        monkeypatch.setattr(DirectoryBackupRunner, "backup_users",
+                            lambda runner, users: backed_up.append("full") or ([], {"Actions": 0, "Bytes": 0}))
+        clients = FakeClients()
+        clients.request_counts = {}
+        runner = DirectoryBackupRunner(clients, "d-123", "s3://bucket/prefix", run_style=RunStyle.RECONCILE,
+                                       reconcile_slices=7)
+        monkeypatch.setattr(runner, "replay_failed_actions", lambda: None)
+        runner.runall()
+        assert backed_up == ["full"]
+
+
+class TestSubtreeRuns:
+    def test_folder_paths_are_separate_arguments(self):
+        parser = ArgumentParser()
+        parser.add_argument("--folder", nargs="+", default=None)
+        args = parser.parse_args(["--folder", "Projects/Alpha Beta", "Team Docs"])
+        assert wdfilter_from_input(None, args.folder).foldernames == ["Projects/Alpha Beta", "Team Docs"]
+        assert wdfilter_from_input(None, None).foldernames == []
+
+    def test_folder_runs_walk_whatever_the_run_style(self, monkeypatch):
+        walked = []
+        monkeypatch.setattr(WdDirectory, "generate_users", lambda directory, filter: iter([]))
+        monkeypatch.setattr(DirectoryBackupRunner, "backup_users",
+                            lambda runner, users: walked.append(users) or ([], {"Actions": 0, "Bytes": 0}))
+        clients = FakeClients()
+        clients.request_counts = {}
+        for style in [RunStyle.ACTIVITIES, RunStyle.RECONCILE, RunStyle.FOLLOW]:
+            runner = DirectoryBackupRunner(clients, "d-123", "s3://bucket/prefix",
+                                           filter=WdFilter(foldernames=["Projects/Alpha"]), run_style=style)
+            assert runner.runall() == []
+        assert len(walked) == 3
+
+    def test_subtree_completions_of_overlapping_runs(self):
+        minder = DirectoryBackupMinder(FakeClients(), "d-123", "s3://bucket/prefix")
+        userkeys = UserKeyHelper(UserHelper({"OrganizationId": "d-123", "Username": "someone",
+                                             "RootFolderId": "root", "ModifiedTimestamp": NOW}), "s3://bucket/prefix")
+        later = {"Path": "Projects", "StartTime": NOW, "EndTime": NOW + timedelta(minutes=5)}
+        earlier = {"Path": "Projects", "StartTime": NOW - timedelta(hours=1), "EndTime": NOW + timedelta(minutes=10)}
+        minder.update_subtree_completion(userkeys, "f1", later)
+        minder.update_subtree_completion(userkeys, "f2", dict(later, Path="Alpha"))
+        minder.update_subtree_completion(userkeys, "f1", earlier)
+        completions = minder.get_subtree_completions(userkeys)
+        assert completions["f1"]["StartTime"] == NOW and completions["f2"]["Path"] == "Alpha"
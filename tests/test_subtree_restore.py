@@ -0,0 +1,71 @@
+from pathlib import Path
+
+from yaml import dump
+
+from tests.helpers import FakeBucket, FakeClients
+from workdocs_dr.document import DocumentHelper
+from workdocs_dr.listings import S3FolderTree, WdFilter
+from workdocs_dr.user import UserHelper, UserKeyHelper
+from workdocs_dr.user_restore import UserRestoreRunner
+
+
+class FolderTreeBucket(FakeBucket):
+    def __init__(self, tree, prefix) -> None:
+        """`tree` maps folder id to (name, parent id, subfolder ids)"""
+        super().__init__()
+        for folder_id, (name, parent_id, children) in tree.items():
+            body = {"Documents": [], "Folders": [{"Id": c, "Name": tree[c][0]} for c in children]}
+            metadata = {"Id": folder_id, "Name": name, "ParentFolderId": parent_id}
+            self.put_object(Bucket="bucket", Key=f"{prefix}/{folder_id}/{DocumentHelper.FOLDERINFONAME}",
+                            Body=dump(body).encode("utf-8"), Metadata=DocumentHelper.metadata_dict2s3(metadata))
+
+    def read_folders(self):
+        return sorted({key.split("/")[-2] for key, _ in self.gets})
+
+    def list_objects_v2(self, Bucket, Prefix, Delimiter, MaxKeys=None):
+        prefixes = sorted({Prefix + k[len(Prefix):].split("/")[0] + "/" for k in self.objects if k.startswith(Prefix)})
+        return {"CommonPrefixes": [{"Prefix": p} for p in prefixes], "IsTruncated": False}
+
+
+class TestSubtreeRestore:
+    tree = {
+        "root": ("root", "user", ["projects", "personal"]),
+        "projects": ("Projects", "root", ["alpha", "beta"]),
+        "alpha": ("Alpha", "projects", ["designs"]),
+        "designs": ("Designs", "alpha", []),
+        "beta": ("Beta", "projects", []),
+        "personal": ("Personal", "root", []),
+    }
+
+    def test_restores_only_named_subtree(self):
+        uh = UserHelper({"OrganizationId": "org", "Username": "jane", "RootFolderId": "root",
+                         "ModifiedTimestamp": None})
+        ukh = UserKeyHelper(uh, "s3://bucket/backup")
+        bucket = FolderTreeBucket(self.tree, ukh.bucket_userprefix())
+        runner = UserRestoreRunner(uh, ukh, FakeClients(bucket), Path("/restore"))
+        defs = list(runner.generate_restoredefs(WdFilter(foldernames=["Projects/Alpha", "Missing"])))
+        assert [(d["Metadata"]["Id"], d["Path"]) for d in defs] == [
+            ("alpha", Path("/restore/Projects/Alpha")),
+            ("designs", Path("/restore/Projects/Alpha/Designs")),
+        ]
+        # Only folders on the way to and inside the subtree are read
+        assert bucket.read_folders() == ["alpha", "designs", "projects", "root"]
+
+    def test_summaries_without_contents_fall_back_on_folder_metadata(self):
+        uh = UserHelper({"OrganizationId": "org", "Username": "jane", "RootFolderId": "root",
+                         "ModifiedTimestamp": None})
+        ukh = UserKeyHelper(uh, "s3://bucket/backup")
+        bucket = FolderTreeBucket(self.tree, ukh.bucket_userprefix())
+        # Summaries written by activity runs used to list nothing
+        key = f"{ukh.bucket_userprefix()}/projects/{DocumentHelper.FOLDERINFONAME}"
+        bucket.objects[key] = (dump({"Documents": [], "Folders": []}).encode("utf-8"), bucket.objects[key][1])
+        runner = UserRestoreRunner(uh, ukh, FakeClients(bucket), Path("/restore"))
+        defs = list(runner.generate_restoredefs(WdFilter(foldernames=["Projects"])))
+        assert sorted((d["Metadata"]["Id"], d["Path"]) for d in defs) == [
+            ("alpha", Path("/restore/Projects/Alpha")),
+            ("beta", Path("/restore/Projects/Beta")),
+            ("designs", Path("/restore/Projects/Alpha/Designs")),
+            ("projects", Path("/restore/Projects")),
+        ]
+        foldertree = S3FolderTree(FakeClients(bucket), ukh.bucket, ukh.bucket_userprefix())
+        assert foldertree.resolve_path("root", "Projects/Alpha/Designs") == "designs"
@@ -0,0 +1,132 @@
+from datetime import datetime, timezone, timedelta
+
+from tests.helpers import FakeClients
+from workdocs_dr.aws_clients import AwsClients
+from workdocs_dr.backup_options import BackupOptions
+from workdocs_dr.codec import Compression
+from workdocs_dr.sync_plan import SyncPlan
+from workdocs_dr.user import UserHelper, UserKeyHelper
+from workdocs_dr.version_index import VersionIndex
+from workdocs_dr.workdocs_bucket_sync import SyncAction, WorkDocs2BucketSync
+
+
+def make_syncer(index_entries=None, options=None):
+    user = UserHelper({"OrganizationId": "d-123", "Username": "someone",
+                       "RootFolderId": "root", "ModifiedTimestamp": datetime.now(tz=timezone.utc)})
+    clients = AwsClients(None)
+    userkeys = UserKeyHelper(user, "s3://bucket/prefix")
+    version_index = VersionIndex(clients, userkeys)
+    version_index.entries = index_entries or {}
+    return WorkDocs2BucketSync(clients, user, userkeys, version_index, options)
+
+
+def wd_document(document_id, size, modified, folder_id="f1"):
+    return {"Id": document_id, "ParentFolderId": folder_id,
+            "LatestVersionMetadata": {"Id": f"v-{document_id}", "Name": document_id, "Size": size,
+                                      "ModifiedTimestamp": modified}}
+
+
+class TestSyncPlan:
+    now = datetime(2022, 6, 1, tzinfo=timezone.utc)
+    folder_def = {"Id": "f1", "ModifiedTimestamp": now - timedelta(days=10)}
+
+    def planned_records(self):
+        wddocuments = [wd_document("new", 2_000, self.now), wd_document("same", 10, self.now - timedelta(days=5)),
+                       wd_document("grown", 20_000_000, self.now)]
+        prefix = "prefix/d-123/someone/f1"
+        s3documents = [
+            {"Key": f"{prefix}/same", "Size": 10, "LastModified": self.now - timedelta(days=4)},
+            {"Key": f"{prefix}/grown", "Size": 10, "LastModified": self.now - timedelta(days=4)},
+            {"Key": f"{prefix}/gone", "Size": 99, "LastModified": self.now - timedelta(days=4)},
+            {"Key": f"{prefix}/.folderinfo", "Size": 1, "LastModified": self.now - timedelta(days=4)},
+        ]
+        return make_syncer().plan_syncactions(self.folder_def, [], wddocuments, s3documents)
+
+    def test_plan_syncactions_records(self):
+        records = self.planned_records()
+        by_action = {}
+        for r in records:
+            by_action.setdefault(r["Action"], []).append(r)
+        assert sorted(r["Args"]["document_id"] for r in by_action["copy_to_bucket"]) == ["grown", "new"]
+        assert [r["Args"]["document_id"] for r in by_action["remove_from_bucket"]] == ["gone"]
+        assert len(by_action["update_folder_summary"]) == 1
+
+    def test_plan_tally(self):
+        syncer = make_syncer()
+        plan = SyncPlan()
+        for r in self.planned_records():
+            plan.put(SyncAction(syncer, r))
+        plan.add_user(folder_count=1)
+        summary = plan.to_dict(walk_seconds=10, walk_requests={}, last_run_stats={})
+        assert summary["Copies"] == 2
+        assert summary["Deletes"] == 1
+        assert summary["EstimatedBytes"] == 20_002_000
+        assert summary["EstimatedRequests"]["Execution"]["s3"]["UploadPart"] == 3
+        assert summary["ProjectedSeconds"] is None
+        assert plan.projected_seconds(10, {"Duration": 100, "Actions": 1, "Bytes": 1_000_000}) == 2000
+
+
+class TestVersionChangeDetection:
+    now = datetime(2022, 6, 1, tzinfo=timezone.utc)
+    s3object = {"Key": "prefix/d-123/someone/f1/doc", "Size": 10, "LastModified": now}
+
+    def test_same_size_edit_is_copied(self):
+        syncer = make_syncer({"doc": {"FolderId": "f1", "VersionId": "v-old", "Signature": None, "Size": 10}})
+        assert syncer.is_document_changed("f1", wd_document("doc", 10, self.now - timedelta(days=1)), self.s3object)
+
+    def test_clock_skew_is_not_copied(self):
+        syncer = make_syncer({"doc": {"FolderId": "f1", "VersionId": "v-doc", "Signature": None, "Size": 10}})
+        skewed = wd_document("doc", 10, self.now + timedelta(minutes=3))
+        assert not syncer.is_document_changed("f1", skewed, self.s3object)
+
+    def test_unindexed_current_object_is_adopted(self):
+        syncer = make_syncer()
+        assert not syncer.is_document_changed("f1", wd_document("doc", 10, self.now - timedelta(days=1)), self.s3object)
+        assert syncer.version_index.get("doc")["VersionId"] == "v-doc"
+        assert syncer.version_index.dirty
+
+    def test_compressed_object_is_not_copied_for_its_size(self):
+        options = BackupOptions(compression=Compression("gzip"))
+        earlier, later = self.now - timedelta(days=1), self.now + timedelta(days=1)
+        assert not make_syncer(options=options).is_document_changed("f1", wd_document("doc", 25, earlier),
+                                                                    self.s3object)
+        assert make_syncer(options=options).is_document_changed("f1", wd_document("doc", 25, later), self.s3object)
+        assert make_syncer().is_document_changed("f1", wd_document("doc", 25, earlier), self.s3object)
+
+
+class TestVersionIndex:
+    userkeys = UserKeyHelper(UserHelper({"OrganizationId": "d-123", "Username": "someone", "RootFolderId": "root",
+                                         "ModifiedTimestamp": datetime(2022, 6, 1, tzinfo=timezone.utc)}),
+                             "s3://bucket/prefix")
+
+    def test_saving_keeps_what_other_runs_saved(self):
+        clients = FakeClients()
+        first, second = VersionIndex(clients, self.userkeys), VersionIndex(clients, self.userkeys)
+        first.record("kept", "f1", {"Id": "v1"})
+        first.record("moved", "f1", {"Id": "v1"})
+        first.save()
+        first.get("kept")
+        second.get("kept")
+        first.record("d1", "f1", {"Id": "v1"})
+        first.record_history("d1", ["v0"])
+        first.save()
+        second.record("d2", "f2", {"Id": "v1"})
+        second.forget("moved", "f1")
+        second.record_history("d1", ["v00"])
+        second.save()
+        stored = VersionIndex(clients, self.userkeys)
+        assert sorted(stored.get(d)["VersionId"] for d in ["kept", "d1", "d2"]) == ["v1", "v1", "v1"]
+        assert stored.get("moved") is None
+        assert stored.get_history("d1") == ["v0", "v00"]
+        assert second.get("d1") is not None
+
+    def test_recorded_entries_are_saved_during_a_run(self, monkeypatch):
+        clients = FakeClients()
+        index = VersionIndex(clients, self.userkeys)
+        index.record("d1", "f1", {"Id": "v1"})
+        assert VersionIndex(clients, self.userkeys).get("d1") is None
+        monkeypatch.setattr(VersionIndex, "save_interval", 0)
+        index.record("d2", "f1", {"Id": "v1"})
+        stored = VersionIndex(clients, self.userkeys)
+        assert stored.get("d1")["VersionId"] == "v1" and stored.get("d2")["VersionId"] == "v1"
+        assert not index.dirty
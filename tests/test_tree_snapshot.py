@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta, timezone
+
+import queue
+
+from tests.helpers import FakeClients
+from workdocs_dr.backup_options import BackupOptions
+from workdocs_dr.queue_backup import ListWorkdocsFolders, RecordSyncTasks
+from workdocs_dr.tree_snapshot import TreeSnapshot
+from workdocs_dr.user import UserHelper, UserKeyHelper
+from workdocs_dr.workdocs_bucket_sync import WorkDocs2BucketSync
+
+NOW = datetime(2022, 6, 1, tzinfo=timezone.utc)
+
+
+class FakeDocs:
+    def __init__(self, tree) -> None:
+        self.tree = tree  # Keyed by folder id, value is the parent id
+        self.modified = {}
+        self.listed = []
+
+    def folder(self, folder_id):
+        return {"Id": folder_id, "ParentFolderId": self.tree[folder_id], "ResourceState": "ACTIVE",
+                "ModifiedTimestamp": self.modified.get(folder_id, NOW - timedelta(days=100))}
+
+    def get_folder(self, FolderId):
+        return {"Metadata": self.folder(FolderId)}
+
+    def describe_folder_contents(self, FolderId, Type, Limit=None, Marker=None):
+        self.listed.append(FolderId)
+        return {"Folders": [self.folder(f) for f, parent in self.tree.items() if parent == FolderId],
+                "Documents": [{"Id": f"doc-{FolderId}", "ParentFolderId": FolderId, "ResourceState": "ACTIVE",
+                               "LatestVersionMetadata": {"Id": "v1", "Name": "doc", "Size": 1,
+                                                         "ModifiedTimestamp": NOW}}]}
+
+
+class TestTreeSnapshot:
+    tree = {"root": None, "a": "root", "a1": "a", "a2": "a", "b": "root"}
+
+    def walk(self, clients, now=NOW, **kwargs):
+        user = UserHelper({"OrganizationId": "d-123", "Username": "someone", "RootFolderId": "root",
+                           "ModifiedTimestamp": NOW})
+        userkeys = UserKeyHelper(user, "s3://bucket/prefix")
+        snapshot = TreeSnapshot(clients, userkeys, now=now, **kwargs)
+        clients.docs.listed = []
+        folder_queue = queue.Queue()
+        walker = ListWorkdocsFolders(clients, collect_folders=True, downstream_queue=folder_queue, snapshot=snapshot)
+        planner = RecordSyncTasks(clients, user, userkeys, task_queue=folder_queue, options=BackupOptions(),
+                                  snapshot=snapshot)
+        walker.start_walk("root")
+        planner.start_recording()
+        walker.finish_walk()
+        folder_queue.put(None)
+        planner.finish_recording()
+        snapshot.save()
+        return sorted(clients.docs.listed), walker.folders, snapshot
+
+    def test_only_subtrees_with_evidence_of_change_are_walked(self):
+        clients = FakeClients(docs=FakeDocs(dict(self.tree)))
+        listed, _, _ = self.walk(clients, verify_fraction=0)
+        assert listed == ["a", "a1", "a2", "b", "root"]
+        listed, folders, snapshot = self.walk(clients, verify_fraction=0)
+        assert listed == ["root"]
+        # Skipped folders are still there, so aren't pruned
+        assert folders == set(self.tree)
+        assert snapshot.stats == {"Skipped": 2}
+        clients.docs.modified["b"] = NOW
+        assert self.walk(clients, verify_fraction=0)[0] == ["b", "root"]
+        # Activities in a folder lead down to it
+        assert self.walk(clients, verify_fraction=0, changed_folders={"a1"})[0] == ["a", "a1", "root"]
+        # So do folders not walked for too long
+        assert self.walk(clients, now=NOW + timedelta(days=40), verify_fraction=0)[0] == ["a", "a1", "a2", "b", "root"]
+
+    def test_folders_failing_to_plan_are_walked_again(self, monkeypatch):
+        def get_folder_syncactions(syncer, folder_def, folders, documents):
+            if folder_def["Id"] == "a1":
+                raise ConnectionError("SlowDown")
+            return []
+        monkeypatch.setattr(WorkDocs2BucketSync, "get_folder_syncactions", get_folder_syncactions)
+        clients = FakeClients(docs=FakeDocs(dict(self.tree)))
+        self.walk(clients, verify_fraction=0)
+        monkeypatch.undo()
+        monkeypatch.setattr(WorkDocs2BucketSync, "get_folder_syncactions", lambda *args: [])
+        assert self.walk(clients, verify_fraction=0)[0] == ["a", "a1", "root"]
+        assert self.walk(clients, verify_fraction=0)[0] == ["root"]
+
+    def test_verification_walks_and_removed_folders_drop_out(self):
+        clients = FakeClients(docs=FakeDocs(dict(self.tree)))
+        self.walk(clients, verify_fraction=0)
+        del clients.docs.tree["a2"]
+        listed, _, snapshot = self.walk(clients, verify_fraction=1)
+        assert listed == ["a", "a1", "b", "root"]
+        assert snapshot.stats == {"Verified": 3, "Missed": 1}
+        assert "a2" not in snapshot.entries
+        assert snapshot.subtree_ids("a") == ["a", "a1"]
+
+    def test_folders_touched_by_activities(self):
+        activities = [
+            {"Type": "DOCUMENT_VERSION_UPLOADED", "ResourceMetadata": {"Id": "doc", "ParentId": "f1"}},
+            {"Type": "DOCUMENT_MOVED", "ResourceMetadata": {"Id": "doc", "ParentId": "f2"},
+             "OriginalParent": {"Id": "f3"}},
+            {"Type": "FOLDER_RENAMED", "ResourceMetadata": {"Id": "f4", "ParentId": "f5"}},
+        ]
+        assert TreeSnapshot.folders_touched(activities) == {"f1", "f2", "f3", "f4", "f5"}
@@ -0,0 +1,96 @@
+from datetime import datetime, timezone
+
+from tests.helpers import FakeBucket, FakeClients
+from workdocs_dr.user import UserHelper, UserKeyHelper
+from workdocs_dr.verification import BackupVerifier, merge_join
+from workdocs_dr.version_index import VersionIndex
+
+T0 = datetime(2022, 5, 1, tzinfo=timezone.utc)
+T1 = datetime(2022, 6, 1, tzinfo=timezone.utc)
+
+
+def document(document_id, size=10, modified=T0):
+    return {"Id": document_id, "ResourceState": "ACTIVE",
+            "LatestVersionMetadata": {"Id": f"{document_id}-v", "Size": size, "ModifiedTimestamp": modified}}
+
+
+class FakeDocs:
+    def __init__(self, folders, documents) -> None:
+        self.folders = folders  # Keyed by folder id, value is the parent id
+        self.documents = documents  # Keyed by folder id, value is list of documents
+
+    def describe_folder_contents(self, FolderId, Type, Limit=None, Marker=None):
+        return {"Folders": [{"Id": f, "ParentFolderId": p, "ResourceState": "ACTIVE"}
+                            for f, p in self.folders.items() if p == FolderId and Type != "DOCUMENT"],
+                "Documents": self.documents.get(FolderId, []) if Type != "FOLDER" else []}
+
+
+class TestVerification:
+
+    def test_merge_join(self):
+        workdocs = [("f1/.folderinfo", "wf1"), ("f1/d1", "wd1"), ("f1/d3", "wd3"), ("f2/.folderinfo", "wf2")]
+        bucket = [("f1/.folderinfo", "sf1"), ("f1/d2", "sd2"), ("f1/d3", "sd3"), ("f3/d9", "sd9")]
+        assert list(merge_join(iter(workdocs), iter(bucket))) == [
+            ("f1/.folderinfo", "wf1", "sf1"),
+            ("f1/d1", "wd1", None),
+            ("f1/d2", None, "sd2"),
+            ("f1/d3", "wd3", "sd3"),
+            ("f2/.folderinfo", "wf2", None),
+            ("f3/d9", None, "sd9"),
+        ]
+
+    def test_merge_join_one_side_empty(self):
+        assert list(merge_join([], [("a", 1)])) == [("a", None, 1)]
+        assert list(merge_join([("a", 1)], [])) == [("a", 1, None)]
+
+
+class TestBackupVerifier:
+    user = UserHelper({"OrganizationId": "d-123", "Username": "someone", "RootFolderId": "root",
+                       "ModifiedTimestamp": T0})
+    userprefix = "prefix/d-123/someone"
+
+    def make_verifier(self):
+        docs = FakeDocs({"full": "root", "empty": "root", "parent": "root", "child": "parent"},
+                        {"root": [document("d1")], "full": [document("d2"), document("d3", size=20)],
+                         "child": [document("d4", modified=T1)]})
+        clients = FakeClients(FakeBucket(last_modified=T0), docs)
+        for key in ["root/.folderinfo", "root/d1", "full/.folderinfo", "full/d3", "child/.folderinfo", "child/d4",
+                    "gone/.folderinfo", "gone/d9"]:
+            clients.bucket.put_object(Bucket="bucket", Key=f"{self.userprefix}/{key}", Body=bytes(10))
+        return BackupVerifier(clients, "d-123", "s3://bucket/prefix")
+
+    def test_workdocs_entries_mark_empty_folders(self):
+        entries = list(self.make_verifier().generate_wd_entries(self.user))
+        assert [k for k, _ in entries] == [
+            "child/.folderinfo", "child/d4", "empty/.folderinfo", "full/.folderinfo", "full/d2", "full/d3",
+            "parent/.folderinfo", "root/.folderinfo", "root/d1"]
+        empty = {k: e["Empty"] for k, e in entries if e["Document"] is None}
+        assert empty == {"child/.folderinfo": False, "empty/.folderinfo": True, "full/.folderinfo": False,
+                         "parent/.folderinfo": False, "root/.folderinfo": False}
+
+    def test_bucket_entries_are_in_folder_order(self):
+        verifier = self.make_verifier()
+        entries = list(verifier.generate_s3_entries(UserKeyHelper(self.user, "s3://bucket/prefix")))
+        assert [k for k, _ in entries] == ["child/.folderinfo", "child/d4", "full/.folderinfo", "full/d3",
+                                           "gone/.folderinfo", "gone/d9", "root/.folderinfo", "root/d1"]
+
+    def test_findings(self):
+        verifier = self.make_verifier()
+        findings = []
+        verifier.report = findings.append
+        verifier.verify_user(self.user)
+        assert sorted((f["Key"], f["Finding"]) for f in findings) == [
+            ("child/d4", "Stale"), ("full/d2", "Missing"), ("full/d3", "Stale"), ("gone/.folderinfo", "Orphaned"),
+            ("gone/d9", "Orphaned"), ("parent/.folderinfo", "MissingFolder")]
+        # The empty folder has no .folderinfo, and that's fine
+        assert verifier.counts["OK"] == 5
+
+    def test_compressed_object_is_compared_by_its_stored_size(self):
+        verifier = self.make_verifier()
+        key = f"{self.userprefix}/full/d5"
+        verifier.clients.bucket.put_object(Bucket="bucket", Key=key, Body=b"", Metadata={"codec": "gzip", "size": "30"})
+        s3object = {"Key": key, "Size": 10, "LastModified": T0}
+        version_index = VersionIndex(verifier.clients, UserKeyHelper(self.user, "s3://bucket/prefix"))
+        version_index.entries = {}
+        assert not verifier.is_stale("full", document("d5", size=30), s3object, version_index, "bucket")
+        assert verifier.is_stale("full", document("d5", size=31), s3object, version_index, "bucket")
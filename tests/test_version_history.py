@@ -0,0 +1,94 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from tests.helpers import FakeClients
+from workdocs_dr.backup_options import BackupOptions
+from workdocs_dr.user import UserHelper, UserKeyHelper
+from workdocs_dr.version_index import VersionIndex
+from workdocs_dr.workdocs_bucket_sync import WorkDocs2BucketSync
+
+NOW = datetime(2022, 6, 1, tzinfo=timezone.utc)
+
+
+class FakeDocs:
+    def __init__(self, versions) -> None:
+        self.versions = versions
+        self.calls = []
+
+    def describe_document_versions(self, DocumentId, Fields, Marker=None, Limit=None):
+        self.calls.append(Marker)
+        page = int(Marker or 0)
+        response = {"DocumentVersions": self.versions[page * 2:page * 2 + 2]}
+        if page * 2 + 2 < len(self.versions):
+            response["Marker"] = str(page + 1)
+        return response
+
+
+class UploadRecordingSync(WorkDocs2BucketSync):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.uploaded = []
+
+    def upload_version(self, document_id, version_id, key, version_metadata=None):
+        if version_id in getattr(self, "failing", []):
+            raise ConnectionError("Connection reset")
+        self.uploaded.append((version_id, key))
+        return version_metadata, {}, None
+
+
+def make_syncer(versions):
+    clients = FakeClients(docs=FakeDocs(versions))
+    user = UserHelper({"OrganizationId": "d-123", "Username": "someone",
+                       "RootFolderId": "root", "ModifiedTimestamp": NOW})
+    userkeys = UserKeyHelper(user, "s3://bucket/prefix")
+    version_index = VersionIndex(clients, userkeys)
+    return UploadRecordingSync(clients, user, userkeys, version_index, BackupOptions(version_history=True))
+
+
+def version(version_id):
+    return {"Id": version_id, "Size": 10, "Source": {"ORIGINAL": f"https://example.com/{version_id}"}}
+
+
+class TestVersionHistory:
+    def test_only_missing_versions_are_fetched(self):
+        syncer = make_syncer([version(f"v{i}") for i in range(5)])
+        syncer.version_index.record_history("doc", ["v0", "v1"])
+        result = syncer.copy_versions_to_bucket("doc", "v4")
+        assert sorted(v for v, _ in syncer.uploaded) == ["v2", "v3"]
+        assert ("v2", "prefix/d-123/someone/.versions/doc/v2") in syncer.uploaded
+        assert result == {"Versions": 2, "Bytes": 20}
+        assert syncer.version_index.get_history("doc") == ["v0", "v1", "v2", "v3"]
+        assert syncer.clients.docs.calls == [None, "1", "2"]
+
+    def test_versions_copied_before_a_failure_are_recorded(self):
+        syncer = make_syncer([version(f"v{i}") for i in range(4)])
+        syncer.version_workers = 1
+        syncer.failing = ["v1"]
+        syncer.version_index.record_history("doc", [])
+        with pytest.raises(ConnectionError):
+            syncer.copy_versions_to_bucket("doc", "v3")
+        assert syncer.version_index.get_history("doc") == ["v0", "v2"]
+        syncer.failing = []
+        syncer.uploaded = []
+        syncer.copy_versions_to_bucket("doc", "v3")
+        assert [v for v, _ in syncer.uploaded] == ["v1"]
+
+    def test_untracked_documents_take_stored_versions_from_bucket(self):
+        syncer = make_syncer([version("v0"), version("v1"), version("v2")])
+        syncer.clients.bucket.list_objects_v2 = lambda **request: {
+            "Contents": [{"Key": f"{request['Prefix']}v0"}], "IsTruncated": False}
+        syncer.copy_versions_to_bucket("doc", "v2")
+        assert [v for v, _ in syncer.uploaded] == ["v1"]
+        syncer.version_index.save()
+        reloaded = VersionIndex(syncer.clients, syncer.userkeys)
+        assert reloaded.get_history("doc") == ["v0", "v1"]
+
+    def test_only_changed_or_untracked_documents_are_planned(self):
+        syncer = make_syncer([])
+        syncer.version_index.record_history("same", ["v0"])
+        syncer.version_index.record_history("changed", ["v0"])
+        wds = {id: {"Id": id, "LatestVersionMetadata": {"Id": "v1", "ModifiedTimestamp": NOW}}
+               for id in ["same", "changed", "new"]}
+        records = syncer.plan_history(wds, ["changed"])
+        assert sorted(r["Args"]["document_id"] for r in records) == ["changed", "new"]
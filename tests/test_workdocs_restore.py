@@ -0,0 +1,127 @@
+import hashlib
+import queue
+from itertools import count
+
+from tests.helpers import FakeClients
+from workdocs_dr.checksums import CHECKSUM_METADATA_KEY
+from workdocs_dr.document import DocumentHelper
+from workdocs_dr.workdocs_restore import AdaptiveConcurrency, RunWorkDocsUploads, WorkDocsFolders
+
+
+class FakeWorkDocs:
+    """Just enough of the WorkDocs API to restore into"""
+
+    def __init__(self) -> None:
+        self.ids = count()
+        self.folders = {"root": {"Name": "root", "ParentFolderId": None}}
+        self.documents = {}
+        self.uploads = {}
+
+    def describe_folder_contents(self, FolderId, Type="ALL", Marker=None, Limit=None):
+        return {
+            "Folders": [{"Id": i, "Name": f["Name"], "ResourceState": "ACTIVE"}
+                        for i, f in self.folders.items() if f["ParentFolderId"] == FolderId],
+            "Documents": [{**d, "ResourceState": "ACTIVE"} for d in self.documents.values()
+                          if d["ParentFolderId"] == FolderId and d["LatestVersionMetadata"]["Status"] == "ACTIVE"],
+        }
+
+    def create_folder(self, Name, ParentFolderId):
+        folder_id = f"folder{next(self.ids)}"
+        self.folders[folder_id] = {"Name": Name, "ParentFolderId": ParentFolderId}
+        return {"Metadata": {"Id": folder_id}}
+
+    def initiate_document_version_upload(self, ParentFolderId, Name, DocumentSizeInBytes, Id=None, **kwargs):
+        document_id = Id or f"doc{next(self.ids)}"
+        version_id = f"version{next(self.ids)}"
+        self.uploads[version_id] = (document_id, ParentFolderId, Name)
+        return {"Metadata": {"Id": document_id, "LatestVersionMetadata": {"Id": version_id}},
+                "UploadMetadata": {"UploadUrl": f"https://upload/{version_id}", "SignedHeaders": {}}}
+
+    def update_document_version(self, DocumentId, VersionId, VersionStatus):
+        _, parent_id, name = self.uploads[VersionId]
+        content = self.uploads[f"https://upload/{VersionId}"]
+        self.documents[DocumentId] = {"Id": DocumentId, "ParentFolderId": parent_id, "Content": content,
+                                      "LatestVersionMetadata": {"Id": VersionId, "Name": name, "Size": len(content),
+                                                                "Status": VersionStatus}}
+
+
+class DocumentBucket:
+    def __init__(self, objects) -> None:
+        self.objects = objects
+        self.checksums = True
+
+    def head_object(self, Bucket, Key):
+        name, body = self.objects[Key]
+        metadata = {"Name": name, "Size": len(body), "Id": Key, "ContentType": "text/plain"}
+        s3metadata = DocumentHelper.metadata_dict2s3(metadata)
+        if self.checksums:
+            s3metadata[CHECKSUM_METADATA_KEY] = hashlib.sha256(body).hexdigest()
+        return {"Metadata": s3metadata}
+
+    def get_object(self, Bucket, Key):
+        body = self.objects[Key][1]
+        return {"Metadata": self.head_object(Bucket, Key)["Metadata"],
+                "Body": type("Body", (), {"iter_chunks": lambda self, size: [body]})()}
+
+
+def make_clients(objects):
+    return FakeClients(DocumentBucket(objects), FakeWorkDocs())
+
+
+class FakeUploads(RunWorkDocsUploads):
+    def put_content(self, url, headers, content):
+        self.clients.docs.uploads[url] = content.read()
+
+    def content_sha256(self, document_id, version_id):
+        return hashlib.sha256(self.clients.docs.documents[document_id]["Content"]).hexdigest()
+
+
+class TestWorkDocsRestore:
+
+    def restore(self, clients, keys):
+        folders = WorkDocsFolders(clients)
+        target = folders.ensure_folder("root", "Projects")
+        upload_queue = queue.Queue()
+        uploader = FakeUploads(upload_queue, clients, folders)
+        uploader.start_uploading()
+        for key in keys:
+            upload_queue.put({"S3Object": {"Key": key}, "Bucket": "bucket", "ParentFolderId": target})
+        uploader.finish_uploading()
+        return sorted(r["Status"] for r in uploader.results)
+
+    def test_restore_and_resume(self):
+        clients = make_clients({"a": ("notes.txt", b"some notes"), "b": ("plan.txt", b"the plan")})
+        assert self.restore(clients, ["a", "b"]) == ["OK", "OK"]
+        assert sorted(d["Content"] for d in clients.docs.documents.values()) == [b"some notes", b"the plan"]
+        # A rerun finds the folder and the documents already there
+        assert self.restore(clients, ["a", "b"]) == ["Skipped", "Skipped"]
+        assert len(clients.docs.folders) == 2
+        # A changed document becomes a new version of the existing one
+        clients.bucket.objects["b"] = ("plan.txt", b"the revised plan")
+        assert self.restore(clients, ["a", "b"]) == ["OK", "Skipped"]
+        assert len(clients.docs.documents) == 2
+        assert b"the revised plan" in [d["Content"] for d in clients.docs.documents.values()]
+
+    def test_resume_compares_content_not_just_size(self):
+        clients = make_clients({"a": ("notes.txt", b"some notes")})
+        assert self.restore(clients, ["a"]) == ["OK"]
+        clients.bucket.objects["a"] = ("notes.txt", b"more notes")
+        assert self.restore(clients, ["a"]) == ["OK"]
+        assert [d["Content"] for d in clients.docs.documents.values()] == [b"more notes"]
+        # Without a checksum or signature to compare, the document is uploaded again
+        clients.bucket.checksums = False
+        assert self.restore(clients, ["a"]) == ["OK"]
+
+    def test_concurrency_backs_off_when_throttled(self):
+        concurrency = AdaptiveConcurrency(initial=8, maximum=8)
+        throttled = type("Throttled", (Exception,), {"response": {"Error": {"Code": "ThrottlingException"}}})
+        try:
+            with concurrency.slot():
+                raise throttled()
+        except throttled:
+            pass
+        assert concurrency.limit == 4
+        for _ in range(4):
+            with concurrency.slot():
+                pass
+        assert concurrency.limit == 5
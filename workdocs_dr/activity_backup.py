@@ -5,11 +5,12 @@ from datetime import datetime
 import queue
 
 from workdocs_dr.aws_clients import AwsClients
+from workdocs_dr.backup_options import BackupOptions
 from workdocs_dr.directory_minder import DirectoryBackupMinder
 from workdocs_dr.listings import WdDirectory, WdItemApexOwner
 from workdocs_dr.queue_backup import RunSyncTasks
 from workdocs_dr.user import UserHelper, UserKeyHelper
-from workdocs_dr.workdocs_bucket_sync import WorkDocs2BucketSync
+from workdocs_dr.workdocs_bucket_sync import SyncAction, WorkDocs2BucketSync
 
 
 class ActivityBackupRunner():
@@ -18,81 +19,72 @@ class ActivityBackupRunner():
     in the time interval of the activities
     """
 
-    def __init__(self, clients: AwsClients, organization_id: str, bucket_url: str, directory: WdDirectory, minder: DirectoryBackupMinder) -> None:
+    def __init__(self, clients: AwsClients, organization_id: str, bucket_url: str, directory: WdDirectory,
+                 minder: DirectoryBackupMinder, options: BackupOptions = None) -> None:
         self.clients = clients
         self.organization_id = organization_id
         self.bucket_url = bucket_url
         self.minder = minder
         self.directory = directory
+        self.options = options or BackupOptions()
+        self.stats = {}
 
-    def backup_activity_queue(self):
+    def backup_activity_queue(self, activities: list = None):
+        """Syncs `activities`, or the activities since the minder's cutoff if None"""
+        if activities is None:
+            activities = list(self.directory.generate_activities(self.minder.get_activities_cutoff()))
         activity_start_time = self.minder.get_activities_cutoff()
-        action_queue = queue.Queue()
+        action_queue = self.options.action_queue()
         actitity_tasks = ActivityTasks(self.clients, self.organization_id,
-                                       self.bucket_url, self.directory, activity_start_time)
-        actitity_tasks.fill_queue(action_queue)
-        run_st = RunSyncTasks(task_queue=action_queue)
+                                       self.bucket_url, self.directory, activity_start_time, self.options)
+        run_st = RunSyncTasks(task_queue=action_queue, retry_queue=self.minder.get_retry_queue())
+        # Start syncing before filling, as the action queue may be bounded
         run_st.start_syncing()
+        actitity_tasks.fill_queue(action_queue, activities)
         action_queue.put(None)
         run_st.finish_syncing()
+        actitity_tasks.save_version_indexes()
         results = run_st.results
+        self.stats = dict(run_st.stats, Activities=len(activities))
         return results
 
 
 class ActivityTasks():
-    def __init__(self, clients: AwsClients, organization_id: str, bucket_url: str, directory: WdDirectory, activity_start_time: datetime) -> None:
+    def __init__(self, clients: AwsClients, organization_id: str, bucket_url: str, directory: WdDirectory,
+                 activity_start_time: datetime, options: BackupOptions = None) -> None:
         self.clients = clients
+        self.options = options
         self.organization_id = organization_id
         self.bucket_url = bucket_url
         self.directory = directory
         self.activity_start_time = activity_start_time
         self.apex_syncer = None
+        self.user_syncers = {}
 
     def get_apex_syncer(self):
         if self.apex_syncer is None:
             users = list(self.directory.generate_users(include_all=True))
             user_helpers = {u["Id"]: UserHelper(u) for u in users}
             user_keyhelpers = {uid: UserKeyHelper(uh, self.bucket_url) for uid, uh in user_helpers.items()}
-            user_syncers = {u["Id"]: WorkDocs2BucketSync(
-                self.clients, user_helpers[u["Id"]], user_keyhelpers[u["Id"]]) for u in users}
-            self.apex_syncer = WdItemApexOwner(self.clients, users, user_syncers)
+            self.user_syncers = {u["Id"]: WorkDocs2BucketSync(
+                self.clients, user_helpers[u["Id"]], user_keyhelpers[u["Id"]], options=self.options) for u in users}
+            self.apex_syncer = WdItemApexOwner(self.clients, users, self.user_syncers)
         return self.apex_syncer
 
-    def get_consolidated_updates(self):
-        activities = list(self.directory.generate_activities(self.activity_start_time))
-        doc_finalevents = dict()  # Keyed by documentid, value is final event
-        doc_moves = defaultdict(list)  # Keyed by documentid, value is list of move events
-        folder_finalevents = dict()  # Keyed by folderid, value is final event
-        folder_moves = defaultdict(list)  # Keyed by folderid, value is list of move events
-        for a in activities:
-            move_map = folder_moves if a["Type"].startswith("FOLDER_") else doc_moves
-            item_map = folder_finalevents if a["Type"].startswith("FOLDER_") else doc_finalevents
-            item_id = a["ResourceMetadata"]["Id"]
-            if a["Type"].endswith("_MOVED"):
-                move_map[item_id].append(a)
-
-            if item_id in item_map:
-                if a["TimeStamp"] >= item_map[item_id]["TimeStamp"]:
-                    item_map = a
-                continue
-            item_map[item_id] = a
-
-        # update folder descriptions
-        folder_updates = [{"folder_id": k, "user": a["ResourceMetadata"]["Owner"]["Id"], "activity_type": a["Type"], }
-                          for k, a in folder_finalevents.items()]
+    def save_version_indexes(self):
+        for syncer in self.user_syncers.values():
+            syncer.version_index.save()
 
-        # Patch old folders into document activities
-        for doc_id, moves in doc_moves.items():
-            old_folders = [a["OriginalParent"]["Id"] for a in moves]
-            doc_finalevents[doc_id]["OldFolderIds"] = old_folders
+    def refresh_caches(self):
+        """Drops the cached users and owner lookups (saving version indexes first), e.g. to pick up new users"""
+        self.save_version_indexes()
+        self.apex_syncer = None
+        self.user_syncers = {}
 
-        doc_updates = [{
-            "document_id": k,
-            "user": a["ResourceMetadata"]["Owner"]["Id"],
-            "old_folder_ids": a.get("OldFolderIds", []),
-            "activity_type": a["Type"],
-        } for k, a in doc_finalevents.items()]
-        return {"FolderUpdates": folder_updates, "DocumentUpdates": doc_updates}
+    def get_consolidated_updates(self, activities=None):
+        if activities is None:
+            activities = self.directory.generate_activities(self.activity_start_time)
+        return consolidate_activities(activities)
 
     def create_sync_action(self, owner_guess: str, syncer_args, activity_type, folder_id=None, document_id=None):
         if document_id is None and folder_id is None:
@@ -114,16 +106,17 @@ class ActivityTasks():
             else:
                 return lambda args=syncer_args: {}
         if document_id is not None:
-            return lambda args=syncer_args: syncer.sync_document_to_bucket(**args)
+            return SyncAction(syncer, SyncAction.make_record("sync_document_to_bucket", syncer_args))
         # Seems like we have a folder
         if activity_type in ["FOLDER_DELETED", "FOLDER_RECYCLED"]:
-            return lambda fid=folder_id: syncer.remove_folder_from_bucket(fid)
-        return lambda args=syncer_args: syncer.update_folder_summary(**args)
+            return SyncAction(syncer, SyncAction.make_record("remove_folder_from_bucket", {"folder_id": folder_id}))
+        return SyncAction(syncer, SyncAction.make_record("update_folder_summary", syncer_args))
 
-    def fill_queue(self, downstream_queue: queue.Queue):
+    def fill_queue(self, downstream_queue: queue.Queue, activities=None):
+        """Queues sync actions for `activities`, or for all activities since the start time if None"""
         limit = 5000
         actions = 0
-        updates = self.get_consolidated_updates()
+        updates = self.get_consolidated_updates(activities)
         for upd in updates["DocumentUpdates"]:
             act = self.create_sync_action(
                 owner_guess=upd["user"],
@@ -143,3 +136,37 @@ class ActivityTasks():
             actions += 1
             if actions >= limit:
                 return
+
+
+def consolidate_activities(activities) -> dict:
+    """
+    Reduces activities to one update per document and folder, from its latest activity. Documents
+    also get the folders they were moved out of, so stale copies there can be removed.
+    """
+    doc_finalevents = dict()  # Keyed by documentid, value is final event
+    doc_moves = defaultdict(list)  # Keyed by documentid, value is list of move events
+    folder_finalevents = dict()  # Keyed by folderid, value is final event
+    folder_moves = defaultdict(list)  # Keyed by folderid, value is list of move events
+    for a in activities:
+        move_map = folder_moves if a["Type"].startswith("FOLDER_") else doc_moves
+        item_map = folder_finalevents if a["Type"].startswith("FOLDER_") else doc_finalevents
+        item_id = a["ResourceMetadata"]["Id"]
+        if a["Type"].endswith("_MOVED"):
+            move_map[item_id].append(a)
+        if item_id not in item_map or a["TimeStamp"] >= item_map[item_id]["TimeStamp"]:
+            item_map[item_id] = a
+
+    # update folder descriptions
+    folder_updates = [{"folder_id": k, "user": a["ResourceMetadata"]["Owner"]["Id"], "activity_type": a["Type"], }
+                      for k, a in folder_finalevents.items()]
+
+    # Patch old folders into document activities
+    old_folder_ids = {doc_id: [a["OriginalParent"]["Id"] for a in moves] for doc_id, moves in doc_moves.items()}
+
+    doc_updates = [{
+        "document_id": k,
+        "user": a["ResourceMetadata"]["Owner"]["Id"],
+        "old_folder_ids": old_folder_ids.get(k, []),
+        "activity_type": a["Type"],
+    } for k, a in doc_finalevents.items()]
+    return {"FolderUpdates": folder_updates, "DocumentUpdates": doc_updates}
@@ -0,0 +1,127 @@
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+from workdocs_dr.activity_backup import ActivityTasks
+from workdocs_dr.aws_clients import AwsClients
+from workdocs_dr.backup_options import BackupOptions
+from workdocs_dr.directory_minder import DirectoryBackupMinder
+from workdocs_dr.listings import WdDirectory
+from workdocs_dr.queue_backup import RunSyncTasks
+
+
+def activity_identity(activity) -> tuple:
+    return (activity["Type"], activity["ResourceMetadata"]["Id"], activity["TimeStamp"],
+            activity.get("Initiator", {}).get("Id"))
+
+
+class ActivityFollower:
+    """
+    Long running alternative to scheduled ACTIVITIES runs. Polls for activities every `poll_interval`
+    seconds from a cursor persisted in the bucket, and syncs touched items once they have been quiet
+    for `debounce` seconds (or waited `max_delay` seconds), so a burst of edits to a document costs one
+    sync. Users and owner lookups stay cached between polls and are refreshed every `cache_refresh`.
+
+    WorkDocs can take minutes to register an activity, so each poll looks back `lookback` before the
+    cursor and skips activities it has already seen.
+    """
+
+    poll_interval = 15
+    debounce = timedelta(seconds=15)
+    max_delay = timedelta(seconds=45)
+    lookback = timedelta(minutes=10)
+    cache_refresh = timedelta(hours=1)
+
+    def __init__(self, clients: AwsClients, organization_id: str, bucket_url: str, directory: WdDirectory,
+                 minder: DirectoryBackupMinder, options: BackupOptions = None) -> None:
+        self.clients = clients
+        self.directory = directory
+        self.minder = minder
+        self.options = options or BackupOptions()
+        self.tasks = ActivityTasks(clients, organization_id, bucket_url, directory, None, self.options)
+        self.cursor = None
+        self.newest_seen = None
+        self.seen = {}  # Identity of activities seen within the lookback window, to their timestamp
+        self.pending = {}  # Keyed by item id, value is (activities, first seen, last seen)
+        self.caches_refreshed = None
+        self.stats = {"Actions": 0, "Bytes": 0}
+
+    def get_now(self):
+        return datetime.now(tz=timezone.utc)
+
+    def poll(self, now: datetime):
+        if self.cursor is None:
+            self.cursor = self.minder.get_follow_cursor()
+            if self.cursor == datetime.min.replace(tzinfo=timezone.utc):
+                # Nothing has run before, so there's no point to catch up from
+                logging.warning("No earlier backup run, following activities from now. Run a FULL backup for the rest")
+                self.cursor = now
+                self.minder.update_follow_cursor(now)
+            self.newest_seen = self.cursor
+        for activity in self.directory.generate_activities(self.cursor - self.lookback):
+            identity = activity_identity(activity)
+            if identity in self.seen:
+                continue
+            self.seen[identity] = activity["TimeStamp"]
+            self.newest_seen = max(self.newest_seen, activity["TimeStamp"])
+            item_id = activity["ResourceMetadata"]["Id"]
+            activities, first_seen, _ = self.pending.get(item_id, ([], now, now))
+            self.pending[item_id] = (activities + [activity], first_seen, now)
+        horizon = self.newest_seen - 2 * self.lookback
+        self.seen = {k: ts for k, ts in self.seen.items() if ts >= horizon}
+
+    def take_due(self, now: datetime) -> dict:
+        """
+        Activities of items that have been quiet long enough, or waited too long, keyed by item id. They stay
+        pending until `drop_synced` drops them, so a failed sync is tried again on the next poll
+        """
+        return {item_id: activities for item_id, (activities, first_seen, last_seen) in self.pending.items()
+                if now - last_seen >= self.debounce or now - first_seen >= self.max_delay}
+
+    def drop_synced(self, due: dict):
+        """Drops synced items from those pending"""
+        for item_id in due:
+            self.pending.pop(item_id, None)
+
+    def sync(self, activities: list):
+        action_queue = self.options.action_queue()
+        retry_queue = self.minder.get_retry_queue()
+        run_st = RunSyncTasks(task_queue=action_queue, retry_queue=retry_queue)
+        run_st.start_syncing()
+        self.tasks.fill_queue(action_queue, activities)
+        action_queue.put(None)
+        run_st.finish_syncing()
+        self.tasks.save_version_indexes()
+        retry_queue.save()
+        self.stats = {k: v + run_st.stats.get(k, 0) for k, v in self.stats.items()}
+        logging.info(f"Follower synced {len(run_st.results)} actions from {len(activities)} activities")
+
+    def save_cursor(self):
+        # Never move past activities still waiting, so a restart picks them up again
+        pending_times = [a["TimeStamp"] for activities, _, _ in self.pending.values() for a in activities]
+        cursor = min(pending_times + [self.newest_seen])
+        if cursor != self.cursor:
+            self.minder.update_follow_cursor(cursor)
+            self.cursor = cursor
+
+    def run_once(self, now: datetime = None):
+        now = now or self.get_now()
+        if self.caches_refreshed is None or now - self.caches_refreshed >= self.cache_refresh:
+            self.tasks.refresh_caches()
+            self.caches_refreshed = now
+        self.poll(now)
+        due = self.take_due(now)
+        if len(due) > 0:
+            self.sync([a for activities in due.values() for a in activities])
+            self.drop_synced(due)
+        self.save_cursor()
+
+    def run_forever(self, stop: threading.Event = None):
+        stop = stop or threading.Event()
+        logging.info("Following activities")
+        while not stop.is_set():
+            try:
+                self.run_once()
+            except Exception as err:
+                logging.warning(f"Follower poll failed, will retry: {err}")
+            stop.wait(self.poll_interval)
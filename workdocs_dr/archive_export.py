@@ -0,0 +1,138 @@
+import logging
+import tarfile
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path, PurePosixPath
+from tempfile import SpooledTemporaryFile
+
+from workdocs_dr.aws_clients import AwsClients
+from workdocs_dr.codec import Decoder
+from workdocs_dr.directory_restore import DirectoryRestoreRunner
+from workdocs_dr.document import DocumentHelper
+from workdocs_dr.document_packs import generate_folder_documents, read_packed_document
+from workdocs_dr.listings import WdFilter
+from workdocs_dr.user_restore import UserRestoreInfo, UserRestoreRunner
+
+
+class TarArchiveWriter:
+    """Writes a tar stream. Works on unseekable outputs like stdout"""
+
+    def __init__(self, fileobj) -> None:
+        self.archive = tarfile.open(fileobj=fileobj, mode="w|")
+
+    def add(self, name: str, size: int, mtime: datetime, fileobj):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = mtime.timestamp()
+        self.archive.addfile(info, fileobj)
+
+    def close(self):
+        self.archive.close()
+
+
+class ZipArchiveWriter:
+    """Writes a zip stream. Documents are stored as is, as most are already compressed"""
+
+    def __init__(self, fileobj) -> None:
+        self.archive = zipfile.ZipFile(fileobj, mode="w", compression=zipfile.ZIP_STORED, allowZip64=True)
+
+    def add(self, name: str, size: int, mtime: datetime, fileobj):
+        info = zipfile.ZipInfo(name, date_time=max(mtime.timetuple()[:6], (1980, 1, 1, 0, 0, 0)))
+        with self.archive.open(info, mode="w", force_zip64=size >= zipfile.ZIP64_LIMIT) as out:
+            while True:
+                chunk = fileobj.read(1024 * 1024)
+                if not chunk:
+                    break
+                out.write(chunk)
+
+    def close(self):
+        self.archive.close()
+
+
+class ArchiveExportRunner(DirectoryRestoreRunner):
+    """
+    Streams the backup of the matching users into a single tar or zip archive instead of restoring
+    files into a directory. Objects are written in folder path order, while up to `prefetch` of the
+    following objects are downloaded concurrently ahead of the writer.
+    """
+
+    worker_count = 6
+    prefetch = 24
+    "Objects larger than this are spooled to disk while waiting to be written"
+    spool_size = 8 * 1024 * 1024
+
+    writers = {"tar": TarArchiveWriter, "zip": ZipArchiveWriter}
+
+    def __init__(self, clients: AwsClients, organization_id: str, bucket_url: str, filter: WdFilter = None,
+                 archive_format: str = "tar", fileobj=None) -> None:
+        super().__init__(clients, organization_id, bucket_url, filter)
+        if archive_format not in self.writers:
+            raise RuntimeError(f"Unknown archive format {archive_format}")
+        self.archive_format = archive_format
+        self.fileobj = fileobj
+        self.results = []
+
+    def generate_entries(self):
+        usernames = self._userlist()
+        uri = UserRestoreInfo(self.clients, self.organization_id, self.bucket_url)
+        for username in sorted(usernames):
+            uh, ukh = uri.userhelper_userkeyhelper_from_username(username)
+            basepath = Path(uh.username) if len(usernames) > 1 else Path(".")
+            restorer = UserRestoreRunner(uh, ukh, self.clients, basepath)
+            folderdefs = sorted(restorer.generate_restoredefs(self.filter), key=lambda fd: fd["Path"].as_posix())
+            for folderdef in folderdefs:
+                folder_id = folderdef["Metadata"]["Id"]
+                for s3obj in generate_folder_documents(self.clients, ukh.bucket, ukh.bucket_folderprefix(folder_id)):
+                    yield {"ArchiveDir": PurePosixPath(folderdef["Path"].as_posix()), "S3Object": s3obj,
+                           "Bucket": ukh.bucket}
+
+    def fetch(self, entry):
+        """Downloads (and decompresses) one object into a spooled temporary file"""
+        spooled = SpooledTemporaryFile(max_size=self.spool_size)
+        if "Packed" in entry["S3Object"]:
+            spooled.write(read_packed_document(self.clients, entry["Bucket"], entry["S3Object"]))
+            size = spooled.tell()
+            spooled.seek(0)
+            return DocumentHelper.document_metadata_s32dict(entry["S3Object"]["Packed"]["Metadata"]), size, spooled
+        client = self.clients.bucket_client()
+        response = client.get_object(Bucket=entry["Bucket"], Key=entry["S3Object"]["Key"])
+        metadata = DocumentHelper.document_metadata_s32dict(response["Metadata"])
+        decoder = Decoder.from_metadata(response["Metadata"])
+        for chunk in response["Body"].iter_chunks(1024 * 1024):
+            self.clients.governor.throttle_bytes(len(chunk))
+            spooled.write(decoder.decode(chunk))
+        spooled.write(decoder.finish())
+        size = spooled.tell()
+        spooled.seek(0)
+        return metadata, size, spooled
+
+    def runall(self):
+        archive = self.writers[self.archive_format](self.fileobj)
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=self.worker_count) as executor:
+            for entry in self.generate_entries():
+                in_flight.append((entry, executor.submit(self.fetch, entry)))
+                if len(in_flight) >= self.prefetch:
+                    self._write_next(archive, in_flight)
+            while len(in_flight) > 0:
+                self._write_next(archive, in_flight)
+        archive.close()
+        logging.info(f"Exported {len([r for r in self.results if r['Status'] == 'OK'])} documents")
+        return self.results
+
+    def _write_next(self, archive, in_flight):
+        entry, future = in_flight.popleft()
+        try:
+            metadata, size, spooled = future.result()
+        except Exception as err:
+            logging.warning(f"Could not export {entry['S3Object']['Key']}: {err}")
+            self.results.append({**entry, "Status": "Error", "ErrorInfo": err})
+            return
+        with spooled:
+            latest = metadata["LatestVersionMetadata"]
+            name = (entry["ArchiveDir"] / str(latest["Name"])).as_posix()
+            mtime = latest.get("ContentModifiedTimestamp", entry["S3Object"]["LastModified"])
+            archive.add(name, size, mtime, spooled)
+        self.results.append({**entry, "Status": "OK", "Name": name})
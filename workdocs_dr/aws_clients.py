@@ -1,40 +1,149 @@
-import boto3
-import botocore
+import threading
+from collections import Counter
+from time import perf_counter
 
 from workdocs_dr.boto_session import RefreshableBotoSession
+from workdocs_dr.governor import Governor
 
 
 class AwsClients:
+    """
+    Holds the sessions and clients used to talk to WorkDocs and the bucket.
+
+    Nothing is created until first use: sessions (and any role assumption) and clients are built
+    the first time `bucket_client()` or `docs_client()` is called. If both roles are the same
+    a single session is shared, and if no role is given the base session is used as is.
+    `basesession` can be a boto3 Session or a callable returning one.
+    Every request made through the clients is counted and goes through the `governor`.
+    `endpoint_urls` can point a client (by name) somewhere else, e.g. a local fake WorkDocs service.
+    Clients for worker processes are made from `worker_spec()`, which needs `basesession` to be a picklable
+    callable (like a `functools.partial`) to create the same session there.
+    """
+
+    client_specs = {
+        "bucket": {"service_name": "s3", "max_pool_connections": 50},
+        # WorkDocs throttles hard, so let botocore back off and pace retries client side
+        "workdocs": {"service_name": "workdocs", "max_pool_connections": 20,
+                     "retries": {"mode": "adaptive", "max_attempts": 10}},
+        # Queue of pushed WorkDocs notifications, which lives with the bucket
+        "notifications": {"service_name": "sqs", "role": "bucket"},
+    }
+
     def __init__(
         self,
         basesession,
         workdocs_role_arn=None,
         bucket_role_arn=None,
+        credential_cache=None,
+        governor: Governor = None,
+        endpoint_urls: dict = None,
     ) -> None:
-        self.basesession = (basesession
-                            if basesession is not None else boto3.Session())
-        # self.s3_url = bucket_url
-        # self.workdocs_client = None
+        self._basesession = basesession
+        self.basesession_factory = basesession if callable(basesession) else None
         self.role_arns = {
             "bucket": bucket_role_arn,
             "workdocs": workdocs_role_arn
         }
-        self.sessions = {}
-        self.init_sessions()
-        # self.sessions = getsessions(self.basesession, self.role_arns)
-        self.clients = {
-            "bucket": self.sessions["bucket"].client("s3", config=botocore.client.Config(max_pool_connections=50)),
-            "workdocs": self.sessions["workdocs"].client("workdocs"),
-        }
+        self.credential_cache = credential_cache
+        self.governor = governor or Governor()
+        self.endpoint_urls = endpoint_urls or {}
+        self.sessions = {}  # Keyed by role arn, so identical roles share a session
+        self.clients = {}
+        self.timings = {}
+        self.request_counts = Counter()  # Keyed by (service, operation)
+        self._lock = threading.RLock()
+
+    @property
+    def basesession(self):
+        with self._lock:
+            if self._basesession is None or callable(self._basesession):
+                start = perf_counter()
+                if self._basesession is None:
+                    import boto3
+                    self._basesession = boto3.Session()
+                else:
+                    self._basesession = self._basesession()
+                self.timings["session:base"] = perf_counter() - start
+            return self._basesession
+
+    def get_session(self, name):
+        role_arn = self.role_arns[self.client_specs.get(name, {}).get("role", name)]
+        with self._lock:
+            if role_arn not in self.sessions:
+                if role_arn is None:
+                    self.sessions[role_arn] = self.basesession
+                else:
+                    start = perf_counter()
+                    self.sessions[role_arn] = RefreshableBotoSession(
+                        base_session=self.basesession, sts_arn=role_arn,
+                        credential_cache=self.credential_cache).refreshable_session()
+                    self.timings[f"session:{name}"] = perf_counter() - start
+            return self.sessions[role_arn]
+
+    def get_client(self, name):
+        client = self.clients.get(name)
+        if client is not None:
+            return client
+        with self._lock:
+            if name not in self.clients:
+                import botocore.config
+                spec = self.client_specs[name]
+                session = self.get_session(name)
+                start = perf_counter()
+                config = botocore.config.Config(max_pool_connections=spec.get("max_pool_connections", 10),
+                                                retries=spec.get("retries", None))
+                client = session.client(spec["service_name"], config=config,
+                                        endpoint_url=self.endpoint_urls.get(name, None))
+                if hasattr(client, "meta"):
+                    client.meta.events.register("before-call", self._before_call)
+                self.clients[name] = client
+                self.timings[f"client:{name}"] = perf_counter() - start
+            return self.clients[name]
 
-    def init_sessions(self):
-        for k, v in self.role_arns.items():
-            if v is None:
-                self.sessions[k] = self.basesession
-            self.sessions[k] = RefreshableBotoSession(base_session=self.basesession, sts_arn=v).refreshable_session()
+    def _before_call(self, event_name=None, **kwargs):
+        # event_name looks like before-call.s3.PutObject
+        _, service, operation = event_name.split(".", 2)
+        self.count_request(service, operation)
+
+    def count_request(self, service, operation):
+        """Counts a request and waits for the governor. Requests outside the clients should call this too"""
+        with self._lock:
+            self.request_counts[(service, operation)] += 1
+        self.governor.throttle_request(service)
+
+    def merge_request_counts(self, counts: Counter):
+        """Adds requests counted in another process"""
+        with self._lock:
+            self.request_counts.update(counts)
+
+    def worker_spec(self, share: float = 1.0) -> dict:
+        """Picklable arguments for `from_worker_spec`, with the worker's governor taking `share` of the limits"""
+        return {"basesession": self.basesession_factory, "workdocs_role_arn": self.role_arns["workdocs"],
+                "bucket_role_arn": self.role_arns["bucket"], "credential_cache": self.credential_cache,
+                "endpoint_urls": dict(self.endpoint_urls), "governor": self.governor.worker_spec(share)}
+
+    @classmethod
+    def from_worker_spec(cls, spec: dict) -> "AwsClients":
+        return cls(**{**spec, "governor": Governor(**spec["governor"])})
+
+    def request_summary(self) -> dict:
+        """Number of API requests made so far, by service and operation"""
+        summary = {}
+        with self._lock:
+            for (service, operation), count in self.request_counts.items():
+                summary.setdefault(service, {})[operation] = count
+        return summary
 
     def bucket_client(self):
-        return self.clients["bucket"]
+        return self.get_client("bucket")
 
     def docs_client(self):
-        return self.clients["workdocs"]
+        return self.get_client("workdocs")
+
+    def notifications_client(self):
+        return self.get_client("notifications")
+
+    def startup_report(self) -> dict:
+        """Seconds spent creating each session and client so far"""
+        with self._lock:
+            return dict(self.timings)
@@ -0,0 +1,36 @@
+import queue
+
+from workdocs_dr.codec import Compression
+from workdocs_dr.queue_priority import PriorityActionQueue, SyncPriority
+
+
+class BackupOptions:
+    """
+    Tunables for a backup run, handed down from the command line to the runners and syncers.
+
+    `priority` orders sync actions (None runs them in the order they are discovered) and
+    `action_queue_size` bounds how many discovered actions are held waiting to run.
+    `compression` turns on compression of stored documents (None stores them as is).
+    `pack_threshold` packs documents smaller than this many bytes into per folder packs (None stores
+    every document as an object of its own).
+    `version_history` also backs up the earlier versions of documents.
+    `processes` above 1 backs up users in that many processes (see ProcessEngine).
+    `tree_snapshot` walks folder trees against a snapshot of the last walk, skipping subtrees without evidence
+    of change except this fraction of them (None walks everything).
+    """
+
+    def __init__(self, priority: SyncPriority = SyncPriority(), action_queue_size: int = 10_000,
+                 compression: Compression = None, pack_threshold: int = None, version_history: bool = False,
+                 processes: int = 1, tree_snapshot: float = None) -> None:
+        self.priority = priority
+        self.action_queue_size = action_queue_size
+        self.compression = compression
+        self.pack_threshold = pack_threshold
+        self.version_history = version_history
+        self.processes = processes
+        self.tree_snapshot = tree_snapshot
+
+    def action_queue(self) -> queue.Queue:
+        if self.priority is None:
+            return queue.Queue(maxsize=self.action_queue_size)
+        return PriorityActionQueue(self.priority, maxsize=self.action_queue_size)
@@ -1,10 +1,52 @@
 from uuid import uuid4
 from datetime import datetime, timezone, timedelta
-from time import time
+from hashlib import sha256
+from pathlib import Path
+from typing import TYPE_CHECKING
+import json
+import logging
+import os
 
-from boto3 import Session
-from botocore.credentials import RefreshableCredentials
-from botocore.session import get_session
+if TYPE_CHECKING:
+    from boto3 import Session
+
+
+class CredentialCache:
+    """
+    Keeps assumed role credentials on disk so that short, frequent runs can skip the STS call.
+
+    Credentials are only handed out while they have more than `min_remaining` left, which is kept
+    above botocore's refresh thresholds so refreshes always get fresh credentials from STS.
+    """
+
+    def __init__(self, cache_dir: Path, min_remaining: timedelta = timedelta(minutes=20)) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.min_remaining = min_remaining
+
+    def _path(self, *key_parts):
+        key = sha256("|".join(str(k) for k in key_parts).encode("utf-8")).hexdigest()
+        return self.cache_dir / f"{key}.json"
+
+    def get(self, *key_parts):
+        try:
+            with open(self._path(*key_parts), "r") as f:
+                credentials = json.load(f)
+            expiry = datetime.fromisoformat(credentials["expiry_time"])
+        except (OSError, ValueError, KeyError):
+            return None
+        if expiry - datetime.now(tz=timezone.utc) < self.min_remaining:
+            return None
+        return credentials
+
+    def put(self, credentials, *key_parts):
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True, mode=0o700)
+            path = self._path(*key_parts)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(credentials, f)
+        except OSError as err:
+            logging.debug(f"Could not cache credentials: {err}")
 
 
 class RefreshableBotoSession:
@@ -20,12 +62,13 @@ class RefreshableBotoSession:
 
     def __init__(
         self,
-        base_session: Session = None,
+        base_session: "Session" = None,
         region_name: str = None,
         profile_name: str = None,
         sts_arn: str = None,
         session_name: str = None,
-        session_ttl: int = 3000
+        session_ttl: int = 3000,
+        credential_cache: CredentialCache = None,
     ):
         """
         Initialize `RefreshableBotoSession`
@@ -47,6 +90,9 @@ class RefreshableBotoSession:
         session_ttl : int (optional)
             An integer number to set the TTL for each session. Beyond this session, it will renew the token.
             50 minutes by default which is before the default role expiration of 1 hour
+
+        credential_cache : CredentialCache (optional)
+            Cache to reuse unexpired assumed role credentials from earlier runs.
         """
 
         self.base_session = base_session
@@ -55,11 +101,19 @@ class RefreshableBotoSession:
         self.sts_arn = sts_arn
         self.session_name = session_name or uuid4().hex
         self.session_ttl = session_ttl
+        self.credential_cache = credential_cache
 
     def __get_session_credentials(self):
         """
         Get session credentials
         """
+        if self.sts_arn and self.credential_cache is not None:
+            cache_key = (self.sts_arn, self.profile_name or getattr(self.base_session, "profile_name", None))
+            credentials = self.credential_cache.get(*cache_key)
+            if credentials is not None:
+                return credentials
+        if self.base_session is None:
+            from boto3 import Session
         session = self.base_session or Session(region_name=self.region_name, profile_name=self.profile_name)
 
         # if sts_arn is given, get credential by assuming given role
@@ -77,6 +131,8 @@ class RefreshableBotoSession:
                 "token": response.get("SessionToken"),
                 "expiry_time": response.get("Expiration").isoformat(),
             }
+            if self.credential_cache is not None:
+                self.credential_cache.put(credentials, *cache_key)
         else:
             session_credentials = session.get_credentials().__dict__
             credentials = {
@@ -88,10 +144,14 @@ class RefreshableBotoSession:
 
         return credentials
 
-    def refreshable_session(self) -> Session:
+    def refreshable_session(self) -> "Session":
         """
         Get refreshable boto3 session.
         """
+        from boto3 import Session
+        from botocore.credentials import RefreshableCredentials
+        from botocore.session import get_session
+
         # get refreshable credentials
         refreshable_credentials = RefreshableCredentials.create_from_metadata(
             metadata=self.__get_session_credentials(),
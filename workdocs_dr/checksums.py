@@ -0,0 +1,35 @@
+import base64
+import hashlib
+
+# S3 metadata key holding the hex SHA-256 of the original (uncompressed) document content
+CHECKSUM_METADATA_KEY = "sha256"
+
+
+class ChecksumMismatch(RuntimeError):
+    pass
+
+
+def s3_checksum(body: bytes) -> str:
+    """Value for the ChecksumSHA256 parameter of S3 requests, so S3 verifies what it stores"""
+    return base64.b64encode(hashlib.sha256(body).digest()).decode("ascii")
+
+
+class ChecksumWriter:
+    """File-like object that hashes what is written to it on its way to `fileobj`"""
+
+    def __init__(self, fileobj) -> None:
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.fileobj.write(data)
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+    def verify(self, s3metadata: dict):
+        """Raises ChecksumMismatch if the object metadata has a checksum and it doesn't match"""
+        expected = s3metadata.get(CHECKSUM_METADATA_KEY, None)
+        if expected is not None and expected != self.hexdigest():
+            raise ChecksumMismatch(f"Checksum {self.hexdigest()} doesn't match stored checksum {expected}")
@@ -1,16 +1,24 @@
+import inspect
 import logging
 import sys
+from argparse import ArgumentTypeError
+from functools import partial
 from os import environ
-
-import boto3
+from pathlib import Path
 
 from workdocs_dr.aws_clients import AwsClients
+from workdocs_dr.backup_options import BackupOptions
+from workdocs_dr.boto_session import CredentialCache
+from workdocs_dr.codec import Compression
 from workdocs_dr.directory_minder import RunStyle
+from workdocs_dr.governor import Governor
 from workdocs_dr.listings import WdFilter
+from workdocs_dr.queue_priority import SyncPriority
 
 
-def wdfilter_from_input(userquery, foldersexpr) -> WdFilter:
-    folders = [f.strip() for f in foldersexpr.split(" ")] if foldersexpr is not None else []
+def wdfilter_from_input(userquery, foldernames) -> WdFilter:
+    # Each path is its own argument (nargs="+"), as folder names can have spaces in them
+    folders = [f.strip() for f in foldernames or [] if len(f.strip()) > 0]
     return WdFilter(userquery=userquery, foldernames=folders)
 
 
@@ -26,6 +34,80 @@ def run_style_from_input(run_style=None) -> RunStyle:
     return all_styles.get(normalize_str(intended_style), None)
 
 
+def reconcile_slices_from_input(reconcile_slices=None) -> int:
+    """Number of slices for rolling reconciliation from --reconcile-slices or RECONCILE_SLICES. Off by default"""
+    reconcile_slices = reconcile_slices or environ.get("RECONCILE_SLICES", None)
+    return int(reconcile_slices) if reconcile_slices else None
+
+
+def sync_priority_from_input(priority_expr=None) -> SyncPriority:
+    """
+    Parses weights like "recency=1,size=0.5". "fifo" turns prioritization off and returns None.
+    Raises ArgumentTypeError for weights SyncPriority doesn't have or values that aren't numbers
+    """
+    expr = priority_expr or environ.get("SYNC_PRIORITY", None)
+    if expr is None:
+        return SyncPriority()
+    if expr.strip().lower() == "fifo":
+        return None
+    known = [p[:-len("_weight")] for p in inspect.signature(SyncPriority.__init__).parameters if p.endswith("_weight")]
+    weights = {}
+    for part in expr.split(","):
+        name, _, value = part.partition("=")
+        name = name.strip().lower()
+        if name not in known:
+            raise ArgumentTypeError(f"Unknown priority weight \"{name}\" in \"{expr}\". Weights are {', '.join(known)}")
+        try:
+            weights[f"{name}_weight"] = float(value)
+        except ValueError:
+            raise ArgumentTypeError(f"Priority weight {name} must be a number, not \"{value.strip()}\"")
+    return SyncPriority(**weights)
+
+
+def compression_from_input(codec=None) -> Compression:
+    """Compression of stored documents from --compress or COMPRESSION ("auto", "zstd" or "gzip"). Off by default"""
+    codec = codec or environ.get("COMPRESSION", None)
+    return Compression(codec.strip().lower()) if codec else None
+
+
+def pack_threshold_from_input(pack_threshold=None) -> int:
+    """Size below which documents are packed, from --pack-small-documents or PACK_SMALL_DOCUMENTS. Off by default"""
+    pack_threshold = pack_threshold or environ.get("PACK_SMALL_DOCUMENTS", None)
+    return int(pack_threshold) if pack_threshold else None
+
+
+def version_history_from_input(version_history=False) -> bool:
+    """Whether earlier versions are backed up too, from --version-history or VERSION_HISTORY"""
+    return version_history or environ.get("VERSION_HISTORY", "").strip().lower() in ["1", "true", "yes"]
+
+
+def processes_from_input(processes=None) -> int:
+    """Number of processes backing up users, from --processes or PROCESSES. "auto" is one per CPU"""
+    processes = processes or environ.get("PROCESSES", None)
+    if processes is None:
+        return 1
+    if str(processes).strip().lower() == "auto":
+        from os import cpu_count
+        return cpu_count() or 1
+    return max(1, int(processes))
+
+
+def tree_snapshot_from_input(tree_snapshot=None) -> float:
+    """Fraction of unchanged subtrees walked anyway, from --tree-snapshot or TREE_SNAPSHOT. Off by default"""
+    tree_snapshot = tree_snapshot or environ.get("TREE_SNAPSHOT", None)
+    return float(tree_snapshot) if tree_snapshot else None
+
+
+def backup_options_from_input(priority_expr=None, compression=None, pack_threshold=None,
+                              version_history=False, processes=None, tree_snapshot=None) -> BackupOptions:
+    return BackupOptions(priority=sync_priority_from_input(priority_expr),
+                         compression=compression_from_input(compression),
+                         pack_threshold=pack_threshold_from_input(pack_threshold),
+                         version_history=version_history_from_input(version_history),
+                         processes=processes_from_input(processes),
+                         tree_snapshot=tree_snapshot_from_input(tree_snapshot))
+
+
 def bucket_url_from_input(bucket_name=None, prefix=None) -> str:
     if bucket_name is None and environ.get("BUCKET_URL") is not None:
         return environ.get("BUCKET_URL")
@@ -34,14 +116,49 @@ def bucket_url_from_input(bucket_name=None, prefix=None) -> str:
     return f"s3://{bucket_name}"
 
 
-def clients_from_input(profile_name=None, region_name=None, workdocs_role_arn=None, bucket_role_arn=None) -> AwsClients:
-    session = basesession_from_input(profile_name, region_name)
+def clients_from_input(profile_name=None, region_name=None, workdocs_role_arn=None, bucket_role_arn=None,
+                       governor: Governor = None) -> AwsClients:
     wd_role = workdocs_role_arn or environ.get("WORKDOCS_ROLE_ARN")
     s3_role = bucket_role_arn or environ.get("BUCKET_ROLE_ARN")
-    return AwsClients(session, wd_role, s3_role)
+    # Session is created on first use, so runs that never reach AWS don't pay for it. A partial, unlike a
+    # lambda, can be handed to worker processes
+    return AwsClients(partial(basesession_from_input, profile_name, region_name), wd_role, s3_role,
+                      credential_cache=credential_cache_from_input(), governor=governor or governor_from_input(),
+                      endpoint_urls=endpoint_urls_from_input())
+
+
+def endpoint_urls_from_input() -> dict:
+    """Endpoint overrides from WORKDOCS_ENDPOINT_URL and BUCKET_ENDPOINT_URL, e.g. for local fakes"""
+    urls = {"workdocs": environ.get("WORKDOCS_ENDPOINT_URL", None), "bucket": environ.get("BUCKET_ENDPOINT_URL", None)}
+    return {k: v for k, v in urls.items() if v}
+
+
+def governor_from_input(max_bytes_per_second=None, max_requests_per_second=None, limits_file=None) -> Governor:
+    """
+    Limits from arguments or MAX_BYTES_PER_SECOND, MAX_REQUESTS_PER_SECOND and GOVERNOR_FILE. Request
+    limits are a single number for every service or per service, like "s3=100,workdocs=20"
+    """
+    max_bytes = max_bytes_per_second or environ.get("MAX_BYTES_PER_SECOND", None)
+    requests_expr = max_requests_per_second or environ.get("MAX_REQUESTS_PER_SECOND", None)
+    requests_per_second = {}
+    if requests_expr:
+        for part in str(requests_expr).split(","):
+            service, _, value = part.rpartition("=")
+            requests_per_second[service.strip() or "*"] = float(value)
+    return Governor(bytes_per_second=float(max_bytes) if max_bytes else None,
+                    requests_per_second=requests_per_second,
+                    limits_file=limits_file or environ.get("GOVERNOR_FILE", None))
+
+
+def credential_cache_from_input(cache_dir=None) -> CredentialCache:
+    """Credential cache directory from CREDENTIAL_CACHE_DIR. Set it to an empty string to disable caching"""
+    cache_dir = cache_dir if cache_dir is not None else environ.get(
+        "CREDENTIAL_CACHE_DIR", str(Path.home() / ".cache" / "workdocs-dr"))
+    return CredentialCache(Path(cache_dir)) if cache_dir else None
 
 
 def basesession_from_input(profile_name=None, region_name=None):
+    import boto3
     profile = profile_name or environ.get("AWS_PROFILE")
     if profile is not None:
         return boto3.Session(profile_name=profile)
@@ -51,10 +168,63 @@ def basesession_from_input(profile_name=None, region_name=None):
     return boto3.session.Session()
 
 
-def logging_setup(rootlogger, verbose: bool):
+def profiling_from_input(profile_output=None):
+    """Turns on stage profiling if an output prefix is given as argument or in PROFILE_OUTPUT"""
+    from workdocs_dr.profiling import profiler
+    output_prefix = profile_output or environ.get("PROFILE_OUTPUT", None)
+    if output_prefix:
+        profiler.enable(output_prefix)
+    return profiler
+
+
+def add_profiling_arguments(parser):
+    parser.add_argument("--profile-output",
+                        help="Profile stages and write <prefix>.collapsed and <prefix>.stages.json", default=None)
+
+
+def notifications_from_input(clients: AwsClients, queue_url=None, public_url=None, port=None, certfile=None,
+                             keyfile=None):
+    """
+    Source of pushed WorkDocs notifications: an SQS queue from --notification-queue-url or
+    NOTIFICATION_QUEUE_URL, or a local endpoint reached at --notification-url or NOTIFICATION_URL.
+    None (polling activities) if neither is given
+    """
+    from workdocs_dr.notification_ingest import HttpsNotificationSource, SqsNotificationSource
+    queue_url = queue_url or environ.get("NOTIFICATION_QUEUE_URL", None)
+    if queue_url:
+        return SqsNotificationSource(clients, queue_url)
+    public_url = public_url or environ.get("NOTIFICATION_URL", None)
+    if public_url:
+        return HttpsNotificationSource(public_url, int(port or environ.get("NOTIFICATION_PORT", 8443)),
+                                       certfile or environ.get("NOTIFICATION_CERT_FILE", None),
+                                       keyfile or environ.get("NOTIFICATION_KEY_FILE", None))
+    return None
+
+
+def add_notification_arguments(parser):
+    parser.add_argument("--notification-queue-url", help="SQS queue to receive WorkDocs notifications from",
+                        default=None)
+    parser.add_argument("--notification-url", help="Public HTTPS URL of the local notification endpoint",
+                        default=None)
+    parser.add_argument("--notification-port", help="Port of the local notification endpoint (default 8443)",
+                        default=None)
+    parser.add_argument("--notification-cert", help="Certificate file for the local endpoint to serve TLS itself",
+                        default=None)
+    parser.add_argument("--notification-key", help="Private key file for --notification-cert", default=None)
+
+
+def add_governor_arguments(parser):
+    parser.add_argument("--max-bytes-per-second", help="Limit on transfer bytes per second", default=None)
+    parser.add_argument("--max-requests-per-second",
+                        help='Limit on requests per second, for all services or e.g. "s3=100,workdocs=20"',
+                        default=None)
+    parser.add_argument("--governor-file", help="JSON file with limits, re-read when it changes", default=None)
+
+
+def logging_setup(rootlogger, verbose: bool, stream=None):
     isverbose = verbose or "VERBOSE" in environ
     loglevel = logging.INFO if isverbose else logging.WARN
-    handler = logging.StreamHandler(sys.stdout)
+    handler = logging.StreamHandler(stream or sys.stdout)
     handler.setLevel(loglevel)
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     handler.setFormatter(formatter)
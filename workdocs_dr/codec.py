@@ -0,0 +1,128 @@
+import zlib
+
+# S3 metadata key recording how a stored object was compressed
+CODEC_METADATA_KEY = "codec"
+
+COMPRESSIBLE_CONTENT_TYPES = [
+    "text/",
+    "application/json",
+    "application/xml",
+    "application/csv",
+    "application/rtf",
+    "application/pdf",
+    "application/msword",
+    "application/vnd.ms-excel",
+    "application/vnd.ms-powerpoint",
+    "application/vnd.openxmlformats-officedocument",
+    "image/svg+xml",
+]
+
+
+def zstd_available() -> bool:
+    try:
+        import zstandard  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class Compression:
+    """
+    Opt-in compression of stored documents. `codec` is "zstd", "gzip" or "auto" (zstd when the
+    zstandard package is installed, gzip otherwise). Only content types that usually compress are
+    considered, and only if a quick test compression of the start of the document saves at least
+    `min_saving`, so already compressed content (e.g. image-heavy PDFs) is stored as is.
+    """
+
+    sample_size = 64 * 1024
+
+    def __init__(self, codec: str = "auto", min_saving: float = 0.1) -> None:
+        if codec == "auto":
+            codec = "zstd" if zstd_available() else "gzip"
+        if codec not in ("zstd", "gzip"):
+            raise RuntimeError(f"Unknown compression codec {codec}")
+        if codec == "zstd" and not zstd_available():
+            raise RuntimeError("zstd compression needs the zstandard package")
+        self.codec = codec
+        self.min_saving = min_saving
+
+    def choose_codec(self, content_type: str, sample: bytes):
+        """Codec to store a document with, or None to store it as is"""
+        if not any((content_type or "").startswith(t) for t in COMPRESSIBLE_CONTENT_TYPES):
+            return None
+        sample = sample[:self.sample_size]
+        if len(sample) == 0:
+            return None
+        return self.codec if len(zlib.compress(sample, 1)) <= (1 - self.min_saving) * len(sample) else None
+
+
+class Encoder:
+    """Incrementally compresses a stream of chunks. A codec of None passes chunks through"""
+
+    def __init__(self, codec=None) -> None:
+        self.codec = codec
+        if codec == "zstd":
+            import zstandard
+            self._obj = zstandard.ZstdCompressor(level=3).compressobj()
+        elif codec == "gzip":
+            self._obj = zlib.compressobj(6, zlib.DEFLATED, 31)
+        else:
+            self._obj = None
+
+    def encode(self, chunk: bytes) -> bytes:
+        return self._obj.compress(chunk) if self._obj is not None else chunk
+
+    def finish(self) -> bytes:
+        return self._obj.flush() if self._obj is not None else b""
+
+
+class Decoder:
+    """Incrementally decompresses a stream of chunks. A codec of None passes chunks through"""
+
+    def __init__(self, codec=None) -> None:
+        self.codec = codec
+        if codec == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise RuntimeError("Restoring zstd compressed documents needs the zstandard package")
+            self._obj = zstandard.ZstdDecompressor().decompressobj()
+        elif codec == "gzip":
+            self._obj = zlib.decompressobj(31)
+        elif codec is None:
+            self._obj = None
+        else:
+            raise RuntimeError(f"Unknown compression codec {codec}")
+
+    @staticmethod
+    def from_metadata(s3metadata: dict):
+        return Decoder(s3metadata.get(CODEC_METADATA_KEY, None))
+
+    def decode(self, chunk: bytes) -> bytes:
+        return self._obj.decompress(chunk) if self._obj is not None else chunk
+
+    def finish(self) -> bytes:
+        flush = getattr(self._obj, "flush", None)
+        return flush() if flush is not None else b""
+
+
+class DecodingWriter:
+    """File-like object that decompresses what is written to it into `fileobj`"""
+
+    def __init__(self, fileobj, decoder: Decoder) -> None:
+        self.fileobj = fileobj
+        self.decoder = decoder
+
+    def write(self, data):
+        self.fileobj.write(self.decoder.decode(data))
+        return len(data)
+
+    def close(self):
+        self.fileobj.write(self.decoder.finish())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
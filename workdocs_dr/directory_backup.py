@@ -1,15 +1,24 @@
 from datetime import datetime, timedelta, timezone
 from enum import Enum, auto
 import logging
+import queue
 from urllib.parse import urlparse
-from yaml import dump
 from workdocs_dr.activity_backup import ActivityBackupRunner
+from workdocs_dr.activity_follower import ActivityFollower
 from workdocs_dr.aws_clients import AwsClients
+from workdocs_dr.backup_options import BackupOptions
 from workdocs_dr.directory_minder import DirectoryBackupMinder, RunEvent, RunStyle
 from workdocs_dr.document import DocumentHelper
-from workdocs_dr.listings import WdDirectory, WdFilter
+from workdocs_dr.listings import FolderPathResolver, WdDirectory, WdFilter
+from workdocs_dr.notification_ingest import NotificationFollower
+from workdocs_dr.process_engine import ProcessEngine
+from workdocs_dr.queue_backup import RunSyncTasks
+from workdocs_dr.run_ledger import RunStyleSelector
+from workdocs_dr.tree_snapshot import TreeSnapshot
 from workdocs_dr.user import UserHelper, UserKeyHelper
 from workdocs_dr.user_backup import UserBackupRunner
+from workdocs_dr.version_index import VersionIndex
+from workdocs_dr.workdocs_bucket_sync import SyncAction, WorkDocs2BucketSync
 
 
 class DirectoryBackupRunner:
@@ -20,12 +29,20 @@ class DirectoryBackupRunner:
         bucket_url: str,
         filter: WdFilter = None,
         run_style: RunStyle = None,
+        options: BackupOptions = None,
+        notifications=None,
+        reconcile_slices: int = None,
     ) -> None:
         self.clients = clients
         self.organization_id = organization_id
         self.bucket_url = bucket_url
         self.forced_runstyle = run_style
         self.filter = filter
+        self.options = options or BackupOptions()
+        # Source of pushed notifications (see notification_ingest) that drives FOLLOW runs instead of polling
+        self.notifications = notifications
+        # Scheduled runs reconcile one of this many slices of users along with the activities (RECONCILE)
+        self.reconcile_slices = reconcile_slices
         self.minder = None
 
     def get_minder(self):
@@ -38,10 +55,40 @@ class DirectoryBackupRunner:
     def runall(self):
         directory = WdDirectory(self.organization_id, self.clients)
 
-        run_style = self.forced_runstyle or self.get_minder().get_best_run_style()
+        requests_before = self.request_total()
+        activities = None
+        run_style = self.forced_runstyle
+        if self.is_subtree_run():
+            # Activities, reconciliation and following don't take the folder filter, so only a walk will do
+            if run_style not in (None, RunStyle.FULL):
+                logging.warning(f"Run style {run_style} ignored, as folders to back up are given")
+            run_style = RunStyle.FULL
+        if run_style is None:
+            # Listed up front, as the pending volume is part of choosing the run style
+            activities = list(directory.generate_activities(self.get_minder().get_activities_cutoff()))
+            run_style = self.get_minder().get_best_run_style(len(activities), reconcile_slices=self.reconcile_slices)
+        if run_style is RunStyle.RECONCILE:
+            activities = activities if activities is not None else list(
+                directory.generate_activities(self.get_minder().get_activities_cutoff()))
+            if len(activities) > RunStyleSelector.max_pending_activities:
+                # The activity step would only queue some of them, and the rest would wait for their user's slice
+                logging.warning(f"{len(activities)} activities pending, too many to reconcile. Running FULL instead")
+                run_style = RunStyle.FULL
         logging.info(f"Starting Backup. Runstyle is {run_style}")
         if run_style is RunStyle.ABORT:
             return
+        if self.is_unfiltered():
+            self.replay_failed_actions()
+        if run_style is RunStyle.FOLLOW and self.notifications is not None:
+            follower = NotificationFollower(self.clients, self.organization_id, self.bucket_url, directory,
+                                            self.get_minder(), self.notifications, self.options)
+            follower.run_forever()
+            return
+        if run_style is RunStyle.FOLLOW:
+            follower = ActivityFollower(self.clients, self.organization_id, self.bucket_url, directory,
+                                        self.get_minder(), self.options)
+            follower.run_forever()
+            return
         if run_style is RunStyle.ACTIVITIES:
             self._update_event_time(RunStyle.ACTIVITIES, RunEvent.START)
             # TODO: Implement user filters -- not at all trivial due to sharing, but we'll do it some day
@@ -50,28 +97,115 @@ class DirectoryBackupRunner:
                 self.organization_id,
                 self.bucket_url,
                 directory,
-                self.minder,
+                self.get_minder(),
+                self.options,
             )
-            results = abr.backup_activity_queue()
-            self._update_event_time(RunStyle.ACTIVITIES, RunEvent.END)
+            results = abr.backup_activity_queue(activities)
+            self.get_minder().get_retry_queue().save()
+            stats = dict(abr.stats, Requests=self.request_total() - requests_before)
+            self._update_event_time(RunStyle.ACTIVITIES, RunEvent.END, stats)
             return results
+        if run_style is RunStyle.RECONCILE:
+            return self.reconcile(directory, activities, requests_before)
         # Seems we are looking at a full backup
         users = [UserHelper(u) for u in directory.generate_users(self.filter)]
         self._update_event_time(RunStyle.FULL, RunEvent.START)
+        results, stats = self.backup_users(users)
+        self.get_minder().get_retry_queue().save()
+        stats["Requests"] = self.request_total() - requests_before
+        self._update_event_time(RunStyle.FULL, RunEvent.END, stats)
+        return results
+
+    def reconcile(self, directory: WdDirectory, activities: list, requests_before: int):
+        """
+        Syncs the activities, then backs up the users of the next slice the way a FULL run would. Slices
+        are taken in turn, so the whole organization is reconciled every `reconcile_slices` runs
+        """
+        minder = self.get_minder()
+        slices = self.reconcile_slices or minder.default_reconcile_slices
+        slice_index = minder.get_reconcile_state(slices)["NextSlice"]
+        self._update_event_time(RunStyle.RECONCILE, RunEvent.START)
+        abr = ActivityBackupRunner(self.clients, self.organization_id, self.bucket_url, directory, minder,
+                                   self.options)
+        results = abr.backup_activity_queue(activities)
+        users = [UserHelper(u) for u in directory.generate_users(self.filter)
+                 if minder.reconcile_slice(u["Id"], slices) == slice_index]
+        logging.info(f"Reconciling slice {slice_index + 1} of {slices} with {len(users)} users")
+        user_results, stats = self.backup_users(users)
+        results.extend(user_results)
+        stats.update(Activities=abr.stats.get("Activities", 0), Users=len(users),
+                     Actions=stats["Actions"] + abr.stats.get("Actions", 0),
+                     Bytes=stats["Bytes"] + abr.stats.get("Bytes", 0),
+                     Requests=self.request_total() - requests_before)
+        minder.get_retry_queue().save()
+        if self.is_unfiltered():
+            minder.complete_reconcile_slice(slices, slice_index, minder.get_now())
+        self._update_event_time(RunStyle.RECONCILE, RunEvent.END, stats)
+        return results
+
+    def replay_failed_actions(self):
+        """Runs the sync actions that failed in earlier runs (see RetryQueue), before anything else"""
+        retry_queue = self.get_minder().get_retry_queue()
+        entries = retry_queue.take()
+        if len(entries) == 0:
+            return
+        logging.info(f"Replaying {len(entries)} failed sync actions")
+        action_queue = queue.Queue()
+        run_st = RunSyncTasks(task_queue=action_queue, retry_queue=retry_queue)
+        syncers = {}
+        run_st.start_syncing()
+        for entry in entries:
+            username = entry["User"]["Username"]
+            if username not in syncers:
+                user = UserHelper(entry["User"])
+                userkeys = UserKeyHelper(user, self.bucket_url)
+                syncers[username] = WorkDocs2BucketSync(self.clients, user, userkeys,
+                                                        VersionIndex(self.clients, userkeys), self.options)
+            action_queue.put(SyncAction(syncers[username], entry))
+        action_queue.put(None)
+        run_st.finish_syncing()
+        for syncer in syncers.values():
+            syncer.version_index.save()
+        retry_queue.save()
+
+    def backup_users(self, users: list):
+        """Backs up each user in full. Returns the results and the summed stats"""
+        changed_folders = self.recently_changed_folders() if self.options.tree_snapshot is not None else None
+        if self.options.processes > 1 and len(users) > 1:
+            engine = ProcessEngine(self.clients, self.organization_id, self.bucket_url, self.get_minder(),
+                                   self.options, self.filter, changed_folders)
+            return engine.backup_users(users)
         results = []
+        stats = {"Actions": 0, "Bytes": 0}
+        resolver = FolderPathResolver(self.clients)
         for u in users:
             ukh = UserKeyHelper(u, self.bucket_url)
-            ubr = UserBackupRunner(u, ukh, self.clients)
+            ubr = UserBackupRunner(u, ukh, self.clients, self.options, self.get_minder(), resolver, changed_folders)
             results.extend(ubr.backup_user_queue(self.filter))
-        self._update_event_time(RunStyle.FULL, RunEvent.END)
-        return results
+            stats = {k: v + ubr.stats.get(k, 0) for k, v in stats.items()}
+        return results, stats
+
+    def recently_changed_folders(self) -> set:
+        """Folders touched by activities as far back as tree snapshots are trusted"""
+        since = self.get_minder().get_now() - TreeSnapshot.max_age
+        activities = WdDirectory(self.organization_id, self.clients).generate_activities(since)
+        return TreeSnapshot.folders_touched(activities)
 
-    def _update_event_time(self, run_style: RunStyle, run_event: RunEvent) -> None:
-        if self.filter is None or (
+    def request_total(self) -> int:
+        return sum(self.clients.request_counts.values())
+
+    def is_unfiltered(self) -> bool:
+        return self.filter is None or (
             (self.filter.foldernames is None or len(self.filter.foldernames) == 0)
             and self.filter.userquery is None
             and self.filter.folderpattern is None
-        ):
+        )
+
+    def is_subtree_run(self) -> bool:
+        return self.filter is not None and self.filter.foldernames is not None and len(self.filter.foldernames) > 0
+
+    def _update_event_time(self, run_style: RunStyle, run_event: RunEvent, run_stats: dict = None) -> None:
+        if self.is_unfiltered():
             self.get_minder().update_last_event_time(
-                run_style=run_style, run_event=run_event
+                run_style=run_style, run_event=run_event, run_stats=run_stats
             )
@@ -1,12 +1,14 @@
 
 from datetime import datetime, timezone, timedelta
 from enum import Enum, auto
+import hashlib
 import logging
 from urllib.parse import urlparse
 
-from yaml import dump
 from workdocs_dr.aws_clients import AwsClients
 from workdocs_dr.document import DocumentHelper
+from workdocs_dr.retry_queue import RetryQueue
+from workdocs_dr.run_ledger import RunLedger, RunStyleSelector
 from workdocs_dr.user import UserKeyHelper
 
 
@@ -14,6 +16,8 @@ class RunStyle(Enum):
     ABORT = auto()
     FULL = auto()
     ACTIVITIES = auto()
+    FOLLOW = auto()
+    RECONCILE = auto()
 
     def __str__(self) -> str:
         return self.name.lower()
@@ -30,6 +34,8 @@ class RunEvent(Enum):
 class DirectoryBackupMinder():
     start_time_key = "StartTime"
     end_time_key = "EndTime"
+    "Number of slices a RECONCILE run works through when none are given"
+    default_reconcile_slices = 30
 
     def __init__(self, clients: AwsClients, organization_id: str, bucket_url: str) -> None:
         self.clients = clients
@@ -40,9 +46,11 @@ class DirectoryBackupMinder():
         self.org_prefix = UserKeyHelper.org_prefix(self.prefix, self.organization_id)
         self.last_times = None
         self.current_run = None
+        self.run_ledger = None
+        self.retry_queue = None
 
     def init_last_times(self):
-        styles = [RunStyle.FULL, RunStyle.ACTIVITIES]
+        styles = [RunStyle.FULL, RunStyle.ACTIVITIES, RunStyle.RECONCILE]
         events = list(RunEvent)
         if self.last_times is None:
             self.last_times = dict()
@@ -54,24 +62,38 @@ class DirectoryBackupMinder():
     def get_key(self, run_style: RunStyle, run_event: RunEvent):
         return f"{self.org_prefix}/.last_backup_{run_event}_{run_style}"
 
-    def get_best_run_style(self, max_days_since_last_full=30, max_hours_to_complete_last_full_run=12) -> RunStyle:
+    def get_best_run_style(self, pending_activities: int = None, max_days_since_last_full=30,
+                           max_hours_to_complete_last_full_run=12, reconcile_slices: int = None) -> RunStyle:
+        """
+        FULL or ACTIVITIES, whichever the run ledger predicts is cheaper while keeping drift bounded (see
+        RunStyleSelector), or RECONCILE with `reconcile_slices`. ABORT if a FULL run would be picked while
+        one started recently hasn't finished
+        """
         cut_last_start_abort = self.get_now() + timedelta(hours=-1 * max_hours_to_complete_last_full_run)
-        cut_last_full = self.get_now() + timedelta(days=-1 * max_days_since_last_full)
         self.init_last_times()
-        if self.last_times[(RunStyle.FULL, RunEvent.END)].get(self.start_time_key) < cut_last_full:
-            # Appears it's been a long time since the last complete full sync
-            if self.last_times[(RunStyle.FULL, RunEvent.START)].get(self.start_time_key) > cut_last_start_abort:
-                # There's a good chance we just started a full run, so let's not start another
-                return RunStyle.ABORT
-            return RunStyle.FULL
-        return RunStyle.ACTIVITIES
+        selector = RunStyleSelector(self.get_run_ledger().get_entries(), self.get_now())
+        selector.max_days_since_full = max_days_since_last_full
+        last_full_end = self.last_times[(RunStyle.FULL, RunEvent.END)].get(self.start_time_key)
+        last_verified = max(last_full_end, self.get_reconcile_coverage(reconcile_slices) or last_full_end)
+        style, predictions = selector.choose(pending_activities, last_verified, reconcile_slices)
+        logging.info(f"Run style {style} predicted from {predictions}")
+        if style == "activities":
+            return RunStyle.ACTIVITIES
+        if style == "reconcile":
+            return RunStyle.RECONCILE
+        last_full_start = self.last_times[(RunStyle.FULL, RunEvent.START)].get(self.start_time_key)
+        if last_full_start > cut_last_start_abort and last_full_start > last_full_end:
+            # There's a good chance we just started a full run, so let's not start another
+            return RunStyle.ABORT
+        return RunStyle.FULL
 
     def get_activities_cutoff(self) -> datetime:
         self.init_last_times()
         # Should return time of start of most recent completed run
         last_start_time = max(
             self.last_times[(RunStyle.ACTIVITIES, RunEvent.END)].get(self.start_time_key),
-            self.last_times[(RunStyle.FULL, RunEvent.END)].get(self.start_time_key)
+            self.last_times[(RunStyle.FULL, RunEvent.END)].get(self.start_time_key),
+            self.last_times[(RunStyle.RECONCILE, RunEvent.END)].get(self.start_time_key)
         )
         # Add a 30 mins of padding, because Workdocs can take ~5 mins to register updates
 
@@ -86,12 +108,18 @@ class DirectoryBackupMinder():
     def get_min_time(self):
         return datetime.min.replace(tzinfo=timezone.utc)
 
-    def update_last_event_time(self, run_style: RunStyle, run_event: RunEvent, extra_info: str = None, event_time: datetime = None):
+    def update_last_event_time(self, run_style: RunStyle, run_event: RunEvent, extra_info: str = None,
+                               event_time: datetime = None, run_stats: dict = None):
+        """Records start/end of a run. `run_stats` (e.g. Actions, Bytes) are stored with the end event"""
+        from yaml import dump
         current_time = event_time or self.get_now()
         if self.current_run is None:
             self.current_run = {"RunStyle": run_style, self.start_time_key: current_time}
         if run_event is RunEvent.END:
             self.current_run[self.end_time_key] = current_time
+            self.current_run["Duration"] = int((current_time - self.current_run[self.start_time_key]).total_seconds())
+            self.current_run.update(run_stats or {})
+            self.get_run_ledger().append(dict(self.current_run, RunStyle=str(run_style)))
         key = self.get_key(run_style, run_event)
         body = (extra_info or dump(self.current_run)).encode("utf-8")
         s3_request = {
@@ -102,6 +130,112 @@ class DirectoryBackupMinder():
         }
         self.clients.bucket_client().put_object(**s3_request)
 
+    def get_run_ledger(self) -> RunLedger:
+        """Statistics of recent completed runs, which run styles are picked from"""
+        if self.run_ledger is None:
+            self.run_ledger = RunLedger(self.clients, self.bucket, f"{self.org_prefix}/.run_ledger")
+        return self.run_ledger
+
+    def get_retry_queue(self) -> RetryQueue:
+        """Failed sync actions, to be replayed first in the next run"""
+        if self.retry_queue is None:
+            self.retry_queue = RetryQueue(self.clients, self.bucket, f"{self.org_prefix}/.retry_queue",
+                                          f"{self.org_prefix}/.dead_letters")
+        return self.retry_queue
+
+    def get_last_run_stats(self, run_style: RunStyle) -> dict:
+        """Metadata of the last completed run of the given style, including any run stats"""
+        self.init_last_times()
+        return self.last_times[(run_style, RunEvent.END)]
+
+    def get_follow_cursor_key(self):
+        return f"{self.org_prefix}/.follow_cursor"
+
+    def get_follow_cursor(self) -> datetime:
+        """Time up to which a follower has synced activities. Falls back on the regular activities cutoff"""
+        metadata = self.get_last_metadata(self.get_follow_cursor_key())
+        return metadata.get("Cursor", None) or self.get_activities_cutoff()
+
+    def update_follow_cursor(self, cursor: datetime):
+        from yaml import dump
+        s3_request = {
+            "Bucket": self.bucket,
+            "Key": self.get_follow_cursor_key(),
+            "Body": dump({"Cursor": cursor}).encode("utf-8"),
+            "Metadata": DocumentHelper.metadata_dict2s3({"Cursor": cursor}),
+        }
+        self.clients.bucket_client().put_object(**s3_request)
+
+    def get_reconcile_state_key(self):
+        return f"{self.org_prefix}/.reconcile_state"
+
+    def get_reconcile_state(self, slices: int) -> dict:
+        """
+        Progress of rolling reconciliation: the slice to reconcile next and when each slice was last
+        reconciled. Starts over if the number of slices changed
+        """
+        from yaml import safe_load
+        client = self.clients.bucket_client()
+        try:
+            response = client.get_object(Bucket=self.bucket, Key=self.get_reconcile_state_key())
+            state = safe_load(response["Body"].read()) or {}
+        except client.exceptions.NoSuchKey:
+            state = {}
+        if state.get("Slices") != slices:
+            return {"Slices": slices, "NextSlice": 0, "SliceEnds": {}}
+        return state
+
+    def complete_reconcile_slice(self, slices: int, slice_index: int, end_time: datetime):
+        from yaml import safe_dump
+        state = self.get_reconcile_state(slices)
+        state["SliceEnds"][slice_index] = end_time
+        state["NextSlice"] = (slice_index + 1) % slices
+        self.clients.bucket_client().put_object(Bucket=self.bucket, Key=self.get_reconcile_state_key(),
+                                                Body=safe_dump(state).encode("utf-8"))
+
+    def get_reconcile_coverage(self, slices: int) -> datetime:
+        """Time since which every slice has been reconciled, or None if some never were"""
+        if slices is None:
+            return None
+        slice_ends = self.get_reconcile_state(slices)["SliceEnds"]
+        return min(slice_ends.values()) if len(slice_ends) == slices else None
+
+    @staticmethod
+    def reconcile_slice(user_id: str, slices: int) -> int:
+        """Slice a user is reconciled in. Stable across runs and as other users come and go"""
+        return int(hashlib.sha256(user_id.encode("utf-8")).hexdigest(), 16) % slices
+
+    def get_subtree_completions(self, userkeys: UserKeyHelper) -> dict:
+        """Last completed filtered backup of each subtree of a user, keyed by folder id"""
+        from yaml import safe_load
+        client = self.clients.bucket_client()
+        try:
+            response = client.get_object(Bucket=self.bucket, Key=userkeys.bucket_folderprefix(".subtree_backups"))
+            return safe_load(response["Body"].read()) or {}
+        except client.exceptions.NoSuchKey:
+            return {}
+
+    def update_subtree_completion(self, userkeys: UserKeyHelper, folder_id: str, completion: dict):
+        """
+        Records that the subtree at `folder_id` was backed up. `completion` has Path, times and run stats.
+        The completions are read again just before writing, and a completion of a run that started later (one
+        overlapping with this one) isn't replaced
+        """
+        from yaml import dump
+        completions = self.get_subtree_completions(userkeys)
+        previous = completions.get(folder_id, None)
+        if previous is not None and previous.get("StartTime") is not None \
+                and previous["StartTime"] > completion["StartTime"]:
+            logging.info(f"Subtree {completion.get('Path', folder_id)} was backed up by a later run meanwhile")
+            return
+        completions[folder_id] = completion
+        s3_request = {
+            "Bucket": self.bucket,
+            "Key": userkeys.bucket_folderprefix(".subtree_backups"),
+            "Body": dump(completions).encode("utf-8"),
+        }
+        self.clients.bucket_client().put_object(**s3_request)
+
     def get_last_metadata(self, key):
         s3_request = {"Bucket": self.bucket, "Key": key}
         try:
@@ -9,6 +9,7 @@ from workdocs_dr.aws_clients import AwsClients
 from workdocs_dr.cli_arguments import bucket_url_from_input
 from workdocs_dr.document import DocumentHelper
 from workdocs_dr.listings import Listings, WdFilter
+from workdocs_dr.restore_journal import RestoreJournal
 from workdocs_dr.user import UserHelper, UserKeyHelper
 from workdocs_dr.user_restore import UserRestoreInfo, UserRestoreRunner
 
@@ -61,9 +62,20 @@ class DirectoryRestoreRunner:
     def runall(self):
         usernames = self._userlist()
         urr = UserRestoreInfo(self.clients, self.organization_id, self.bucket_url)
-        for username in usernames:
-            uh, ukh = urr.userhelper_userkeyhelper_from_username(username)
-            userpath = self.restore_path / uh.username if len(usernames) > 1 else self.restore_path
-            ur = UserRestoreRunner(uh, ukh, self.clients, userpath)
-            ur.restore_user_queued(self.filter)
-            logging.info(f"Restored user {uh.username}")
+        # Progress is journalled so running the same restore again continues it. It's dropped once all went well
+        journal = RestoreJournal(self.restore_path)
+        errors = 0
+        try:
+            for username in usernames:
+                uh, ukh = urr.userhelper_userkeyhelper_from_username(username)
+                userpath = self.restore_path / uh.username if len(usernames) > 1 else self.restore_path
+                ur = UserRestoreRunner(uh, ukh, self.clients, userpath, journal)
+                results = ur.restore_user_queued(self.filter)
+                errors += len([r for r in results if r.get("Status") == "Error"])
+                logging.info(f"Restored user {uh.username}")
+        except BaseException:
+            journal.close()
+            raise
+        if errors > 0:
+            logging.warning(f"{errors} documents could not be restored. Run the restore again to retry them")
+        journal.close(remove=errors == 0)
@@ -4,13 +4,22 @@ import base64
 import datetime
 import re
 
+from workdocs_dr.profiling import profiled
+
 
 class DocumentHelper():
 
     FOLDERINFONAME = ".folderinfo"
     USERINFONAME = ".userinfo"
+    VERSIONINDEXNAME = ".versionindex"
+    PACKINDEXNAME = ".packindex"
+    PACKSNAME = ".packs"
+    VERSIONSNAME = ".versions"
+    VERSIONHISTORYNAME = ".versionhistory"
+    TREESNAPSHOTNAME = ".treesnapshot"
 
     @staticmethod
+    @profiled("metadata_dict2s3")
     def metadata_dict2s3(wdmetadata):
         snake_case_key = {k: DocumentHelper.pascal_to_snakecase(k) for k in wdmetadata.keys()}
         items = wdmetadata.items()
@@ -23,6 +32,7 @@ class DocumentHelper():
         return {**{snake_case_key[k]: v for k, v in {**asciistrs, **dates, **ints}.items()}, **{f"base64_{snake_case_key[k]}": v for k, v in nonasciistrs.items()}}
 
     @staticmethod
+    @profiled("metadata_s32dict")
     def metadata_s32dict(s3metadata):
         items = s3metadata.items()
         keymap = {k: DocumentHelper.snakecase_to_pascal(DocumentHelper.removeprefix(k, "base64_")) \
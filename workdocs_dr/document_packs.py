@@ -0,0 +1,241 @@
+import json
+import logging
+import threading
+import uuid
+from datetime import datetime
+from io import BytesIO
+
+from workdocs_dr.aws_clients import AwsClients
+from workdocs_dr.checksums import ChecksumWriter, s3_checksum
+from workdocs_dr.codec import Decoder
+from workdocs_dr.document import DocumentHelper
+
+
+class PackBuilder:
+    """Stored (possibly compressed) documents laid back to back in memory, on their way to a new pack"""
+
+    def __init__(self) -> None:
+        self.buffer = BytesIO()
+        self.entries = {}
+
+    def add(self, document_id, stored: bytes, size: int, last_modified: datetime, metadata: dict):
+        self.entries[document_id] = {
+            "Offset": self.buffer.tell(),
+            "Length": len(stored),
+            "Size": size,
+            "LastModified": last_modified.isoformat(),
+            "Metadata": metadata,
+        }
+        self.buffer.write(stored)
+
+    def __len__(self):
+        return self.buffer.tell()
+
+
+class PackIndex:
+    """
+    Packs of small documents in one folder, and the `.packindex` object that maps each packed document to
+    its pack, offset and length, with the S3 metadata it would have had as an object of its own. Packs are
+    objects under `.packs/` holding stored documents back to back, so a document is one ranged GET and
+    neighbouring documents can share one. Removed and replaced documents leave dead bytes in their pack,
+    and packs with less than `min_live_ratio` of their bytes still in use are rewritten by `repack`.
+
+    Updates are read-modify-write of the index, so callers hold `lock` around them.
+    """
+
+    "Documents below this size are packed when packing is enabled"
+    default_threshold = 100_000
+    "New packs are closed at about this size"
+    pack_max_bytes = 32 * 1024 * 1024
+    min_live_ratio = 0.5
+    "Documents less than this apart in a pack are read with one ranged GET"
+    max_gap = 256 * 1024
+    max_range = 16 * 1024 * 1024
+
+    def __init__(self, clients: AwsClients, bucket: str, folderprefix: str) -> None:
+        self.clients = clients
+        self.bucket = bucket
+        self.folderprefix = folderprefix
+        self.key = f"{folderprefix}/{DocumentHelper.PACKINDEXNAME}"
+        self.packs = None  # Keyed by pack id, value is the pack length
+        self.documents = None  # Keyed by document id
+        self.dirty = False
+        self.lock = threading.RLock()
+
+    def pack_key(self, pack_id) -> str:
+        return f"{self.folderprefix}/{DocumentHelper.PACKSNAME}/{pack_id}"
+
+    def _load(self):
+        client = self.clients.bucket_client()
+        try:
+            response = client.get_object(Bucket=self.bucket, Key=self.key)
+            return json.loads(response["Body"].read())
+        except client.exceptions.NoSuchKey:
+            return {}
+
+    def _ensure_loaded(self):
+        if self.documents is None:
+            with self.lock:
+                if self.documents is None:
+                    loaded = self._load()
+                    self.packs = loaded.get("Packs", {})
+                    self.documents = loaded.get("Documents", {})
+
+    def get(self, document_id):
+        self._ensure_loaded()
+        return self.documents.get(document_id, None)
+
+    def as_s3objects(self) -> dict:
+        """Packed documents as stand-ins for listed objects, keyed by document id"""
+        self._ensure_loaded()
+        return {document_id: {"Key": f"{self.folderprefix}/{document_id}", "Size": entry["Size"],
+                              "LastModified": datetime.fromisoformat(entry["LastModified"]), "Packed": entry}
+                for document_id, entry in self.documents.items()}
+
+    def remove(self, document_id):
+        self._ensure_loaded()
+        with self.lock:
+            if self.documents.pop(document_id, None) is not None:
+                self.dirty = True
+
+    def live_ratio(self, pack_id) -> float:
+        self._ensure_loaded()
+        live = sum(e["Length"] for e in self.documents.values() if e["Pack"] == pack_id)
+        return live / self.packs[pack_id] if self.packs[pack_id] > 0 else 0.0
+
+    def sparse_packs(self) -> list:
+        self._ensure_loaded()
+        return [pack_id for pack_id in self.packs if self.live_ratio(pack_id) < self.min_live_ratio]
+
+    def write_pack(self, builder: PackBuilder) -> str:
+        """Stores the pack and indexes its documents (replacing older entries for them). Returns the pack id"""
+        self._ensure_loaded()
+        pack_id = uuid.uuid4().hex
+        body = builder.buffer.getvalue()
+        self.clients.bucket_client().put_object(Bucket=self.bucket, Key=self.pack_key(pack_id), Body=body,
+                                                ContentType="application/octet-stream",
+                                                ChecksumSHA256=s3_checksum(body))
+        with self.lock:
+            self.packs[pack_id] = len(body)
+            self.documents.update({document_id: {**entry, "Pack": pack_id}
+                                   for document_id, entry in builder.entries.items()})
+            self.dirty = True
+        return pack_id
+
+    def repack(self, pack_ids) -> list:
+        """
+        Moves the live documents of `pack_ids` into new packs. Returns the keys of the old packs, which
+        should only be deleted once the index is saved
+        """
+        self._ensure_loaded()
+        builder = PackBuilder()
+        for pack_id in pack_ids:
+            live = [(d, e) for d, e in self.documents.items() if e["Pack"] == pack_id]
+            for document_id, entry, stored in self.read_ranges(live):
+                builder.add(document_id, stored, entry["Size"], datetime.fromisoformat(entry["LastModified"]),
+                            entry["Metadata"])
+                if len(builder) >= self.pack_max_bytes:
+                    self.write_pack(builder)
+                    builder = PackBuilder()
+        if len(builder) > 0:
+            self.write_pack(builder)
+        with self.lock:
+            for pack_id in pack_ids:
+                self.packs.pop(pack_id, None)
+            self.dirty = True
+        logging.info(f"Repacked {len(pack_ids)} sparse packs in {self.folderprefix}")
+        return [self.pack_key(pack_id) for pack_id in pack_ids]
+
+    def read_ranges(self, documents):
+        """
+        Yields (document id, entry, stored bytes) for (document id, entry) pairs, reading documents that
+        are close together in the same pack with a single ranged GET
+        """
+        client = self.clients.bucket_client()
+        by_pack = {}
+        for document_id, entry in documents:
+            by_pack.setdefault(entry["Pack"], []).append((document_id, entry))
+        for pack_id, pack_documents in by_pack.items():
+            for run in self.coalesce(sorted(pack_documents, key=lambda d: d[1]["Offset"])):
+                start = run[0][1]["Offset"]
+                end = max(e["Offset"] + e["Length"] for _, e in run)
+                body = b""
+                if end > start:  # Empty documents need no read
+                    response = client.get_object(Bucket=self.bucket, Key=self.pack_key(pack_id),
+                                                 Range=f"bytes={start}-{end - 1}")
+                    body = response["Body"].read()
+                    self.clients.governor.throttle_bytes(len(body))
+                for document_id, entry in run:
+                    offset = entry["Offset"] - start
+                    yield document_id, entry, body[offset:offset + entry["Length"]]
+
+    def coalesce(self, documents) -> list:
+        """Splits (document id, entry) pairs sorted by offset into runs that are each read with one GET"""
+        runs = []
+        for document_id, entry in documents:
+            if len(runs) > 0:
+                run_start = runs[-1][0][1]["Offset"]
+                run_end = max(e["Offset"] + e["Length"] for _, e in runs[-1])
+                if entry["Offset"] - run_end <= self.max_gap and \
+                        entry["Offset"] + entry["Length"] - run_start <= self.max_range:
+                    runs[-1].append((document_id, entry))
+                    continue
+            runs.append([(document_id, entry)])
+        return runs
+
+    def save(self):
+        if not self.dirty:
+            return
+        with self.lock:
+            body = json.dumps({"Packs": self.packs, "Documents": self.documents},
+                              separators=(",", ":")).encode("utf-8")
+            self.dirty = False
+        self.clients.bucket_client().put_object(Bucket=self.bucket, Key=self.key, Body=body,
+                                                ContentType="application/json")
+        logging.debug(f"Saved pack index with {len(self.documents)} documents to {self.key}")
+
+
+def unpack_document(entry, stored: bytes) -> bytes:
+    """Original content of a packed document from its stored bytes, checked against its checksum"""
+    decoder = Decoder.from_metadata(entry["Metadata"])
+    checked = ChecksumWriter(BytesIO())
+    checked.write(decoder.decode(stored) + decoder.finish())
+    checked.verify(entry["Metadata"])
+    return checked.fileobj.getvalue()
+
+
+def read_packed_document(clients: AwsClients, bucket: str, s3object: dict) -> bytes:
+    """Original content of a packed stand-in from `generate_folder_documents`, with one ranged GET"""
+    folderprefix, document_id = s3object["Key"].rsplit("/", 1)
+    packindex = PackIndex(clients, bucket, folderprefix)
+    for _, entry, stored in packindex.read_ranges([(document_id, s3object["Packed"])]):
+        return unpack_document(entry, stored)
+
+
+def merge_packed(standalone: dict, packed: dict) -> dict:
+    """
+    Merges listed objects and packed stand-ins, both keyed by document id. Where a document is in both
+    (an interrupted pack or a later copy of its own) the one stored last wins
+    """
+    merged = dict(packed)
+    for document_id, s3object in standalone.items():
+        if document_id not in merged or s3object["LastModified"] >= merged[document_id]["LastModified"]:
+            merged[document_id] = s3object
+    return merged
+
+
+def generate_folder_documents(clients: AwsClients, bucket: str, folderprefix: str):
+    """
+    Yields listed objects for the documents stored in a folder, with packed documents as stand-ins that
+    carry their pack entry as "Packed". `.folderinfo`, the pack index and packs are left out
+    """
+    from workdocs_dr.listings import Listings
+    s3objects = Listings(clients).list_s3_documents(bucket, folderprefix)
+    standalone = {o["Key"][len(folderprefix) + 1:]: o for o in s3objects
+                  if o["Key"].startswith(f"{folderprefix}/")}
+    packed = {}
+    if DocumentHelper.PACKINDEXNAME in standalone:
+        packed = PackIndex(clients, bucket, folderprefix).as_s3objects()
+    for document_id, s3object in merge_packed(standalone, packed).items():
+        if "/" not in document_id and not document_id.startswith("."):
+            yield s3object
@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+import threading
+from collections import Counter
+from time import monotonic, sleep
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket. A `rate` of None means unlimited. Requests larger than the bucket
+    are let through by going into debt, so later callers wait for it to be paid back.
+    """
+
+    def __init__(self, rate: float = None, burst: float = None) -> None:
+        self._lock = threading.Lock()
+        self.configure(rate, burst)
+
+    def configure(self, rate: float = None, burst: float = None):
+        with self._lock:
+            self.rate = rate if rate else None
+            self.burst = burst or (rate or 0)
+            self.tokens = self.burst
+            self.last = monotonic()
+
+    def acquire(self, amount: float = 1) -> float:
+        """Takes `amount` tokens, sleeping as needed. Returns the number of seconds waited"""
+        with self._lock:
+            if self.rate is None:
+                return 0.0
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+
+class Governor:
+    """
+    Shared limits on bytes per second moved by transfers, and on requests per second per service
+    ("s3", "workdocs", "workdocs-content" for document downloads). Every client request and transfer
+    draws from it, so one setting caps the whole run whatever the worker counts are.
+
+    Limits can be changed while running with `configure`, or by editing `limits_file` (JSON like
+    {"BytesPerSecond": 50000000, "RequestsPerSecond": {"s3": 100, "workdocs": 20}}), which is
+    checked for changes every `reload_interval` seconds. A governor in one of several processes sharing
+    the limits takes its `share` of each.
+    """
+
+    reload_interval = 5.0
+
+    def __init__(self, bytes_per_second: float = None, requests_per_second: dict = None,
+                 limits_file: str = None, share: float = 1.0) -> None:
+        self.share = share
+        self.limits = (None, {})
+        self.bytes = TokenBucket()
+        self.requests = {}
+        self.default_requests_per_second = None
+        self.totals = Counter()
+        self.waited = Counter()
+        self.limits_file = limits_file
+        self._limits_mtime = None
+        self._next_reload = 0.0
+        self._lock = threading.Lock()
+        self.configure(bytes_per_second, requests_per_second)
+        self.maybe_reload()
+
+    def configure(self, bytes_per_second: float = None, requests_per_second: dict = None):
+        """`requests_per_second` maps service to limit. The key "*" sets a limit for all other services"""
+        requests_per_second = requests_per_second or {}
+        self.limits = (bytes_per_second, dict(requests_per_second))
+        if self.share != 1.0:
+            bytes_per_second = bytes_per_second * self.share if bytes_per_second else None
+            requests_per_second = {k: v * self.share if v else v for k, v in requests_per_second.items()}
+        with self._lock:
+            self.bytes.configure(bytes_per_second)
+            self.default_requests_per_second = requests_per_second.get("*", None)
+            for service, bucket in self.requests.items():
+                bucket.configure(requests_per_second.get(service, self.default_requests_per_second))
+            for service, rate in requests_per_second.items():
+                if service != "*" and service not in self.requests:
+                    self.requests[service] = TokenBucket(rate)
+        logging.info(f"Governor limits: bytes/s {bytes_per_second}, requests/s {requests_per_second}")
+
+    def _request_bucket(self, service):
+        bucket = self.requests.get(service, None)
+        if bucket is None:
+            with self._lock:
+                bucket = self.requests.setdefault(service, TokenBucket(self.default_requests_per_second))
+        return bucket
+
+    def throttle_request(self, service: str):
+        self.maybe_reload()
+        waited = self._request_bucket(service).acquire(1)
+        with self._lock:
+            self.totals[f"requests:{service}"] += 1
+            self.waited[f"requests:{service}"] += waited
+
+    def throttle_bytes(self, amount: int):
+        self.maybe_reload()
+        waited = self.bytes.acquire(amount)
+        with self._lock:
+            self.totals["bytes"] += amount
+            self.waited["bytes"] += waited
+
+    def maybe_reload(self):
+        if self.limits_file is None or monotonic() < self._next_reload:
+            return
+        self._next_reload = monotonic() + self.reload_interval
+        try:
+            mtime = os.stat(self.limits_file).st_mtime
+            if mtime == self._limits_mtime:
+                return
+            self._limits_mtime = mtime
+            with open(self.limits_file, "r") as f:
+                limits = json.load(f)
+            self.configure(limits.get("BytesPerSecond", None), limits.get("RequestsPerSecond", None))
+        except (OSError, ValueError) as err:
+            logging.warning(f"Could not read governor limits from {self.limits_file}: {err}")
+
+    def worker_spec(self, share: float) -> dict:
+        """Arguments for a governor in another process, taking `share` of the current limits"""
+        bytes_per_second, requests_per_second = self.limits
+        return {"bytes_per_second": bytes_per_second, "requests_per_second": requests_per_second,
+                "limits_file": self.limits_file, "share": share}
+
+    def merge(self, totals: Counter, waited: Counter):
+        """Adds the totals and waits of a governor in another process, so the report covers both"""
+        with self._lock:
+            self.totals.update(totals)
+            self.waited.update(waited)
+
+    def report(self) -> dict:
+        """Totals, seconds spent waiting and current limit for each throttled quantity"""
+        with self._lock:
+            limits = {"bytes": self.bytes.rate, **{f"requests:{s}": b.rate for s, b in self.requests.items()}}
+            return {k: {"Total": self.totals[k], "WaitedSeconds": round(self.waited[k], 3), "Limit": limits.get(k)}
+                    for k in sorted(set(self.totals) | set(limits))}
@@ -1,13 +1,70 @@
 
 import datetime
+import os
+import threading
+import uuid
 from os import utime
 from time import time
 from pathlib import Path
 
 from workdocs_dr.document import DocumentHelper
+from workdocs_dr.profiling import profiled
 
 
-def scribble_file(dirpath, mainrequest, writer, headrequest=None):
+class RestoreFileWriter:
+    """
+    Writes restored files so a crash never leaves a truncated file under the real name: content goes
+    to a hidden temp file next to the destination (preallocated when large) and is renamed into place.
+    Modification times are set in batches of `mtime_batch_size`, and by `flush`.
+    """
+
+    preallocate_threshold = 1_000_000
+    mtime_batch_size = 200
+
+    def __init__(self) -> None:
+        self.pending_mtimes = []
+        self._lock = threading.Lock()
+
+    def write(self, documentpath: Path, size: int, writer):
+        temppath = documentpath.with_name(f".{documentpath.name}.{uuid.uuid4().hex[:8]}.partial")
+        try:
+            with open(temppath, "wb") as f:
+                if size is not None and size >= self.preallocate_threshold and hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(f.fileno(), 0, size)
+                writer(f)
+                f.truncate(f.tell())
+            os.replace(temppath, documentpath)
+        except BaseException:
+            temppath.unlink(missing_ok=True)
+            raise
+
+    def set_mtime(self, path: Path, mtime: float):
+        with self._lock:
+            self.pending_mtimes.append((path, mtime))
+            is_batch_full = len(self.pending_mtimes) >= self.mtime_batch_size
+        if is_batch_full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self.pending_mtimes = self.pending_mtimes, []
+        now = time()
+        for path, mtime in pending:
+            utime(path, (now, mtime))
+
+
+def is_identical_on_disk(documentpath: Path, metadata) -> bool:
+    """True if the file exists with the size and modification time of the document in `metadata`"""
+    if not documentpath.exists():
+        return False
+    doc_stat = documentpath.stat()
+    modified_timestamp = metadata["LatestVersionMetadata"]["ContentModifiedTimestamp"].timestamp()
+    return doc_stat.st_size == metadata["LatestVersionMetadata"]["Size"] \
+        and abs(doc_stat.st_mtime - modified_timestamp) < 2.0
+
+
+@profiled("scribble_file")
+def scribble_file(dirpath, mainrequest, writer, headrequest=None, file_writer: RestoreFileWriter = None):
     # Note:
     # If headrequest is absent we just download the file
     # If metadata indicates the file is already on disk we return early
@@ -26,15 +83,17 @@ def scribble_file(dirpath, mainrequest, writer, headrequest=None):
     modified_timestamp = metadata["LatestVersionMetadata"]["ContentModifiedTimestamp"].timestamp()
     documentpath = dirpath / name
     # If metadata in response indicate the file is already on disk we can return early
-    if documentpath.exists():
-        doc_stat = documentpath.stat()
-        if doc_stat.st_size == metadata["LatestVersionMetadata"]["Size"] \
-                and abs(doc_stat.st_mtime - modified_timestamp) < 2.0:
-            return {"Metadata": metadata, "Path": documentpath, "Action": "SkippedIdentical"}
+    if is_identical_on_disk(documentpath, metadata):
+        return {"Metadata": metadata, "Path": documentpath, "Action": "SkippedIdentical"}
     # if mainrequest and headrequest are same we can skip the download, so can reuse the response
     # also, already did the download if there isn't a headrequest, so can reuse the response
     bodyresponse = mainrequest() if headrequest is not None and mainrequest != headrequest else response
-    with open(documentpath, "wb") as f:
-        writer(bodyresponse, f)
-    utime(documentpath, (time(), modified_timestamp))
+    # Without a shared writer, the modification time is set straight away
+    is_own_writer = file_writer is None
+    file_writer = file_writer or RestoreFileWriter()
+    file_writer.write(documentpath, metadata["LatestVersionMetadata"].get("Size", None),
+                      lambda f: writer(bodyresponse, f))
+    file_writer.set_mtime(documentpath, modified_timestamp)
+    if is_own_writer:
+        file_writer.flush()
     return {"Metadata": metadata, "Path": documentpath, "Action": "Restored"}
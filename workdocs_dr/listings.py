@@ -1,9 +1,11 @@
+import logging
+import threading
 from re import search
-import botocore.exceptions
 
 from functools import lru_cache
 from workdocs_dr.aws_clients import AwsClients
 from workdocs_dr.document import DocumentHelper
+from workdocs_dr.paginator import PrefetchPaginator
 
 
 class WdFilter:
@@ -45,15 +47,7 @@ class WdDirectory:
         if include_all:
             request["Include"] = "ALL"
         client = self.clients.docs_client()
-        while True:
-            response = client.describe_users(**request)
-            if "Users" in response:
-                for u in response["Users"]:
-                    yield u
-            if "Marker" in response:
-                request["Marker"] = response["Marker"]
-            else:
-                break
+        yield from PrefetchPaginator.workdocs(client.describe_users, request).items("Users")
 
     def generate_activities(
         self, start_time, activity_types=actionable_activity_types, limit=None
@@ -68,23 +62,16 @@ class WdDirectory:
                 raise RuntimeWarning(
                     "Activity types not of type being handled. Ignoring parameter and passing all acitivies"
                 )
-        # if limit is not None:
-        #     request["Limit"] = limit
+        if limit is not None:
+            request["Limit"] = min(limit, PrefetchPaginator.workdocs_page_size)
         client = self.clients.docs_client()
         itemcount = 0
-        while True:
-            response = client.describe_activities(**request)
-            if "UserActivities" in response:
-                for a in response["UserActivities"]:
-                    yield a
-                    if limit is not None:
-                        itemcount += 1
-                        if itemcount >= limit:
-                            return
-            if "Marker" in response:
-                request["Marker"] = response["Marker"]
-            else:
-                break
+        for a in PrefetchPaginator.workdocs(client.describe_activities, request).items("UserActivities"):
+            yield a
+            if limit is not None:
+                itemcount += 1
+                if itemcount >= limit:
+                    return
 
 
 class WorkdocsFolderTree:
@@ -104,16 +91,41 @@ class WorkdocsFolderTree:
         self._add_to_folders(folderid)
         request = {"FolderId": folderid, "Type": "FOLDER"}
         client = self.clients.docs_client()
-        while True:
-            response = client.describe_folder_contents(**request)
-            for f in response["Folders"]:
-                if f["ResourceState"] == "ACTIVE":
-                    yield f
-                    yield from self.generate_subfolders(f["Id"])
-            if "Marker" in response:
-                request["Marker"] = response["Marker"]
-            else:
-                break
+        for f in PrefetchPaginator.workdocs(client.describe_folder_contents, request).items("Folders"):
+            if f["ResourceState"] == "ACTIVE":
+                yield f
+                yield from self.generate_subfolders(f["Id"])
+
+
+class FolderPathResolver:
+    """
+    Resolves "/" separated folder paths below a root folder to WorkDocs folder metadata. Subfolder
+    listings are paginated and cached, so paths sharing a parent (and repeated runs over the same
+    resolver) only list each folder once
+    """
+
+    def __init__(self, clients: AwsClients) -> None:
+        self.clients = clients
+        self.subfolders = {}  # Keyed by folder id, value maps subfolder name to folder metadata
+        self._lock = threading.Lock()
+
+    def list_subfolders(self, folder_id) -> dict:
+        with self._lock:
+            if folder_id not in self.subfolders:
+                request = {"FolderId": folder_id, "Type": "FOLDER"}
+                client = self.clients.docs_client()
+                folders = PrefetchPaginator.workdocs(client.describe_folder_contents, request).items("Folders")
+                self.subfolders[folder_id] = {f["Name"]: f for f in folders if f["ResourceState"] == "ACTIVE"}
+            return self.subfolders[folder_id]
+
+    def resolve(self, root_folder_id, folderpath: str):
+        """Metadata of the folder at `folderpath`, or None if there is no such folder"""
+        folder = {"Id": root_folder_id}
+        for name in [n for n in folderpath.split("/") if n != ""]:
+            folder = self.list_subfolders(folder["Id"]).get(name, None)
+            if folder is None:
+                return None
+        return folder
 
 
 class S3FolderTree:
@@ -122,6 +134,7 @@ class S3FolderTree:
         self.bucket = bucket
         self.prefix = prefix
         self.already_generated = set()
+        self.children = None  # Keyed by parent folder id, from folder metadata. Only listed if needed
 
     def isrootfolder(self, folderinfo):
         metadata = folderinfo.get("Metadata", None)
@@ -135,6 +148,7 @@ class S3FolderTree:
         return f"{self.prefix}/{folderid}/{DocumentHelper.FOLDERINFONAME}"
 
     def folderinfo(self, folderid):
+        import botocore.exceptions
         client = self.clients.bucket_client()
         metadata = {}
         try:
@@ -142,7 +156,7 @@ class S3FolderTree:
                 Bucket=self.bucket, Key=self.folderinfokey(folderid)
             )
             metadata = DocumentHelper.folder_metadata_s32dict(response["Metadata"])
-        except s3client.exceptions.NoSuchKey:  # type: ignore
+        except client.exceptions.NoSuchKey:  # type: ignore
             pass  # falling back on empty metadata
         except botocore.exceptions.ClientError as err:
             # NOTE: This case is required because of https://github.com/boto/boto3/issues/2442
@@ -163,6 +177,66 @@ class S3FolderTree:
             )
         yield folderinfo
 
+    def folderinfo_with_contents(self, folderid):
+        """Metadata plus the subfolders and documents listed in the body of `.folderinfo`, from a single GET"""
+        from yaml import safe_load
+        client = self.clients.bucket_client()
+        try:
+            response = client.get_object(Bucket=self.bucket, Key=self.folderinfokey(folderid))
+        except client.exceptions.NoSuchKey:
+            return None
+        contents = safe_load(response["Body"].read()) or {}
+        return {
+            "Metadata": DocumentHelper.folder_metadata_s32dict(response["Metadata"]),
+            "Folders": contents.get("Folders", []),
+            "Documents": contents.get("Documents", []),
+        }
+
+    def resolve_path(self, root_folder_id, folderpath: str):
+        """
+        Folder id of a "/" separated path of folder names below the root folder, found by walking the
+        stored `.folderinfo` bodies. Returns None if the path isn't in the backup
+        """
+        folder_id = root_folder_id
+        for name in [n for n in folderpath.split("/") if n != ""]:
+            folderinfo = self.folderinfo_with_contents(folder_id)
+            if folderinfo is None:
+                return None
+            matches = [f["Id"] for f in self.subfolders(folder_id, folderinfo) if str(f["Name"]) == name]
+            if len(matches) == 0:
+                return None
+            folder_id = matches[0]
+        return folder_id
+
+    def generate_subtree(self, folderid, path_names=()):
+        """Yields (folderinfo, names of folders from the start folder) for a folder and all below it"""
+        if folderid in self.already_generated:
+            return
+        self.already_generated.add(folderid)
+        folderinfo = self.folderinfo_with_contents(folderid)
+        if folderinfo is None:
+            return
+        yield folderinfo, path_names
+        for subfolder in self.subfolders(folderid, folderinfo):
+            yield from self.generate_subtree(subfolder["Id"], path_names + (str(subfolder["Name"]),))
+
+    def subfolders(self, folderid, folderinfo) -> list:
+        """
+        Subfolders listed in the `.folderinfo` body. Summaries written by activity runs used to list nothing,
+        so for a body without any contents they are found from the `ParentFolderId` of the stored folders
+        """
+        if len(folderinfo["Folders"]) > 0 or len(folderinfo["Documents"]) > 0:
+            return folderinfo["Folders"]
+        if self.children is None:
+            logging.info(f"Folder {folderid} has no contents listed, finding subfolders from folder metadata")
+            self.children = {}
+            for fid in Listings(self.clients).list_s3_subfoldernames(self.bucket, self.prefix):
+                metadata = self.folderinfo(fid)["Metadata"]
+                if "ParentFolderId" in metadata:
+                    self.children.setdefault(metadata["ParentFolderId"], []).append(
+                        {"Id": fid, "Name": metadata.get("Name", fid)})
+        return self.children.get(folderid, [])
+
     def generate_folders(self):
         lister = Listings(self.clients)
         s3folderids = lister.list_s3_subfoldernames(self.bucket, self.prefix)
@@ -176,35 +250,21 @@ class Listings:
 
     def list_wd_folder(self, folderid):
         request = {"FolderId": folderid, "Type": "ALL"}
-        documents = []
-        folders = []
         client = self.clients.docs_client()
-        while True:
-            response = client.describe_folder_contents(**request)
-            documents.extend(
-                [d for d in response["Documents"] if d["ResourceState"] == "ACTIVE"]
-            )
-            folders.extend(
-                [d for d in response["Folders"] if d["ResourceState"] == "ACTIVE"]
-            )
-            if "Marker" in response:
-                request["Marker"] = response["Marker"]
-            else:
-                return {"Documents": documents, "Folders": folders}
+        contents = PrefetchPaginator.workdocs(client.describe_folder_contents, request).collect("Documents", "Folders")
+        return {k: [d for d in items if d["ResourceState"] == "ACTIVE"] for k, items in contents.items()}
 
     def list_wd_documents(self, folderid):
         request = {"FolderId": folderid, "Type": "DOCUMENT"}
-        documents = []
         client = self.clients.docs_client()
-        while True:
-            response = client.describe_folder_contents(**request)
-            documents.extend(
-                [d for d in response["Documents"] if d["ResourceState"] == "ACTIVE"]
-            )
-            if "Marker" in response:
-                request["Marker"] = response["Marker"]
-            else:
-                return documents
+        documents = PrefetchPaginator.workdocs(client.describe_folder_contents, request).items("Documents")
+        return [d for d in documents if d["ResourceState"] == "ACTIVE"]
+
+    def generate_wd_document_versions(self, document_id):
+        """Yields the active versions of a document, with download URLs"""
+        request = {"DocumentId": document_id, "Fields": "SOURCE"}
+        client = self.clients.docs_client()
+        yield from PrefetchPaginator.workdocs(client.describe_document_versions, request).items("DocumentVersions")
 
     def list_s3_documents(self, bucket, folderprefix):
         request = {"Bucket": bucket, "Prefix": folderprefix}
@@ -231,19 +291,13 @@ class Listings:
         return search(f"({unslashed_prefix})/(.*)/([^/]*)", key).groups(0)[1]
 
     def list_s3_objects(self, request):
-        objects = []
+        return list(self.generate_s3_objects(request))
+
+    def generate_s3_objects(self, request):
+        """Yields objects (or common prefixes) a page at a time, in key order, for listings too big to hold"""
         client = self.clients.bucket_client()
-        while True:
-            response = client.list_objects_v2(**request)
-            if "Delimiter" in request:
-                objects.extend(response.get("CommonPrefixes", []))
-            else:
-                if "Contents" in response:
-                    objects.extend(response["Contents"])
-            if response["IsTruncated"]:
-                request["ContinuationToken"] = response["NextContinuationToken"]
-            else:
-                return objects
+        key = "CommonPrefixes" if "Delimiter" in request else "Contents"
+        yield from PrefetchPaginator.s3(client.list_objects_v2, request).items(key)
 
 
 class WdItemApexOwner:
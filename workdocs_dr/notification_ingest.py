@@ -0,0 +1,318 @@
+import hmac
+import json
+import logging
+import queue
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from workdocs_dr.activity_follower import ActivityFollower
+from workdocs_dr.aws_clients import AwsClients
+from workdocs_dr.backup_options import BackupOptions
+from workdocs_dr.directory_minder import DirectoryBackupMinder
+from workdocs_dr.listings import WdDirectory
+
+
+def notification_to_activities(notification: dict, received: datetime) -> list:
+    """
+    Activity-like records for a WorkDocs notification, which names the changed entity and its parent
+    (`entityType`, `entityId`, `parentEntityType`, `parentEntityId` and `action`). A changed document
+    also touches its parent folder, whose summary lists the documents in it
+    """
+    entity_type = str(notification.get("entityType", "")).lower()
+    entity_id = notification.get("entityId", None)
+    action = str(notification.get("action", "")).lower()
+    if entity_id is None or entity_type not in ["document", "folder"]:
+        return []
+    is_removal = "delete" in action or "recycle" in action
+    kind = "DOCUMENT" if entity_type == "document" else "FOLDER"
+    activities = [{
+        "Type": f"{kind}_RECYCLED" if is_removal else f"{kind}_UPDATED",
+        "ResourceMetadata": {"Id": entity_id, "Owner": {"Id": None}},
+        "TimeStamp": received,
+    }]
+    parent_id = notification.get("parentEntityId", None)
+    if parent_id is not None and str(notification.get("parentEntityType", "folder")).lower() == "folder":
+        activities.append({"Type": "FOLDER_UPDATED", "ResourceMetadata": {"Id": parent_id, "Owner": {"Id": None}},
+                           "TimeStamp": received})
+    return activities
+
+
+def unwrap_sns(body: dict) -> dict:
+    """The WorkDocs notification in a message, whether it came directly or wrapped in an SNS envelope"""
+    if body.get("Type") == "Notification" and "Message" in body:
+        return json.loads(body["Message"])
+    return body
+
+
+class SqsNotificationSource:
+    """
+    Notifications delivered to an SQS queue. Messages are long polled, and only deleted from the queue
+    once their changes are synced, so a crash means they are delivered again rather than lost. Messages
+    are kept invisible for `visibility_timeout` seconds at a time while they wait, so they aren't
+    delivered again meanwhile
+    """
+
+    protocol = "SQS"
+    wait_seconds = 5
+    max_messages = 10
+    visibility_timeout = 120
+
+    def __init__(self, clients: AwsClients, queue_url: str) -> None:
+        self.clients = clients
+        self.queue_url = queue_url
+
+    def endpoint(self) -> str:
+        """Queue ARN, as WorkDocs subscribes to queues by ARN"""
+        response = self.clients.notifications_client().get_queue_attributes(
+            QueueUrl=self.queue_url, AttributeNames=["QueueArn"])
+        return response["Attributes"]["QueueArn"]
+
+    def receive(self) -> list:
+        """(message id, notification, receipt handle) for messages waiting, waiting up to `wait_seconds`"""
+        response = self.clients.notifications_client().receive_message(
+            QueueUrl=self.queue_url, MaxNumberOfMessages=self.max_messages, WaitTimeSeconds=self.wait_seconds,
+            VisibilityTimeout=self.visibility_timeout)
+        received = []
+        for message in response.get("Messages", []):
+            try:
+                received.append((message["MessageId"], unwrap_sns(json.loads(message["Body"])),
+                                 message["ReceiptHandle"]))
+            except (ValueError, KeyError) as err:
+                logging.warning(f"Dropping unreadable notification {message.get('MessageId')}: {err}")
+                self.acknowledge([message["ReceiptHandle"]])
+        return received
+
+    def start(self):
+        pass
+
+    def acknowledge(self, receipt_handles: list):
+        client = self.clients.notifications_client()
+        for i in range(0, len(receipt_handles), 10):
+            batch = receipt_handles[i:i + 10]
+            client.delete_message_batch(QueueUrl=self.queue_url, Entries=[
+                {"Id": str(n), "ReceiptHandle": handle} for n, handle in enumerate(batch)])
+
+    def keep_invisible(self, receipt_handles: list):
+        """Keeps messages still waiting to be synced from being delivered again for `visibility_timeout`"""
+        client = self.clients.notifications_client()
+        for i in range(0, len(receipt_handles), 10):
+            batch = receipt_handles[i:i + 10]
+            client.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=[
+                {"Id": str(n), "ReceiptHandle": handle, "VisibilityTimeout": self.visibility_timeout}
+                for n, handle in enumerate(batch)])
+
+    def close(self):
+        pass
+
+
+class HttpsNotificationSource:
+    """
+    Local endpoint that WorkDocs posts notifications to (as SNS messages). Subscription confirmations
+    are confirmed if the confirmation URL is an AWS one. `public_url` is where WorkDocs can reach the
+    endpoint, e.g. through a load balancer, and the server only speaks TLS itself when given a
+    certificate. Posts are acknowledged as they arrive.
+
+    Anyone can post to the endpoint, so `public_url` has to carry a secret `token` query parameter (like
+    `https://example.com/notifications?token=...`) that WorkDocs posts back. Posts without it get a 403.
+    """
+
+    protocol = "HTTPS"
+    wait_seconds = 5
+    min_token_length = 16
+
+    def __init__(self, public_url: str, port: int = 8443, certfile: str = None, keyfile: str = None) -> None:
+        self.token = self.url_token(public_url)
+        if self.token is None or len(self.token) < self.min_token_length:
+            raise ValueError(f"Notification URL needs a secret token parameter of at least {self.min_token_length} "
+                             "characters, like https://example.com/notifications?token=...")
+        self.public_url = public_url
+        self.port = port
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.received = queue.Queue()
+        self.server = None
+
+    def start(self):
+        if self.server is not None:
+            return
+        source = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if not source.is_authorized(self.path):
+                    logging.warning(f"Rejected notification post from {self.client_address[0]} without the token")
+                    self.send_response(403)
+                    self.end_headers()
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                try:
+                    source.handle_message(json.loads(self.rfile.read(length)))
+                    self.send_response(200)
+                except Exception as err:
+                    logging.warning(f"Could not handle notification post: {err}")
+                    self.send_response(400)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+        self.server = ThreadingHTTPServer(("", self.port), Handler)
+        if self.certfile is not None:
+            import ssl
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.certfile, self.keyfile)
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        threading.Thread(target=self.server.serve_forever, name="notifications", daemon=True).start()
+        logging.info(f"Listening for notifications on port {self.port}")
+
+    def endpoint(self) -> str:
+        return self.public_url
+
+    @staticmethod
+    def url_token(url: str) -> str:
+        return parse_qs(urlparse(url).query).get("token", [None])[0]
+
+    def is_authorized(self, request_path: str) -> bool:
+        token = self.url_token(request_path)
+        return token is not None and hmac.compare_digest(token.encode("utf-8"), self.token.encode("utf-8"))
+
+    def handle_message(self, body: dict):
+        if body.get("Type") == "SubscriptionConfirmation":
+            self.confirm_subscription(body["SubscribeURL"])
+            return
+        self.received.put((body.get("MessageId", None), unwrap_sns(body), None))
+
+    @staticmethod
+    def confirm_subscription(subscribe_url: str):
+        import requests
+        host = urlparse(subscribe_url).hostname or ""
+        if urlparse(subscribe_url).scheme != "https" or not host.endswith(".amazonaws.com"):
+            raise RuntimeError(f"Not confirming subscription from {host}")
+        requests.get(subscribe_url, timeout=30).raise_for_status()
+        logging.info("Confirmed notification subscription")
+
+    def receive(self) -> list:
+        try:
+            received = [self.received.get(timeout=self.wait_seconds)]
+        except queue.Empty:
+            return []
+        while not self.received.empty():
+            received.append(self.received.get_nowait())
+        return received
+
+    def acknowledge(self, receipt_handles: list):
+        pass
+
+    def keep_invisible(self, receipt_handles: list):
+        pass
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+
+def ensure_subscription(clients: AwsClients, organization_id: str, endpoint: str, protocol: str) -> str:
+    """Subscribes `endpoint` to all notifications for the organization, unless it already is. Returns the id"""
+    client = clients.docs_client()
+    request = {"OrganizationId": organization_id}
+    while True:
+        response = client.describe_notification_subscriptions(**request)
+        for subscription in response.get("Subscriptions", []):
+            if subscription.get("EndPoint") == endpoint and subscription.get("Protocol") == protocol:
+                return subscription["SubscriptionId"]
+        if "Marker" not in response:
+            break
+        request["Marker"] = response["Marker"]
+    response = client.create_notification_subscription(
+        OrganizationId=organization_id, Endpoint=endpoint, Protocol=protocol, SubscriptionType="ALL")
+    logging.info(f"Subscribed {endpoint} to WorkDocs notifications")
+    return response["Subscription"]["SubscriptionId"]
+
+
+class NotificationFollower(ActivityFollower):
+    """
+    FOLLOW run driven by pushed notifications instead of polling activities. Changes made while nothing
+    was listening are caught up once from the saved cursor, and after that each notification becomes
+    activities for the touched document and folder, so the debouncing and syncing of `ActivityFollower`
+    apply. Notifications can be delivered more than once, so ones already seen are skipped, and they are
+    only acknowledged after the items they touch are synced. A notification delivered again while waiting
+    is acknowledged with its latest receipt handle, and waiting ones are kept invisible every
+    `visibility_refresh`.
+    """
+
+    poll_interval = 0  # Receiving waits for notifications
+    visibility_refresh = timedelta(seconds=60)
+
+    def __init__(self, clients: AwsClients, organization_id: str, bucket_url: str, directory: WdDirectory,
+                 minder: DirectoryBackupMinder, source, options: BackupOptions = None) -> None:
+        super().__init__(clients, organization_id, bucket_url, directory, minder, options)
+        self.organization_id = organization_id
+        self.source = source
+        self.caught_up = False
+        self.subscription_id = None
+        self.visibility_refreshed = None
+
+    def poll(self, now: datetime):
+        if self.subscription_id is None:
+            self.source.start()
+            self.subscription_id = ensure_subscription(self.clients, self.organization_id,
+                                                       self.source.endpoint(), self.source.protocol)
+        if not self.caught_up:
+            super().poll(now)
+            self.caught_up = True
+            return
+        for message_id, notification, receipt_handle in self.source.receive():
+            identity = ("NOTIFICATION", message_id)
+            waiting = [a for activities, _, _ in self.pending.values() for a in activities
+                       if message_id is not None and a.get("MessageId") == message_id]
+            if len(waiting) > 0:
+                # Only the latest receipt handle of a message is sure to delete it
+                for activity in waiting:
+                    activity["ReceiptHandle"] = receipt_handle
+                continue
+            if message_id is not None and identity in self.seen:
+                self.source.acknowledge([receipt_handle] if receipt_handle is not None else [])
+                continue
+            self.seen[identity] = now
+            self.newest_seen = max(self.newest_seen, now)
+            for activity in notification_to_activities(notification, now):
+                activity["MessageId"] = message_id
+                activity["ReceiptHandle"] = receipt_handle
+                item_id = activity["ResourceMetadata"]["Id"]
+                activities, first_seen, _ = self.pending.get(item_id, ([], now, now))
+                self.pending[item_id] = (activities + [activity], first_seen, now)
+        horizon = self.newest_seen - 2 * self.lookback
+        self.seen = {k: ts for k, ts in self.seen.items() if ts >= horizon}
+        if self.visibility_refreshed is None or now - self.visibility_refreshed >= self.visibility_refresh:
+            handles = {a.get("ReceiptHandle") for activities, _, _ in self.pending.values() for a in activities}
+            handles.discard(None)
+            if len(handles) > 0:
+                self.source.keep_invisible(sorted(handles))
+            self.visibility_refreshed = now
+
+    def sync(self, activities: list):
+        try:
+            super().sync(activities)
+        except Exception:
+            # Delivered again, the notifications are taken as new rather than acknowledged
+            for a in activities:
+                self.seen.pop(("NOTIFICATION", a.get("MessageId", None)), None)
+            raise
+
+    def drop_synced(self, due: dict):
+        super().drop_synced(due)
+        self.acknowledge([a for activities in due.values() for a in activities])
+
+    def acknowledge(self, activities: list):
+        handles = {a["ReceiptHandle"] for a in activities if a.get("ReceiptHandle") is not None}
+        # A notification touching several items is only acknowledged once none of them are waiting
+        waiting = {a.get("ReceiptHandle") for pending, _, _ in self.pending.values() for a in pending}
+        self.source.acknowledge(sorted(handles - waiting))
+
+    def run_forever(self, stop: threading.Event = None):
+        try:
+            super().run_forever(stop)
+        finally:
+            self.source.close()
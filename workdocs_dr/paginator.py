@@ -0,0 +1,93 @@
+import queue
+import threading
+
+
+class PrefetchPaginator:
+    """
+    Pages of a WorkDocs or S3 listing, with the next page requested in the background as soon as its marker
+    is known, while the caller works on the current one. Listings that fit in one page don't start a thread.
+    Pages are asked for at the largest size the service allows. `pages()` and `items()` stream, `collect()`
+    returns everything at once. Errors while prefetching are raised to the caller when it reaches that page.
+    """
+
+    workdocs_page_size = 999
+    s3_page_size = 1000
+    "Pages fetched ahead of the caller"
+    prefetch_pages = 1
+
+    def __init__(self, operation, request: dict, next_request) -> None:
+        self.operation = operation
+        self.request = request
+        self.next_request = next_request
+
+    @classmethod
+    def workdocs(cls, operation, request: dict):
+        """Paginates a WorkDocs describe operation, which hands out `Marker`s"""
+        def next_request(request, response):
+            return {**request, "Marker": response["Marker"]} if "Marker" in response else None
+        return cls(operation, {"Limit": cls.workdocs_page_size, **request}, next_request)
+
+    @classmethod
+    def s3(cls, operation, request: dict):
+        """Paginates `list_objects_v2`"""
+        def next_request(request, response):
+            if not response.get("IsTruncated", False):
+                return None
+            return {**request, "ContinuationToken": response["NextContinuationToken"]}
+        return cls(operation, {"MaxKeys": cls.s3_page_size, **request}, next_request)
+
+    def pages(self):
+        response = self.operation(**self.request)
+        request = self.next_request(self.request, response)
+        if request is None:
+            yield response
+            return
+        fetched = queue.Queue(maxsize=self.prefetch_pages)
+        stop = threading.Event()
+        threading.Thread(target=self._prefetch, args=(request, fetched, stop), daemon=True).start()
+        try:
+            yield response
+            while True:
+                response, err = fetched.get()
+                if err is not None:
+                    raise err
+                if response is None:
+                    return
+                yield response
+        finally:
+            # Also when the caller stops early, so the prefetching thread doesn't wait forever
+            stop.set()
+
+    def _prefetch(self, request, fetched: queue.Queue, stop: threading.Event):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    fetched.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            while request is not None:
+                response = self.operation(**request)
+                request = self.next_request(request, response)
+                if not put((response, None)):
+                    return
+            put((None, None))
+        except Exception as err:
+            put((None, err))
+
+    def items(self, *keys):
+        """Yields the entries under `keys` of each page"""
+        for response in self.pages():
+            for key in keys:
+                yield from response.get(key, [])
+
+    def collect(self, *keys) -> dict:
+        """All entries under each of `keys`, by key"""
+        collected = {key: [] for key in keys}
+        for response in self.pages():
+            for key in keys:
+                collected[key].extend(response.get(key, []))
+        return collected
@@ -0,0 +1,90 @@
+import logging
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from workdocs_dr.aws_clients import AwsClients
+from workdocs_dr.backup_options import BackupOptions
+from workdocs_dr.directory_minder import DirectoryBackupMinder
+from workdocs_dr.listings import FolderPathResolver, WdFilter
+from workdocs_dr.user import UserHelper, UserKeyHelper
+from workdocs_dr.user_backup import UserBackupRunner
+
+# Set up in each worker process by _init_worker
+_worker = {}
+
+
+def _init_worker(clients_spec: dict, organization_id: str, bucket_url: str, options: BackupOptions,
+                 filter: WdFilter, changed_folders: set, log_level: int):
+    logging.basicConfig(level=log_level, format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+    clients = AwsClients.from_worker_spec(clients_spec)
+    _worker.update(clients=clients, bucket_url=bucket_url, options=options, filter=filter,
+                   changed_folders=changed_folders,
+                   minder=DirectoryBackupMinder(clients, organization_id, bucket_url),
+                   resolver=FolderPathResolver(clients))
+
+
+def _backup_user(user: UserHelper) -> dict:
+    """Backs up a user in a worker process. Returns results and what was counted doing it"""
+    clients = _worker["clients"]
+    governor = clients.governor
+    requests_before = Counter(clients.request_counts)
+    totals_before, waited_before = Counter(governor.totals), Counter(governor.waited)
+    ubr = UserBackupRunner(user, UserKeyHelper(user, _worker["bucket_url"]), clients, _worker["options"],
+                           _worker["minder"], _worker["resolver"], _worker["changed_folders"])
+    results = ubr.backup_user_queue(_worker["filter"])
+    retry_queue = _worker["minder"].get_retry_queue()
+    failed, retry_queue.failed = retry_queue.failed, []
+    return {"Results": results, "Stats": ubr.stats, "Failed": failed,
+            "Requests": Counter(clients.request_counts) - requests_before,
+            "GovernorTotals": Counter(governor.totals) - totals_before,
+            "GovernorWaited": Counter(governor.waited) - waited_before}
+
+
+class ProcessEngine:
+    """
+    Backs up users in a pool of processes, for when a run is held up by one CPU (botocore parsing
+    responses, metadata conversion, dumping folder summaries all hold the GIL) rather than by WorkDocs
+    or the bucket. Each process has its own clients and worker threads, and its governor takes an even
+    share of the limits. Users are handed out one at a time, so a big user doesn't hold up a shard of
+    small ones. Results, stats, request counts and failed sync actions are merged in this process.
+    """
+
+    def __init__(self, clients: AwsClients, organization_id: str, bucket_url: str, minder: DirectoryBackupMinder,
+                 options: BackupOptions, filter: WdFilter = None, changed_folders: set = None) -> None:
+        self.clients = clients
+        self.organization_id = organization_id
+        self.bucket_url = bucket_url
+        self.minder = minder
+        self.options = options
+        self.filter = filter
+        self.changed_folders = changed_folders
+
+    def backup_users(self, users: list):
+        """Backs up each user in full. Returns the results and the summed stats"""
+        processes = min(self.options.processes, len(users))
+        results = []
+        stats = {"Actions": 0, "Bytes": 0}
+        retry_queue = self.minder.get_retry_queue()
+        initargs = (self.clients.worker_spec(share=1 / processes), self.organization_id, self.bucket_url,
+                    self.options, self.filter, self.changed_folders, logging.getLogger().getEffectiveLevel())
+        logging.info(f"Backing up {len(users)} users in {processes} processes")
+        # Spawned rather than forked, as forking copies clients and threads that aren't safe to share
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker, initargs=initargs) as pool:
+            futures = {pool.submit(_backup_user, u): u for u in users}
+            for future in as_completed(futures):
+                try:
+                    outcome = future.result()
+                except Exception:
+                    # Fails the run like backing up in this process would, without starting the users left
+                    logging.error(f"Backing up user {futures[future].username} failed")
+                    for f in futures:
+                        f.cancel()
+                    raise
+                results.extend(outcome["Results"])
+                stats = {k: v + outcome["Stats"].get(k, 0) for k, v in stats.items()}
+                retry_queue.merge(outcome["Failed"])
+                self.clients.merge_request_counts(outcome["Requests"])
+                self.clients.governor.merge(outcome["GovernorTotals"], outcome["GovernorWaited"])
+        return results, stats
@@ -2,19 +2,26 @@
 import logging
 import queue
 from workdocs_dr.aws_clients import AwsClients
+from workdocs_dr.backup_options import BackupOptions
 from workdocs_dr.listings import Listings
 from workdocs_dr.queue_pool import QueueWorkPool
+from workdocs_dr.retry_queue import RetryQueue
+from workdocs_dr.tree_snapshot import TreeSnapshot
 from workdocs_dr.user import UserHelper, UserKeyHelper
+from workdocs_dr.version_index import VersionIndex
 from workdocs_dr.workdocs_bucket_sync import WorkDocs2BucketSync
 
 
 class ListWorkdocsFolders():
     worker_count = 4
 
-    def __init__(self, clients: AwsClients, downstream_queue: queue.LifoQueue = None, collect_folders=False) -> None:
+    def __init__(self, clients: AwsClients, downstream_queue: queue.LifoQueue = None, collect_folders=False,
+                 snapshot: TreeSnapshot = None) -> None:
         self.clients = clients
         self.downstream_queue = downstream_queue
         self.collect_folders = collect_folders
+        # Walks just the subtrees with evidence of change since the snapshot, if given
+        self.snapshot = snapshot
         if self.collect_folders:
             self.folders = set()
         self._threads = []
@@ -36,13 +43,22 @@ class ListWorkdocsFolders():
         #             self._add_to_folders(folder_id)
         def task_work(folder_def, lock):
             # Describe the folder
-            # Place self metadata + list of folders/documents on downstream queue, and place subfolders on tree walking queue
+            # Place self metadata + list of folders/documents on downstream queue, and place subfolders on
+            # tree walking queue
             contents = self.listings.list_wd_folder(folder_def["Id"])
-            if self.downstream_queue is not None:
-                if len(contents.get("Folders", [])) > 0 or len(contents.get("Documents", [])) > 0:
-                    self.downstream_queue.put({"Metadata": folder_def, "Contents": contents})
+            has_contents = len(contents.get("Folders", [])) > 0 or len(contents.get("Documents", [])) > 0
+            if self.downstream_queue is not None and has_contents:
+                # Recorded in the snapshot downstream, once its sync actions are planned
+                self.downstream_queue.put({"Metadata": folder_def, "Contents": contents})
+            elif self.snapshot is not None:
+                self.snapshot.record(folder_def, contents)
             for subfolder_def in contents.get("Folders", []):
-                self.queue_walktree.put(subfolder_def)
+                if self.snapshot is None or self.snapshot.should_walk(subfolder_def):
+                    self.queue_walktree.put(subfolder_def)
+                elif self.collect_folders:
+                    # Still there, so not to be pruned
+                    with lock:
+                        self.folders.update(self.snapshot.subtree_ids(subfolder_def["Id"]))
             if self.collect_folders:
                 with lock:
                     self._add_to_folders(folder_def["Id"])
@@ -85,17 +101,23 @@ class ListWorkdocsFolders():
 class RecordSyncTasks:
     worker_count = 4
 
-    def __init__(self, clients: AwsClients, user: UserHelper, userkeys: UserKeyHelper, task_queue: queue.Queue, downstream_queue: queue.Queue = None) -> None:
+    def __init__(self, clients: AwsClients, user: UserHelper, userkeys: UserKeyHelper, task_queue: queue.Queue,
+                 downstream_queue: queue.Queue = None, version_index: VersionIndex = None,
+                 options: BackupOptions = None, snapshot: TreeSnapshot = None) -> None:
         self.clients = clients
+        self.options = options
         self.listings = Listings(self.clients)
+        # Folders are recorded in the snapshot once planned, and forgotten if planning fails
+        self.snapshot = snapshot
         self.user = user
         self.userkeys = userkeys
+        self.version_index = version_index
         self.task_queue = task_queue
         self.downstream_queue = downstream_queue
         self.queue_helper = None
 
     def _setup(self):
-        wd2bs = WorkDocs2BucketSync(self.clients, self.user, self.userkeys)
+        wd2bs = WorkDocs2BucketSync(self.clients, self.user, self.userkeys, self.version_index, self.options)
         # def task_work(fdef, lock):
         #     actions = wd2bs.get_folder_syncactions(fdef["Id"])
         #     if self.downstream_queue is not None:
@@ -107,8 +129,16 @@ class RecordSyncTasks:
 
         def task_work(folder_data, lock):
             fdef = folder_data["Metadata"]
-            actions = wd2bs.get_folder_syncactions(fdef, folder_data["Contents"].get(
-                "Folders", []), folder_data["Contents"].get("Documents", []))
+            try:
+                actions = wd2bs.get_folder_syncactions(fdef, folder_data["Contents"].get(
+                    "Folders", []), folder_data["Contents"].get("Documents", []))
+            except Exception:
+                if self.snapshot is not None:
+                    # So the next run walks it again
+                    self.snapshot.forget(fdef)
+                raise
+            if self.snapshot is not None:
+                self.snapshot.record(fdef, folder_data["Contents"])
             if self.downstream_queue is not None:
                 for act in actions:
                     self.downstream_queue.put(act)
@@ -130,16 +160,25 @@ class RecordSyncTasks:
 class RunSyncTasks():
     worker_count = 6
 
-    def __init__(self, task_queue: queue.Queue) -> None:
+    def __init__(self, task_queue: queue.Queue, retry_queue: RetryQueue = None) -> None:
         self.task_queue = task_queue
+        # Failed actions are retried and kept there for the next run, if given
+        self.retry_queue = retry_queue
         self.results = []
+        self.stats = {"Actions": 0, "Bytes": 0}
         self.queue_helper = None
 
     def _setup(self):
         def task_work(act, lock):
-            result = act()
-            if result is not None:
-                with lock:
+            result = self.retry_queue.run(act) if self.retry_queue is not None else act()
+            record = getattr(act, "record", {})
+            with lock:
+                self.stats["Actions"] += 1
+                if record.get("Action") in ["copy_to_bucket", "pack_documents"]:
+                    self.stats["Bytes"] += record.get("Size", 0)
+                elif record.get("Action") == "copy_versions_to_bucket":
+                    self.stats["Bytes"] += result.get("Bytes", 0)
+                if result is not None:
                     self.results.append(result)
         self.queue_helper = QueueWorkPool(self.task_queue, self.worker_count, worker_action=task_work)
 
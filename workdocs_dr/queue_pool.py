@@ -1,14 +1,18 @@
 import threading
 import logging
 
+from workdocs_dr.profiling import profiler
+
 
 class QueueWorkPool:
     def __init__(self, task_queue, worker_count: int = 4, worker_action=lambda wi, l: None,
-                 lock=None) -> None:
+                 lock=None, stage: str = None) -> None:
         self.task_queue = task_queue
         self.worker_count = worker_count
         self.worker_action = worker_action
         self.lock = lock
+        # Profiling stage, e.g. "RunSyncTasks" for a worker action defined in RunSyncTasks._setup
+        self.stage = stage or getattr(worker_action, "__qualname__", "worker").split(".")[0]
 
     def worker(self, tq, lock=threading.Lock()):
         while True:
@@ -18,7 +22,11 @@ class QueueWorkPool:
                 got_queue_item = True
                 if workitem is None:
                     break
-                self.worker_action(workitem, lock)
+                if profiler.enabled:
+                    with profiler.stage(self.stage):
+                        self.worker_action(workitem, lock)
+                else:
+                    self.worker_action(workitem, lock)
             except Exception as err:
                 try:
                     logging.warning(err)
@@ -0,0 +1,56 @@
+import heapq
+import itertools
+import math
+import queue
+from datetime import datetime, timezone
+
+
+class SyncPriority:
+    """
+    Scores sync action records for scheduling. Lower scores run first.
+
+    The score adds up the log of the age of the change in hours and the log of the size in MB, each
+    with its own weight, so recently modified and small documents go ahead of old and large ones.
+    Records without hints (e.g. from activities) score 0 and go first.
+    """
+
+    def __init__(self, recency_weight: float = 1.0, size_weight: float = 0.5) -> None:
+        self.recency_weight = recency_weight
+        self.size_weight = size_weight
+
+    def __call__(self, record: dict) -> float:
+        score = 0.0
+        modified = record.get("ModifiedTimestamp", None)
+        if modified is not None and self.recency_weight:
+            age_hours = max(0.0, (datetime.now(tz=timezone.utc) - modified).total_seconds() / 3600)
+            score += self.recency_weight * math.log1p(age_hours)
+        size = record.get("Size", 0)
+        if size and self.size_weight:
+            score += self.size_weight * math.log1p(size / 1_000_000)
+        return score
+
+
+class PriorityActionQueue(queue.Queue):
+    """
+    Queue of sync actions that hands out the lowest scoring action first. Scores come from the
+    `record` of each action. `maxsize` bounds memory: producers block until workers catch up.
+    `None` (the worker stop signal) always sorts last.
+    """
+
+    def __init__(self, priority: SyncPriority = None, maxsize: int = 0) -> None:
+        self.priority = priority or SyncPriority()
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self.heap = []
+        self.counter = itertools.count()  # Keeps FIFO order for equal scores and avoids comparing actions
+
+    def _qsize(self):
+        return len(self.heap)
+
+    def _put(self, item):
+        score = math.inf if item is None else self.priority(getattr(item, "record", {}))
+        heapq.heappush(self.heap, (score, next(self.counter), item))
+
+    def _get(self):
+        return heapq.heappop(self.heap)[2]
@@ -1,11 +1,40 @@
 
 
 import logging
+import os
+import uuid
 from collections import defaultdict
+from workdocs_dr.checksums import ChecksumMismatch, ChecksumWriter
+from workdocs_dr.codec import CODEC_METADATA_KEY, Decoder, DecodingWriter
 from workdocs_dr.document import DocumentHelper
-from workdocs_dr.item_restore import scribble_file
-from workdocs_dr.listings import Listings
+from workdocs_dr.document_packs import PackIndex, generate_folder_documents, unpack_document
+from workdocs_dr.item_restore import RestoreFileWriter, is_identical_on_disk, scribble_file
 from workdocs_dr.queue_pool import QueueWorkPool
+from workdocs_dr.restore_journal import RestoreJournal
+from workdocs_dr.version_index import VersionIndex
+
+
+def create_directory(path) -> bool:
+    """Creates the directory (and parents) if needed. Returns True if it wasn't there before"""
+    if path.is_file():
+        raise RuntimeError(f"Can't restore to directory {path} as it's a file!")
+    is_new = not path.is_dir()
+    path.mkdir(parents=True, exist_ok=True)
+    return is_new
+
+
+def create_directories(folderdefs):
+    """
+    Creates the directories of a whole restore tree in one pass, parents first, before any downloads
+    start. Marks each folder def with IsNew, and drops the ones that can't be created.
+    """
+    created = []
+    for folderdef in sorted(folderdefs, key=lambda fd: fd["Path"]):
+        try:
+            created.append({**folderdef, "IsNew": create_directory(folderdef["Path"])})
+        except (RuntimeError, OSError) as err:
+            logging.warning(err)
+    return created
 
 
 class GenerateRestoreTasks:
@@ -16,6 +45,7 @@ class GenerateRestoreTasks:
         self.downstream_queue = restore_file_queue
         self.clients = clients
         self.userkeyhelper = userkeyhelper
+        self.version_index = VersionIndex(clients, userkeyhelper)
 
         self.queue_helper = None
 
@@ -23,25 +53,22 @@ class GenerateRestoreTasks:
         def task_work(folderdef, lock):
             try:
                 path = folderdef["Path"]
-                if path.is_file():
-                    raise RuntimeError(f"Can't restore to directory {path} as it's a file!")
-                is_folder_new = not path.is_dir()
-                with lock:
-                    path.mkdir(parents=True, exist_ok=True)
+                is_folder_new = folderdef.get("IsNew", None)
+                if is_folder_new is None:
+                    # Directories are normally created up front by create_directories
+                    is_folder_new = create_directory(path)
                 folderid = folderdef["Metadata"]["Id"]
                 folderprefix = self.userkeyhelper.bucket_folderprefix(folderid)
-                lister = Listings(self.clients)
-                s3objects = lister.list_s3_documents(self.userkeyhelper.bucket, folderprefix)
+                s3objects = list(generate_folder_documents(self.clients, self.userkeyhelper.bucket, folderprefix))
                 # TODO:
                 # - Only mark files skippable if a file with same size/date exists in destination dir
                 if self.downstream_queue is not None:
-                    task_list = self.create_task_list(folderpath=path, folder_id=folderid,
-                                                      is_folder_new=is_folder_new, s3objects=s3objects)
+                    task_list = self.create_task_list(
+                        folderpath=path, folder_id=folderid, is_folder_new=is_folder_new,
+                        s3objects=[o for o in s3objects if "Packed" not in o])
+                    task_list += self.create_pack_tasks(path, folderid, [o for o in s3objects if "Packed" in o])
                     for task in task_list:
                         self.downstream_queue.put(task)
-                with lock:
-                    for s3obj in s3objects:
-                        logging.debug(s3obj)
             except Exception as err:
                 logging.warning(err)
         self.queue_helper = QueueWorkPool(task_queue=self.task_queue, worker_count=self.worker_count,
@@ -53,14 +80,24 @@ class GenerateRestoreTasks:
         # Looks like the folder was already there. See if we can supply the download process with
         # hints on when to do head requests first
         # Get stats for all files in the directory on disk (since we know the folder is already there)
-        file_stats = [p.stat() for p in folderpath.iterdir() if p.is_file()]
+        file_stats = [p.stat() for p in folderpath.iterdir() if p.is_file() and not p.name.endswith(".partial")]
         sizes = {stat.st_size for stat in file_stats}
 
         def matching_size_exists(s3obj):
-            return s3obj.get("Size", -1) in sizes
+            # Compressed objects are listed with their stored size, the version index has the document's own
+            entry = self.version_index.get(s3obj["Key"].split("/")[-1]) or {}
+            return s3obj.get("Size", -1) in sizes or (entry.get("FolderId") == folder_id and entry.get("Size") in sizes)
         # If we see a file in destination dir with matching size it's worthwhile to fetch metadata first
         return [{"Path": folderpath, "S3Object": s3obj, "FolderId": folder_id, "FetchMetadataFirst": matching_size_exists(s3obj)} for s3obj in s3objects]
 
+    @staticmethod
+    def create_pack_tasks(folderpath, folder_id, packed_objects):
+        """One task per pack, so its documents are restored with a few ranged GETs rather than one GET each"""
+        by_pack = {}
+        for s3obj in packed_objects:
+            by_pack.setdefault(s3obj["Packed"]["Pack"], []).append(s3obj)
+        return [{"Path": folderpath, "FolderId": folder_id, "PackedObjects": objs} for objs in by_pack.values()]
+
     def start_generating(self):
         self._setup()
         self.queue_helper.start_tasks()
@@ -72,14 +109,19 @@ class GenerateRestoreTasks:
 class RunRestoreTasks:
     worker_count = 6
 
-    def __init__(self, restore_queue, clients, userkeyhelper) -> None:
+    def __init__(self, restore_queue, clients, userkeyhelper, journal: RestoreJournal = None) -> None:
         self.task_queue = restore_queue
         self.clients = clients
         self.userkeyhelper = userkeyhelper
+        # With a journal, objects restored before are skipped and large downloads can be continued
+        self.journal = journal
         self.results = []
+        self.file_writer = RestoreFileWriter()
 
     def _setup(self):
         def task_work(restoredef, lock):
+            if "PackedObjects" in restoredef:
+                return self.restore_packed(restoredef)
             try:
                 client = self.clients.bucket_client()
                 s3obj = restoredef["S3Object"]
@@ -89,17 +131,41 @@ class RunRestoreTasks:
                 request_kwargs = {"Bucket": self.userkeyhelper.bucket, "Key": s3obj["Key"]}
                 if s3obj["Key"] == self.userkeyhelper.bucket_documentkey(folder_id, DocumentHelper.FOLDERINFONAME):
                     return
+                if self.journal is not None and self.journal.is_done(s3obj):
+                    self.results.append({**restoredef, "Status": "OK", "DocumentInfo": {"Action": "SkippedJournal"}})
+                    return
+                if self.journal is not None and s3obj["Size"] >= 1_000_000:
+                    documentinfo = self.restore_resumable(restoredef)
+                    self.journal.record_done(s3obj)
+                    self.results.append({**restoredef, "Status": "OK", "DocumentInfo": documentinfo})
+                    return
                 if s3obj["Size"] < 1_000_000:
                     # Just a straight get_object
 
                     head_request = None if not fetch_metadata_first else lambda: client.head_object(**request_kwargs)
                     def req(): return client.get_object(**request_kwargs)
-                    def writer(r, f): return f.write(r["Body"].read())
+
+                    def writer(r, f):
+                        self.clients.governor.throttle_bytes(r.get("ContentLength", s3obj["Size"]))
+                        decoder = Decoder.from_metadata(r["Metadata"])
+                        checked = ChecksumWriter(f)
+                        written = checked.write(decoder.decode(r["Body"].read()) + decoder.finish())
+                        checked.verify(r["Metadata"])
+                        return written
                 else:
                     def req(): return client.head_object(**request_kwargs)
                     head_request = req
-                    def writer(_, f): return client.download_fileobj(self.userkeyhelper.bucket, s3obj["Key"], f)
-                documentinfo = scribble_file(path, req, writer, head_request)
+
+                    def writer(r, f):
+                        # Stored objects may be compressed, so decompress (and checksum) as the download streams in
+                        checked = ChecksumWriter(f)
+                        with DecodingWriter(checked, Decoder.from_metadata(r["Metadata"])) as decoded:
+                            client.download_fileobj(self.userkeyhelper.bucket, s3obj["Key"], decoded,
+                                                    Callback=self.clients.governor.throttle_bytes)
+                        checked.verify(r["Metadata"])
+                documentinfo = scribble_file(path, req, writer, head_request, self.file_writer)
+                if self.journal is not None:
+                    self.journal.record_done(s3obj)
                 self.results.append({**restoredef, **{"Status": "OK"}, **{"DocumentInfo": documentinfo}})
             except Exception as err:
                 self.results.append({**restoredef, **{"Status": "Error", "ErrorInfo": err}})
@@ -107,9 +173,101 @@ class RunRestoreTasks:
         self.queue_helper = QueueWorkPool(task_queue=self.task_queue, worker_count=self.worker_count,
                                           worker_action=task_work)
 
+    def restore_resumable(self, restoredef):
+        """
+        Restores a large object so an interrupted download carries on where it stopped: the partial file is
+        kept, its offset is recorded in the journal as it grows, and the rest is fetched with a range request.
+        Compressed objects can't be continued mid-stream, so their downloads start over
+        """
+        s3obj = restoredef["S3Object"]
+        client = self.clients.bucket_client()
+        request = {"Bucket": self.userkeyhelper.bucket, "Key": s3obj["Key"]}
+        head = client.head_object(**request)
+        metadata = DocumentHelper.document_metadata_s32dict(head["Metadata"])
+        documentpath = restoredef["Path"] / metadata["LatestVersionMetadata"]["Name"]
+        if is_identical_on_disk(documentpath, metadata):
+            return {"Metadata": metadata, "Path": documentpath, "Action": "SkippedIdentical"}
+        is_resumable = CODEC_METADATA_KEY not in head["Metadata"]
+        partial = self.journal.get_partial(s3obj) if is_resumable else None
+        partialpath, offset = partial or (
+            documentpath.with_name(f".{documentpath.name}.{uuid.uuid4().hex[:8]}.partial"), 0)
+        if "ETag" in s3obj:
+            request["IfMatch"] = s3obj["ETag"]
+        if offset > 0:
+            request["Range"] = f"bytes={offset}-"
+            logging.info(f"Continuing download of {s3obj['Key']} from byte {offset}")
+        try:
+            with open(partialpath, "r+b" if offset > 0 else "wb") as f:
+                f.truncate(offset)
+                checked = ChecksumWriter(f)
+                # Bytes already there count towards the checksum of the whole document
+                while f.tell() < offset:
+                    checked.hash.update(f.read(min(1024 * 1024, offset - f.tell())))
+                response = client.get_object(**request)
+                since_recorded = 0
+                with DecodingWriter(checked, Decoder.from_metadata(head["Metadata"])) as decoded:
+                    for chunk in response["Body"].iter_chunks(1024 * 1024):
+                        self.clients.governor.throttle_bytes(len(chunk))
+                        decoded.write(chunk)
+                        offset += len(chunk)
+                        since_recorded += len(chunk)
+                        if is_resumable and since_recorded >= self.journal.progress_bytes:
+                            f.flush()
+                            self.journal.record_partial(s3obj, partialpath, offset)
+                            since_recorded = 0
+                checked.verify(head["Metadata"])
+        except ChecksumMismatch:
+            partialpath.unlink(missing_ok=True)
+            raise
+        except BaseException:
+            if is_resumable:
+                self.journal.record_partial(s3obj, partialpath, offset)
+            else:
+                partialpath.unlink(missing_ok=True)
+            raise
+        os.replace(partialpath, documentpath)
+        self.file_writer.set_mtime(documentpath,
+                                   metadata["LatestVersionMetadata"]["ContentModifiedTimestamp"].timestamp())
+        return {"Metadata": metadata, "Path": documentpath, "Action": "Restored"}
+
+    def restore_packed(self, restoredef):
+        """Restores the documents of one pack, reading only the ones that aren't already on disk"""
+        path = restoredef["Path"]
+        packindex = PackIndex(self.clients, self.userkeyhelper.bucket,
+                              self.userkeyhelper.bucket_folderprefix(restoredef["FolderId"]))
+        to_read = {}
+        for s3obj in restoredef["PackedObjects"]:
+            metadata = DocumentHelper.document_metadata_s32dict(s3obj["Packed"]["Metadata"])
+            result = {"Path": path, "S3Object": s3obj, "FolderId": restoredef["FolderId"]}
+            documentpath = path / metadata["LatestVersionMetadata"]["Name"]
+            if self.journal is not None and self.journal.is_done(s3obj):
+                self.results.append({**result, "Status": "OK", "DocumentInfo": {"Action": "SkippedJournal"}})
+            elif is_identical_on_disk(documentpath, metadata):
+                documentinfo = {"Metadata": metadata, "Path": documentpath, "Action": "SkippedIdentical"}
+                self.results.append({**result, "Status": "OK", "DocumentInfo": documentinfo})
+            else:
+                to_read[s3obj["Key"].split("/")[-1]] = result
+        try:
+            for document_id, entry, stored in packindex.read_ranges(
+                    [(d, r["S3Object"]["Packed"]) for d, r in to_read.items()]):
+                result = to_read.pop(document_id)
+                try:
+                    documentinfo = scribble_file(path, lambda: {"Metadata": entry["Metadata"]},
+                                                 lambda r, f: f.write(unpack_document(entry, stored)),
+                                                 file_writer=self.file_writer)
+                    if self.journal is not None:
+                        self.journal.record_done(result["S3Object"])
+                    self.results.append({**result, "Status": "OK", "DocumentInfo": documentinfo})
+                except Exception as err:
+                    self.results.append({**result, "Status": "Error", "ErrorInfo": err})
+        except Exception as err:
+            # Documents that weren't read when the pack read failed
+            self.results.extend({**result, "Status": "Error", "ErrorInfo": err} for result in to_read.values())
+
     def start_restoring(self):
         self._setup()
         self.queue_helper.start_tasks()
 
     def finish_restoring(self):
         self.queue_helper.finish_tasks()
+        self.file_writer.flush()
@@ -0,0 +1,100 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from time import monotonic
+
+
+class RestoreJournal:
+    """
+    Append-only record of a directory restore's progress, so a restore that's stopped picks up where it was
+    when run again. Each line is JSON: objects restored (`Done`), and how far large downloads have got
+    (`Partial`, the partial file and `Offset` of the bytes in it). Objects are told apart by a tag of their
+    stored content, so ones changed in the bucket since are restored again. Lines are synced to disk every
+    `fsync_every` lines or `fsync_seconds`, whichever comes first, and a torn last line is ignored on load.
+    """
+
+    filename = ".restore_journal"
+    fsync_every = 100
+    fsync_seconds = 2.0
+    "Bytes downloaded between recording the offset of a large download"
+    progress_bytes = 64 * 1024 * 1024
+
+    def __init__(self, restore_path: Path) -> None:
+        self.path = Path(restore_path) / self.filename
+        self.done = {}
+        self.partial = {}
+        self.file = None
+        self.unsynced = 0
+        self.last_sync = monotonic()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("Done", False):
+                    self.done[record["Key"]] = record["Tag"]
+                    self.partial.pop(record["Key"], None)
+                else:
+                    self.partial[record["Key"]] = record
+        logging.info(f"Resuming restore with {len(self.done)} objects done and {len(self.partial)} partly done")
+
+    @staticmethod
+    def tag(s3obj) -> str:
+        """Identifies the stored content: the ETag, or for packed documents where in which pack they are"""
+        if "Packed" in s3obj:
+            return f"{s3obj['Packed']['Pack']}:{s3obj['Packed']['Offset']}"
+        return str(s3obj.get("ETag", s3obj.get("LastModified", "")))
+
+    def is_done(self, s3obj) -> bool:
+        return self.done.get(s3obj["Key"], None) == self.tag(s3obj)
+
+    def get_partial(self, s3obj):
+        """(partial file, offset) of an unfinished download of the object, if it can be resumed"""
+        record = self.partial.get(s3obj["Key"], None)
+        if record is None or record["Tag"] != self.tag(s3obj):
+            return None
+        partialpath = Path(record["Partial"])
+        if not partialpath.is_file() or partialpath.stat().st_size < record["Offset"]:
+            return None
+        return partialpath, record["Offset"]
+
+    def record_done(self, s3obj):
+        self._append({"Key": s3obj["Key"], "Tag": self.tag(s3obj), "Done": True})
+
+    def record_partial(self, s3obj, partialpath: Path, offset: int):
+        self._append({"Key": s3obj["Key"], "Tag": self.tag(s3obj), "Partial": str(partialpath), "Offset": offset})
+
+    def _append(self, record):
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self.file is None:
+                self.file = open(self.path, "a", encoding="utf-8")
+            self.file.write(line)
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_every or monotonic() - self.last_sync >= self.fsync_seconds:
+                self._sync()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = monotonic()
+
+    def close(self, remove: bool = False):
+        """Syncs what's recorded. `remove` deletes the journal, e.g. once a restore completed without errors"""
+        with self._lock:
+            if self.file is not None:
+                self._sync()
+                self.file.close()
+                self.file = None
+            if remove:
+                self.path.unlink(missing_ok=True)
@@ -0,0 +1,118 @@
+import logging
+import threading
+import time
+import uuid
+
+from workdocs_dr.aws_clients import AwsClients
+
+
+class RetryQueue:
+    """
+    Sync actions that kept failing, kept in `.retry_queue` below the organization prefix so the next run
+    replays them before anything else. Each action is tried again after each of `retry_delays` seconds
+    within the run first. Entries are action records (not closures) with the user they belong to, the
+    last error and the number of runs they failed in. After `max_runs` runs they are moved to
+    `.dead_letters` for someone to look at, and aren't replayed again.
+
+    Runs that overlap (a subtree backup alongside a full one, say) share the queue. Each entry has an
+    `EntryId`, and saving reads the queue again and only replaces the entries this run took or saved.
+    """
+
+    retry_delays = (1, 4)
+    max_runs = 5
+    max_dead_letters = 1000
+
+    def __init__(self, clients: AwsClients, bucket: str, key: str, dead_letter_key: str) -> None:
+        self.clients = clients
+        self.bucket = bucket
+        self.key = key
+        self.dead_letter_key = dead_letter_key
+        self.failed = []
+        self.owned = set()  # Ids of the stored entries taken or saved by this run
+        self._lock = threading.Lock()
+
+    def _load(self, key) -> list:
+        from yaml import safe_load
+        client = self.clients.bucket_client()
+        try:
+            response = client.get_object(Bucket=self.bucket, Key=key)
+            return safe_load(response["Body"].read()) or []
+        except client.exceptions.NoSuchKey:
+            return []
+
+    def take(self) -> list:
+        """The entries saved by earlier runs. Whatever fails of them again is added back"""
+        entries = self._load(self.key)
+        with self._lock:
+            self.owned.update(self.entry_id(e) for e in entries)
+        return entries
+
+    @staticmethod
+    def entry_id(entry) -> str:
+        # Entries saved before they had ids are told apart by their content
+        return entry.get("EntryId", None) or repr(sorted(entry.items(), key=lambda kv: kv[0]))
+
+    def run(self, action):
+        """Runs a sync action, retrying it with backoff. Actions that still fail are added to the queue"""
+        for delay in self.retry_delays + (None,):
+            try:
+                return action()
+            except Exception as err:
+                if delay is None:
+                    self.add(action, err)
+                    raise
+                logging.info(f"Retrying failed sync action in {delay}s: {err}")
+                time.sleep(delay)
+
+    def add(self, action, err: Exception):
+        record = getattr(action, "record", None)
+        user = getattr(getattr(action, "syncer", None), "user", None)
+        if record is None or user is None:
+            logging.warning(f"Can't keep failed sync action {action} to retry later")
+            return
+        args = dict(record["Args"])
+        if record["Action"] == "update_folder_summary":
+            # Folder contents are listed again when the summary is written
+            args.pop("wdfolders", None)
+            args.pop("wddocuments", None)
+        entry = {**record, "EntryId": record.get("EntryId", None) or uuid.uuid4().hex, "Args": args,
+                 "Error": str(err), "Runs": record.get("Runs", 0) + 1,
+                 "User": {"OrganizationId": user.organization_id, "Username": user.username,
+                          "RootFolderId": user.root_folder_id, "ModifiedTimestamp": user.modified_timestamp}}
+        with self._lock:
+            self.failed.append(entry)
+
+    def merge(self, entries: list):
+        """Adds failed actions kept by another process's queue"""
+        with self._lock:
+            self.failed.extend(entries)
+
+    def save(self):
+        """
+        Stores the failed actions for the next run. Stored entries this run didn't take, including those saved
+        by other runs meanwhile, are kept
+        """
+        from yaml import safe_dump
+        with self._lock:
+            saving = len(self.failed)
+            failed = list(self.failed)
+            owned = set(self.owned)
+        stored = self._load(self.key)
+        failed = [e for e in stored if self.entry_id(e) not in owned] + failed
+        retry = [e for e in failed if e["Runs"] < self.max_runs]
+        dead = [e for e in failed if e["Runs"] >= self.max_runs]
+        client = self.clients.bucket_client()
+        if len(dead) > 0:
+            logging.warning(f"Giving up on {len(dead)} sync actions, see {self.dead_letter_key}")
+            dead_letters = (self._load(self.dead_letter_key) + dead)[-self.max_dead_letters:]
+            client.put_object(Bucket=self.bucket, Key=self.dead_letter_key,
+                              Body=safe_dump(dead_letters).encode("utf-8"))
+        if len(retry) > 0 or len(stored) > 0:
+            client.put_object(Bucket=self.bucket, Key=self.key, Body=safe_dump(retry).encode("utf-8"))
+        with self._lock:
+            # Saving again later (e.g. while following) replaces what this run saved now
+            saved = [e for e in self.failed[:saving] if e["Runs"] < self.max_runs]
+            self.owned.update(self.entry_id(e) for e in saved)
+            self.failed = saved + self.failed[saving:]
+        if len(retry) > 0:
+            logging.warning(f"{len(retry)} failed sync actions will be retried next run")
@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta
+from statistics import median
+
+from workdocs_dr.aws_clients import AwsClients
+
+
+class RunLedger:
+    """
+    History of completed runs, kept in `.run_ledger` below the organization prefix. Each entry has the
+    run style, start and end times, duration and the run stats (actions, bytes, requests and for
+    activity runs the number of activities). Only the latest `max_entries` are kept.
+    """
+
+    max_entries = 200
+
+    def __init__(self, clients: AwsClients, bucket: str, key: str) -> None:
+        self.clients = clients
+        self.bucket = bucket
+        self.key = key
+        self.entries = None
+
+    def get_entries(self) -> list:
+        if self.entries is None:
+            from yaml import safe_load
+            client = self.clients.bucket_client()
+            try:
+                response = client.get_object(Bucket=self.bucket, Key=self.key)
+                self.entries = safe_load(response["Body"].read()) or []
+            except client.exceptions.NoSuchKey:
+                self.entries = []
+        return self.entries
+
+    def append(self, entry: dict):
+        from yaml import safe_dump
+        self.entries = (self.get_entries() + [entry])[-self.max_entries:]
+        self.clients.bucket_client().put_object(Bucket=self.bucket, Key=self.key,
+                                                Body=safe_dump(self.entries).encode("utf-8"))
+
+
+class RunStyleSelector:
+    """
+    Picks the cheapest run style that keeps drift bounded, from the run ledger. Costs are predicted
+    in seconds: a FULL run takes about what recent FULL runs took, and an ACTIVITIES run takes the
+    recent seconds per activity times the activities pending. Drift is what activity runs miss and the
+    next FULL run corrects; its rate is learnt from the actions of FULL runs per day since the FULL run
+    before, for FULL runs with activity (or reconciling) runs in between. Without those, what a FULL run
+    does is just the changes since the one before, not drift. A FULL run is chosen when it's predicted
+    to be cheaper, when expected drift is above `max_expected_drift` documents, when there are more
+    activities pending than an activity run queues, or when the last one is `max_days_since_full` days old.
+    """
+
+    max_days_since_full = 30
+    max_expected_drift = 50
+    max_pending_activities = 5000  # Activity runs stop queueing after this many (see ActivityTasks)
+    "Number of recent runs of a style that predictions are based on"
+    history = 5
+
+    def __init__(self, ledger: list, now: datetime) -> None:
+        self.ledger = ledger
+        self.now = now
+
+    def runs(self, style: str) -> list:
+        return [e for e in self.ledger if e.get("RunStyle") == style and e.get("Duration") is not None]
+
+    def predicted_full_seconds(self):
+        durations = [e["Duration"] for e in self.runs("full")[-self.history:]]
+        return median(durations) if len(durations) > 0 else None
+
+    def predicted_activities_seconds(self, pending_activities: int):
+        recent = self.runs("activities")[-self.history:]
+        if len(recent) == 0 or pending_activities is None:
+            return None
+        seconds_per_activity = sum(e["Duration"] for e in recent) / sum(e.get("Activities", 0) + 1 for e in recent)
+        return seconds_per_activity * (pending_activities + 1)
+
+    def drift_per_day(self):
+        rates = []
+        previous = None
+        incremental = False  # Whether activity runs synced changes since the previous FULL run
+        for run in self.ledger:
+            if run.get("RunStyle") in ["activities", "reconcile"]:
+                incremental = True
+            if run.get("RunStyle") != "full" or run.get("Duration") is None:
+                continue
+            if previous is not None and incremental:
+                days = (run["EndTime"] - previous["EndTime"]) / timedelta(days=1)
+                if days > 0:
+                    rates.append(run.get("Actions", 0) / days)
+            previous = run
+            incremental = False
+        rates = rates[-self.history:]
+        return median(rates) if len(rates) > 0 else None
+
+    def choose(self, pending_activities: int, last_full_end: datetime, reconcile_slices: int = None):
+        """
+        Returns "full", "activities" or "reconcile" and the predictions it was based on. Rolling reconciliation
+        (with `reconcile_slices`) keeps drift bounded by itself, so it's chosen when enabled unless there are
+        more activities pending than its activity step queues. `pending_activities` may be None
+        """
+        days_since_full = (self.now - last_full_end) / timedelta(days=1)
+        full_seconds = self.predicted_full_seconds()
+        activities_seconds = self.predicted_activities_seconds(pending_activities)
+        drift_per_day = self.drift_per_day()
+        expected_drift = drift_per_day * days_since_full if drift_per_day is not None else None
+        predictions = {"DaysSinceFull": round(days_since_full, 2), "PendingActivities": pending_activities,
+                       "FullSeconds": full_seconds, "ActivitiesSeconds": activities_seconds,
+                       "ExpectedDrift": expected_drift}
+        if pending_activities is not None and pending_activities > self.max_pending_activities:
+            return "full", predictions
+        if reconcile_slices is not None:
+            if full_seconds is not None and activities_seconds is not None:
+                predictions["ReconcileSeconds"] = activities_seconds + full_seconds / reconcile_slices
+            return "reconcile", predictions
+        if days_since_full >= self.max_days_since_full:
+            return "full", predictions
+        if full_seconds is not None and activities_seconds is not None and activities_seconds >= full_seconds:
+            return "full", predictions
+        if expected_drift is not None and expected_drift > self.max_expected_drift:
+            return "full", predictions
+        return "activities", predictions
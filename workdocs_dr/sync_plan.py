@@ -0,0 +1,170 @@
+import logging
+import math
+import queue
+import threading
+from collections import Counter
+from timeit import default_timer as timer
+
+from workdocs_dr.aws_clients import AwsClients
+from workdocs_dr.backup_options import BackupOptions
+from workdocs_dr.directory_minder import DirectoryBackupMinder, RunStyle
+from workdocs_dr.listings import WdDirectory, WdFilter
+from workdocs_dr.queue_backup import ListWorkdocsFolders, RecordSyncTasks
+from workdocs_dr.user import UserHelper, UserKeyHelper
+
+
+class SyncPlan:
+    """
+    Tally of what a backup run would do, built from the action records of `plan_syncactions`.
+    Has a `put` so it can stand in for the action queue of `RecordSyncTasks`.
+    """
+
+    "copy_to_bucket uses put_object below this size and upload_fileobj above"
+    single_put_limit = 1_000_000
+    "s3transfer defaults for upload_fileobj"
+    multipart_threshold = 8 * 1024 * 1024
+    multipart_chunksize = 8 * 1024 * 1024
+
+    def __init__(self) -> None:
+        self.action_counts = Counter()
+        self.bytes = 0
+        self.deleted_bytes = 0
+        self.users = 0
+        self.folders = 0
+        self.execution_requests = Counter()  # Keyed by (service, operation)
+        self._lock = threading.Lock()
+
+    def put(self, action):
+        if action is not None:
+            self.add_record(action.record)
+
+    def add_user(self, folder_count):
+        with self._lock:
+            self.users += 1
+            self.folders += folder_count
+            self.execution_requests[("s3", "HeadObject")] += 1  # update_user_info
+
+    def add_record(self, record):
+        action = record["Action"]
+        size = record.get("Size", 0)
+        with self._lock:
+            self.action_counts[action] += 1
+            if action == "copy_to_bucket":
+                self.bytes += size
+                self.execution_requests[("workdocs", "GetDocumentVersion")] += 1
+                self.execution_requests[("workdocs-content", "GET")] += 1
+                self.execution_requests.update({("s3", op): n for op, n in self.upload_requests(size).items()})
+            elif action == "pack_documents":
+                self.bytes += size
+                documents = len(record["Args"].get("documents", []))
+                self.execution_requests[("workdocs", "GetDocumentVersion")] += documents
+                self.execution_requests[("workdocs-content", "GET")] += documents
+                self.execution_requests[("s3", "PutObject")] += 2  # The pack and the pack index
+            elif action == "copy_versions_to_bucket":
+                # Which earlier versions are missing is only known when it runs
+                self.execution_requests[("workdocs", "DescribeDocumentVersions")] += 1
+            elif action == "remove_from_bucket":
+                self.deleted_bytes += size
+                self.execution_requests[("s3", "DeleteObject")] += 1
+            elif action == "update_folder_summary":
+                self.execution_requests[("workdocs", "GetFolder")] += 1
+                self.execution_requests[("s3", "PutObject")] += 1
+
+    def upload_requests(self, size):
+        if size <= self.single_put_limit or size < self.multipart_threshold:
+            return {"PutObject": 1}
+        parts = math.ceil(size / self.multipart_chunksize)
+        return {"CreateMultipartUpload": 1, "UploadPart": parts, "CompleteMultipartUpload": 1}
+
+    def action_total(self):
+        return sum(self.action_counts.values())
+
+    def projected_seconds(self, walk_seconds, last_run_stats):
+        """
+        Projects run time from the throughput of the last run of the same style. Both the action rate
+        and the byte rate of that run bound the projection, and the run can't be faster than the walk.
+        """
+        duration = last_run_stats.get("Duration", 0)
+        if not duration:
+            return None
+        estimates = [walk_seconds]
+        if last_run_stats.get("Actions", 0) > 0:
+            estimates.append(self.action_total() / (last_run_stats["Actions"] / duration))
+        if last_run_stats.get("Bytes", 0) > 0:
+            estimates.append(self.bytes / (last_run_stats["Bytes"] / duration))
+        return int(max(estimates))
+
+    @staticmethod
+    def nest_requests(counts):
+        nested = {}
+        for (service, operation), n in sorted(counts.items()):
+            nested.setdefault(service, {})[operation] = n
+        return nested
+
+    def to_dict(self, walk_seconds, walk_requests, last_run_stats):
+        return {
+            "Users": self.users,
+            "Folders": self.folders,
+            "Copies": self.action_counts["copy_to_bucket"],
+            "Deletes": self.action_counts["remove_from_bucket"],
+            "Packs": self.action_counts["pack_documents"],
+            "FolderSummaryWrites": self.action_counts["update_folder_summary"],
+            "EstimatedBytes": self.bytes,
+            "DeletedBytes": self.deleted_bytes,
+            "EstimatedRequests": {
+                "Listing": self.nest_requests(walk_requests),
+                "Execution": self.nest_requests(self.execution_requests),
+            },
+            "WalkSeconds": int(walk_seconds),
+            "ProjectedSeconds": self.projected_seconds(walk_seconds, last_run_stats),
+        }
+
+
+class SyncPlanner:
+    """
+    Walks WorkDocs and the bucket the way a FULL run does, but only records what the run would do.
+    Nothing is written to the bucket.
+    """
+
+    def __init__(self, clients: AwsClients, organization_id: str, bucket_url: str,
+                 filter: WdFilter = None, minder: DirectoryBackupMinder = None,
+                 options: BackupOptions = None) -> None:
+        self.clients = clients
+        self.organization_id = organization_id
+        self.bucket_url = bucket_url
+        self.filter = filter
+        self.minder = minder or DirectoryBackupMinder(clients, organization_id, bucket_url)
+        self.options = options
+        self.plan = SyncPlan()
+
+    def plan_user(self, user: UserHelper):
+        ukh = UserKeyHelper(user, self.bucket_url)
+        folder_queue = queue.Queue()
+        foldertree = ListWorkdocsFolders(self.clients, collect_folders=True, downstream_queue=folder_queue)
+        record_st = RecordSyncTasks(self.clients, user, ukh, task_queue=folder_queue, downstream_queue=self.plan,
+                                    options=self.options)
+        foldertree.start_walk(user.root_folder_id)
+        record_st.start_recording()
+        foldertree.finish_walk()
+        folder_queue.put(None)
+        record_st.finish_recording()
+        self.plan.add_user(len(foldertree.folders))
+        logging.info(f"Planned user {user.username}")
+
+    def plan_all(self) -> dict:
+        start = timer()
+        requests_before = Counter(self.clients.request_counts)
+        directory = WdDirectory(self.organization_id, self.clients)
+        for u in directory.generate_users(self.filter):
+            self.plan_user(UserHelper(u))
+        walk_seconds = timer() - start
+        walk_requests = Counter(self.clients.request_counts)
+        walk_requests.subtract(requests_before)
+        pending_activities = sum(1 for _ in directory.generate_activities(self.minder.get_activities_cutoff()))
+        last_full = self.minder.get_last_run_stats(RunStyle.FULL)
+        return {
+            "SuggestedRunStyle": str(self.minder.get_best_run_style(pending_activities)),
+            "PendingActivities": pending_activities,
+            "LastFullRun": {k: last_full.get(k) for k in ["StartTime", "Duration", "Actions", "Bytes"]},
+            "Full": self.plan.to_dict(walk_seconds, +walk_requests, last_full),
+        }
@@ -0,0 +1,157 @@
+import json
+import logging
+import random
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from workdocs_dr.aws_clients import AwsClients
+from workdocs_dr.document import DocumentHelper
+from workdocs_dr.user import UserKeyHelper
+
+
+class TreeSnapshot:
+    """
+    Per user snapshot of the WorkDocs folder tree as last walked, kept in `.treesnapshot` next to the
+    version index. Each folder has its parent, a fingerprint of its metadata as listed in its parent
+    (modified time, signature and sizes), its subfolders, the version of each of its documents and when it
+    was walked.
+
+    Walks with a snapshot only descend into subfolders with evidence of change: not in the snapshot, a
+    different fingerprint, touched by an activity (or above a folder that was) or walked longer ago than
+    `max_age`, which is how far back activities are looked at. Of the subfolders without, `verify_fraction`
+    are walked anyway, and changes found in those are counted as `Missed`.
+    """
+
+    max_age = timedelta(days=31)
+    default_verify_fraction = 0.05
+
+    def __init__(self, clients: AwsClients, userkeys: UserKeyHelper, verify_fraction: float = default_verify_fraction,
+                 changed_folders: set = None, now: datetime = None) -> None:
+        self.clients = clients
+        self.bucket = userkeys.bucket
+        self.key = userkeys.bucket_folderprefix(DocumentHelper.TREESNAPSHOTNAME)
+        self.verify_fraction = verify_fraction
+        self.changed_folders = changed_folders or set()
+        self.now = now or datetime.now(tz=timezone.utc)
+        self.entries = None
+        self.dirty = False
+        self.suspect = None  # Folders touched by activities and the folders above them
+        self.verifying = set()
+        self.failed = set()
+        self.stats = Counter()
+        self._lock = threading.RLock()
+
+    def _ensure_loaded(self):
+        with self._lock:
+            if self.entries is not None:
+                return
+            client = self.clients.bucket_client()
+            try:
+                response = client.get_object(Bucket=self.bucket, Key=self.key)
+                self.entries = json.loads(response["Body"].read())
+            except client.exceptions.NoSuchKey:
+                self.entries = {}
+            self.suspect = set()
+            for folder_id in self.changed_folders:
+                while folder_id is not None and folder_id not in self.suspect:
+                    self.suspect.add(folder_id)
+                    folder_id = self.entries.get(folder_id, {}).get("ParentId", None)
+
+    @staticmethod
+    def fingerprint(folder_def) -> str:
+        keys = ["ModifiedTimestamp", "Signature", "Size", "LatestVersionSize"]
+        return "|".join(str(folder_def.get(k, "")) for k in keys)
+
+    def should_walk(self, folder_def) -> bool:
+        """Whether the walk should descend into a subfolder, as listed in its parent"""
+        self._ensure_loaded()
+        with self._lock:
+            entry = self.entries.get(folder_def["Id"], None)
+            changed = entry is None or folder_def["Id"] in self.suspect \
+                or entry["Fingerprint"] != self.fingerprint(folder_def) \
+                or datetime.fromisoformat(entry["Walked"]) < self.now - self.max_age
+            if changed:
+                self.stats["Changed"] += 1
+                return True
+            if random.random() < self.verify_fraction:
+                self.stats["Verified"] += 1
+                self.verifying.add(folder_def["Id"])
+                return True
+            self.stats["Skipped"] += 1
+            return False
+
+    def subtree_ids(self, folder_id) -> list:
+        """Ids of the folder and all below it, as last walked"""
+        self._ensure_loaded()
+        with self._lock:
+            ids = []
+            pending = [folder_id]
+            while len(pending) > 0:
+                fid = pending.pop()
+                ids.append(fid)
+                pending.extend(self.entries.get(fid, {}).get("Folders", []))
+            return ids
+
+    def record(self, folder_def, contents: dict):
+        """Records a walked folder and what's in it. Subfolders no longer in it are dropped with all below them"""
+        self._ensure_loaded()
+        entry = {
+            "ParentId": folder_def.get("ParentFolderId", None),
+            "Fingerprint": self.fingerprint(folder_def),
+            "Folders": sorted(f["Id"] for f in contents.get("Folders", [])),
+            "Documents": {d["Id"]: d.get("LatestVersionMetadata", {}).get("Id", None)
+                          for d in contents.get("Documents", [])},
+            "Walked": self.now.isoformat(),
+        }
+        with self._lock:
+            previous = self.entries.get(folder_def["Id"], {})
+            if folder_def["Id"] in self.verifying and (
+                    previous.get("Folders") != entry["Folders"] or previous.get("Documents") != entry["Documents"]):
+                logging.warning(f"Folder {folder_def['Id']} changed without the snapshot noticing")
+                self.stats["Missed"] += 1
+            for child_id in set(previous.get("Folders", [])) - set(entry["Folders"]):
+                if self.entries.get(child_id, {}).get("ParentId") == folder_def["Id"]:
+                    self._drop(child_id)
+            self.entries[folder_def["Id"]] = entry
+            self.dirty = True
+
+    def forget(self, folder_def):
+        """
+        Marks a folder that couldn't be synced. When saved, it and the folders above it are dropped, so the next
+        walk sees them as new and descends to it
+        """
+        with self._lock:
+            self.failed.add((folder_def["Id"], folder_def.get("ParentFolderId", None)))
+            self.dirty = True
+
+    def _drop(self, folder_id):
+        for fid in self.subtree_ids(folder_id):
+            self.entries.pop(fid, None)
+
+    def save(self):
+        with self._lock:
+            if not self.dirty:
+                return
+            for folder_id, parent_id in self.failed:
+                entry = self.entries.pop(folder_id, None)
+                folder_id = entry["ParentId"] if entry is not None else parent_id
+                while folder_id in self.entries:
+                    folder_id = self.entries.pop(folder_id)["ParentId"]
+            self.failed = set()
+            client = self.clients.bucket_client()
+            client.put_object(Bucket=self.bucket, Key=self.key, Body=json.dumps(self.entries).encode("utf-8"))
+            self.dirty = False
+        logging.info(f"Tree snapshot walk: {dict(self.stats)}")
+
+    @staticmethod
+    def folders_touched(activities) -> set:
+        """Folders that activities changed something in, or moved something out of"""
+        touched = set()
+        for a in activities:
+            if a["Type"].startswith("FOLDER_"):
+                touched.add(a["ResourceMetadata"]["Id"])
+            touched.add(a["ResourceMetadata"].get("ParentId", None))
+            touched.add(a.get("OriginalParent", {}).get("Id", None))
+        touched.discard(None)
+        return touched
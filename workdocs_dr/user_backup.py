@@ -1,10 +1,15 @@
 import logging
 import queue
+from datetime import datetime, timezone
 from timeit import default_timer as timer
 
 from workdocs_dr.user import UserHelper, UserKeyHelper
 from workdocs_dr.aws_clients import AwsClients
-from workdocs_dr.listings import Listings, S3FolderTree, WdFilter
+from workdocs_dr.backup_options import BackupOptions
+from workdocs_dr.directory_minder import DirectoryBackupMinder
+from workdocs_dr.listings import FolderPathResolver, Listings, S3FolderTree, WdFilter
+from workdocs_dr.tree_snapshot import TreeSnapshot
+from workdocs_dr.version_index import VersionIndex
 from workdocs_dr.workdocs_bucket_sync import WorkDocs2BucketSync
 from workdocs_dr.queue_backup import ListWorkdocsFolders, RecordSyncTasks, RunSyncTasks
 
@@ -18,22 +23,78 @@ class UserBackupRunner():
     chunksize = 100
     starttime = timer()
 
-    def __init__(self, user: UserHelper, userkeys: UserKeyHelper, clients: AwsClients) -> None:
+    def __init__(self, user: UserHelper, userkeys: UserKeyHelper, clients: AwsClients,
+                 options: BackupOptions = None, minder: DirectoryBackupMinder = None,
+                 resolver: FolderPathResolver = None, changed_folders: set = None) -> None:
         self.userhelper = user
         self.userkeyhelper = userkeys
         self.clients = clients
+        self.options = options or BackupOptions()
+        self.minder = minder
+        self.resolver = resolver or FolderPathResolver(clients)
+        # Folders touched by recent activities, for walks against a tree snapshot
+        self.changed_folders = changed_folders
+        self.stats = {}
 
     def backup_user_queue(self, filter: WdFilter = None):
-        br = WorkDocs2BucketSync(self.clients, self.userhelper, self.userkeyhelper)
+        version_index = VersionIndex(self.clients, self.userkeyhelper)
+        br = WorkDocs2BucketSync(self.clients, self.userhelper, self.userkeyhelper, version_index, self.options)
         br.update_user_info()
+        snapshot = None
+        if self.options.tree_snapshot is not None:
+            snapshot = TreeSnapshot(self.clients, self.userkeyhelper, self.options.tree_snapshot, self.changed_folders)
+        if filter is not None and filter.foldernames is not None and len(filter.foldernames) > 0:
+            return self.backup_subtrees(version_index, filter.foldernames, snapshot)
+        foldertree, results, self.stats = self.backup_from(self.userhelper.root_folder_id, version_index, snapshot)
+        version_index.save()
+        if snapshot is not None:
+            snapshot.save()
+        # TODO: Something to clear out deleted folders goes here
+        if foldertree.collect_folders and (filter is None or filter.folderpattern is None):
+            self.prune_inactive_folders(br, foldertree.folders)
+        return results
+
+    def backup_subtrees(self, version_index: VersionIndex, folderpaths, snapshot: TreeSnapshot = None):
+        """
+        Backs up just the folders at `folderpaths` (like "Projects/Alpha") and everything below them, one
+        subtree at a time. Each completed subtree is saved and recorded, so an interrupted run keeps its progress
+        """
+        results = []
+        self.stats = {"Actions": 0, "Bytes": 0}
+        for folderpath in folderpaths:
+            folder = self.resolver.resolve(self.userhelper.root_folder_id, folderpath)
+            if folder is None:
+                logging.warning(f"Folder {folderpath} not found for user {self.userhelper.username}")
+                continue
+            start_time = datetime.now(tz=timezone.utc)
+            _, subtree_results, subtree_stats = self.backup_from(folder["Id"], version_index, snapshot)
+            version_index.save()
+            if snapshot is not None:
+                snapshot.save()
+            results.extend(subtree_results)
+            self.stats = {k: v + subtree_stats.get(k, 0) for k, v in self.stats.items()}
+            if self.minder is not None:
+                self.minder.update_subtree_completion(self.userkeyhelper, folder["Id"], {
+                    "Path": folderpath, "StartTime": start_time, "EndTime": datetime.now(tz=timezone.utc),
+                    **subtree_stats})
+            logging.info(f"Backed up {folderpath} for user {self.userhelper.username}")
+        return results
+
+    def backup_from(self, folder_id, version_index: VersionIndex, snapshot: TreeSnapshot = None):
+        """
+        Walks and syncs the folder and everything below it (or what's changed below it, with a snapshot).
+        Returns the walker, results and stats
+        """
         folder_queue = queue.Queue()
-        action_queue = queue.Queue()
-        # TODO: Make filter work
-        foldertree = ListWorkdocsFolders(self.clients, collect_folders=True, downstream_queue=folder_queue)
+        action_queue = self.options.action_queue()
+        foldertree = ListWorkdocsFolders(self.clients, collect_folders=True, downstream_queue=folder_queue,
+                                         snapshot=snapshot)
         record_st = RecordSyncTasks(self.clients, self.userhelper, self.userkeyhelper,
-                                    task_queue=folder_queue, downstream_queue=action_queue)
-        run_st = RunSyncTasks(task_queue=action_queue)
-        foldertree.start_walk(self.userhelper.root_folder_id)
+                                    task_queue=folder_queue, downstream_queue=action_queue,
+                                    version_index=version_index, options=self.options, snapshot=snapshot)
+        run_st = RunSyncTasks(task_queue=action_queue,
+                              retry_queue=self.minder.get_retry_queue() if self.minder is not None else None)
+        foldertree.start_walk(folder_id)
         record_st.start_recording()
         run_st.start_syncing()
 
@@ -42,34 +103,14 @@ class UserBackupRunner():
         record_st.finish_recording()
         action_queue.put(None)
         run_st.finish_syncing()
-        results = run_st.results
-        # TODO: Something to clear out deleted folders goes here
-        if foldertree.collect_folders and filter.folderpattern is None and \
-                (filter.foldernames is None or len(filter.foldernames) == 0):
-            self.prune_inactive_folders(br, foldertree.folders)
-
-        return results
+        return foldertree, run_st.results, run_st.stats
 
     def prune_inactive_folders(self, syncer: WorkDocs2BucketSync, active_folders: set):
         lister = Listings(self.clients)
         s3folderids = lister.list_s3_subfoldernames(self.userkeyhelper.bucket, self.userkeyhelper.bucket_userprefix())
         actions = []
         for folder_id in s3folderids:
-            if not folder_id in active_folders:
+            # Dot-named prefixes like .versions aren't folders
+            if not folder_id in active_folders and not folder_id.startswith("."):
                 logging.info(f"Would like to clear out folder {folder_id} for user {self.userhelper.username}")
                 actions.append(lambda fid=folder_id: syncer.remove_folder_from_bucket(fid))
-
-    def folderidfrompath(self, path):
-        """Need this later for implementing filters"""
-        subfolderlist = path.strip('/').split('/')
-        currentfolderid = self.userhelper.root_folder_id
-        client = self.clients.docs_client()
-        for folder in subfolderlist:
-            response = client.describe_folder_contents(
-                FolderId=currentfolderid)
-            matchingfolder = next(
-                (d for d in response["Folders"] if d["Name"] == folder), None)
-            if matchingfolder is None:
-                raise RuntimeError("Bad path")
-            currentfolderid = matchingfolder["Id"]
-        return currentfolderid
@@ -5,8 +5,9 @@ from urllib.parse import urlparse
 
 from workdocs_dr.aws_clients import AwsClients
 from workdocs_dr.document import DocumentHelper
-from workdocs_dr.queue_restore import GenerateRestoreTasks, RunRestoreTasks
+from workdocs_dr.queue_restore import GenerateRestoreTasks, RunRestoreTasks, create_directories
 from workdocs_dr.listings import S3FolderTree, WdFilter
+from workdocs_dr.restore_journal import RestoreJournal
 from workdocs_dr.user import UserHelper, UserKeyHelper
 
 
@@ -32,11 +33,13 @@ class UserRestoreInfo:
 
 class UserRestoreRunner:
 
-    def __init__(self, user: UserHelper, userkeys: UserKeyHelper, clients: AwsClients, restore_path: Path) -> None:
+    def __init__(self, user: UserHelper, userkeys: UserKeyHelper, clients: AwsClients, restore_path: Path,
+                 journal: RestoreJournal = None) -> None:
         self.userhelper = user
         self.userkeyhelper = userkeys
         self.clients = clients
         self.restore_path = Path(restore_path)
+        self.journal = journal
         self.lost_and_found = self.restore_path / "lost and found"
         self.foldergenerator = None
         self.folderpaths = None
@@ -50,20 +53,38 @@ class UserRestoreRunner:
         self.folderpaths[folderinfo["Metadata"]["Id"]] = path
         return path
 
-    def generate_restoredefs(self):
-        # TODO: Implement handling of filters
+    def generate_restoredefs(self, filter: WdFilter = None):
         foldertree = S3FolderTree(self.clients, self.userkeyhelper.bucket, self.userkeyhelper.bucket_userprefix())
+        if filter is not None and filter.foldernames is not None and len(filter.foldernames) > 0:
+            yield from self.generate_subtree_restoredefs(foldertree, filter.foldernames)
+            return
         for finfo in foldertree.generate_folders():
             yield {**finfo, **{"Path": self.get_folderpath(finfo), "FallbackBasePath": self.lost_and_found}}
 
+    def generate_subtree_restoredefs(self, foldertree: S3FolderTree, foldernames):
+        """
+        Restore defs for just the folders named by path (like "Projects/Alpha") and everything below them.
+        Only the `.folderinfo` of folders on the way and in the subtrees are read
+        """
+        for foldername in foldernames:
+            folder_id = foldertree.resolve_path(self.userhelper.root_folder_id, foldername)
+            if folder_id is None:
+                logging.warning(f"Folder {foldername} not found in backup of {self.userhelper.username}")
+                continue
+            basepath = self.restore_path.joinpath(*[n for n in foldername.split("/") if n != ""])
+            for finfo, path_names in foldertree.generate_subtree(folder_id):
+                yield {"Metadata": finfo["Metadata"], "Path": basepath.joinpath(*path_names),
+                       "FallbackBasePath": self.lost_and_found}
+
     def restore_user_queued(self, filter: WdFilter = None):
         summary = []
         folder_queue = queue.Queue()
         file_queue = queue.Queue()
         grt = GenerateRestoreTasks(folder_queue=folder_queue, restore_file_queue=file_queue,
                                    clients=self.clients, userkeyhelper=self.userkeyhelper)
-        rrt = RunRestoreTasks(restore_queue=file_queue, clients=self.clients, userkeyhelper=self.userkeyhelper)
-        for restore_folder_def in self.generate_restoredefs():
+        rrt = RunRestoreTasks(restore_queue=file_queue, clients=self.clients, userkeyhelper=self.userkeyhelper,
+                              journal=self.journal)
+        for restore_folder_def in create_directories(self.generate_restoredefs(filter)):
             folder_queue.put(restore_folder_def)
         grt.start_generating()
         rrt.start_restoring()
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import logging
+import random
+from collections import Counter
+from itertools import groupby
+
+from workdocs_dr.aws_clients import AwsClients
+from workdocs_dr.checksums import CHECKSUM_METADATA_KEY
+from workdocs_dr.codec import CODEC_METADATA_KEY, Decoder
+from workdocs_dr.document import DocumentHelper
+from workdocs_dr.document_packs import PackIndex, merge_packed
+from workdocs_dr.listings import Listings, WdDirectory, WdFilter, WorkdocsFolderTree
+from workdocs_dr.user import UserHelper, UserKeyHelper
+from workdocs_dr.version_index import VersionIndex
+
+
+def merge_join(left, right):
+    """
+    Joins two iterables of (key, item) that are sorted by key. Yields (key, left item, right item)
+    with None for a side that doesn't have the key. Only one item from each side is held at a time.
+    """
+    left, right = iter(left), iter(right)
+    lnext, rnext = next(left, None), next(right, None)
+    while lnext is not None or rnext is not None:
+        if rnext is None or (lnext is not None and lnext[0] < rnext[0]):
+            yield lnext[0], lnext[1], None
+            lnext = next(left, None)
+        elif lnext is None or rnext[0] < lnext[0]:
+            yield rnext[0], None, rnext[1]
+            rnext = next(right, None)
+        else:
+            yield lnext[0], lnext[1], rnext[1]
+            lnext, rnext = next(left, None), next(right, None)
+
+
+class BackupVerifier:
+    """
+    Checks the bucket against WorkDocs without running a backup. For each user the WorkDocs tree and
+    the bucket listing are both produced in bucket key order ("folderid/documentid" below the user
+    prefix) and merge-joined, so only the folder ids and one folder's documents are held in memory
+    however many documents there are. Findings are:
+
+    - Missing: in WorkDocs, not in the bucket (MissingFolder if the folder has no `.folderinfo`)
+    - Stale: in both, but the bucket copy is of an older version
+    - Orphaned: in the bucket, no longer in WorkDocs
+    - ChecksumMismatch: content differs in a sampled document (only with `sample_rate` above 0)
+    """
+
+    def __init__(self, clients: AwsClients, organization_id: str, bucket_url: str, filter: WdFilter = None,
+                 sample_rate: float = 0.0, output=None) -> None:
+        self.clients = clients
+        self.organization_id = organization_id
+        self.bucket_url = bucket_url
+        self.filter = filter
+        self.sample_rate = sample_rate
+        self.output = output
+        self.counts = Counter()
+
+    def verify_all(self) -> dict:
+        directory = WdDirectory(self.organization_id, self.clients)
+        for u in directory.generate_users(self.filter):
+            self.verify_user(UserHelper(u))
+        return dict(self.counts)
+
+    def verify_user(self, user: UserHelper):
+        userkeys = UserKeyHelper(user, self.bucket_url)
+        version_index = VersionIndex(self.clients, userkeys)
+        joined = merge_join(self.generate_wd_entries(user), self.generate_s3_entries(userkeys))
+        for key, wdentry, s3object in joined:
+            finding = self.compare(key, wdentry, s3object, version_index, userkeys)
+            self.counts[finding] += 1
+            if finding != "OK":
+                self.report({"User": user.username, "Key": key, "Finding": finding})
+        logging.info(f"Verified user {user.username}")
+
+    def generate_wd_entries(self, user: UserHelper):
+        subfolders = list(WorkdocsFolderTree(self.clients).generate_subfolders(user.root_folder_id))
+        folder_ids = [user.root_folder_id] + [f["Id"] for f in subfolders]
+        parent_ids = {f.get("ParentFolderId", None) for f in subfolders}
+        lister = Listings(self.clients)
+        # Sorting on "folderid/" gives the same order as the bucket keys
+        for folder_id in sorted(folder_ids, key=lambda f: f"{f}/"):
+            documents = lister.list_wd_documents(folder_id)
+            # Backups only write `.folderinfo` for folders with something in them
+            folderinfo = {"FolderId": folder_id, "Document": None,
+                          "Empty": folder_id not in parent_ids and len(documents) == 0}
+            entries = [(f"{folder_id}/{DocumentHelper.FOLDERINFONAME}", folderinfo)]
+            entries.extend((f"{folder_id}/{d['Id']}", {"FolderId": folder_id, "Document": d}) for d in documents)
+            yield from sorted(entries, key=lambda e: e[0])
+
+    def generate_s3_entries(self, userkeys: UserKeyHelper):
+        prefix = f"{userkeys.bucket_userprefix()}/"
+        lister = Listings(self.clients)
+        s3objects = lister.generate_s3_objects({"Bucket": userkeys.bucket, "Prefix": prefix})
+        # User level objects like .userinfo aren't in a folder
+        in_folders = (o for o in s3objects if "/" in o["Key"][len(prefix):])
+        # A folder's objects are listed together, so one folder at a time can be merged with its packed documents
+        for folder_id, folder_objects in groupby(in_folders, key=lambda o: o["Key"][len(prefix):].split("/")[0]):
+            folderprefix = f"{prefix}{folder_id}"
+            standalone = {o["Key"][len(folderprefix) + 1:]: o for o in folder_objects}
+            packed = {}
+            if DocumentHelper.PACKINDEXNAME in standalone:
+                packed = PackIndex(self.clients, userkeys.bucket, folderprefix).as_s3objects()
+            documents = merge_packed(standalone, packed)
+            for name in sorted(documents.keys()):
+                if "/" not in name and (not name.startswith(".") or name == DocumentHelper.FOLDERINFONAME):
+                    yield f"{folder_id}/{name}", documents[name]
+
+    def compare(self, key, wdentry, s3object, version_index: VersionIndex, userkeys: UserKeyHelper) -> str:
+        if s3object is None:
+            if wdentry["Document"] is None:
+                return "OK" if wdentry.get("Empty", False) else "MissingFolder"
+            return "Missing"
+        if wdentry is None:
+            return "Orphaned"
+        document = wdentry["Document"]
+        if document is None:
+            return "OK"
+        if self.is_stale(wdentry["FolderId"], document, s3object, version_index, userkeys.bucket):
+            return "Stale"
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            if not self.is_checksum_matching(document, userkeys.bucket, s3object["Key"], version_index,
+                                             s3object.get("Packed", None)):
+                return "ChecksumMismatch"
+        return "OK"
+
+    def is_stale(self, folder_id, wddocument, s3object, version_index: VersionIndex, bucket: str) -> bool:
+        latest = wddocument["LatestVersionMetadata"]
+        entry = version_index.get(wddocument["Id"])
+        if entry is not None and entry.get("FolderId") == folder_id:
+            return not VersionIndex.is_same_version(entry, latest)
+        if latest["ModifiedTimestamp"] > s3object["LastModified"]:
+            return True
+        return latest["Size"] != s3object["Size"] and latest["Size"] != self.stored_size(bucket, s3object)
+
+    def stored_size(self, bucket, s3object) -> int:
+        """Size of the document when it was stored. Compressed objects are listed with their compressed size"""
+        if "Packed" in s3object:
+            return s3object["Size"]
+        stored = self.clients.bucket_client().head_object(Bucket=bucket, Key=s3object["Key"])["Metadata"]
+        if CODEC_METADATA_KEY not in stored:
+            return s3object["Size"]
+        return DocumentHelper.document_metadata_s32dict(stored)["LatestVersionMetadata"].get("Size", None)
+
+    def is_checksum_matching(self, wddocument, bucket, key, version_index: VersionIndex = None,
+                             packed: dict = None) -> bool:
+        """Compares with the checksum recorded at backup when there is one, so the bucket copy isn't read"""
+        import requests
+        latest = wddocument["LatestVersionMetadata"]
+        version = self.clients.docs_client().get_document_version(
+            DocumentId=wddocument["Id"], VersionId=latest["Id"], Fields="SOURCE")
+        wdhash = hashlib.sha256()
+        self.clients.count_request("workdocs-content", "GET")
+        with requests.get(version["Metadata"]["Source"]["ORIGINAL"], stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                self.clients.governor.throttle_bytes(len(chunk))
+                wdhash.update(chunk)
+        entry = version_index.get(wddocument["Id"]) if version_index is not None else None
+        if entry is not None and entry.get("Sha256") is not None and entry.get("VersionId") == latest["Id"]:
+            return entry["Sha256"] == wdhash.hexdigest()
+        if packed is not None:
+            return packed["Metadata"].get(CHECKSUM_METADATA_KEY) == wdhash.hexdigest()
+        stored = self.clients.bucket_client().head_object(Bucket=bucket, Key=key)["Metadata"]
+        if CHECKSUM_METADATA_KEY in stored:
+            return stored[CHECKSUM_METADATA_KEY] == wdhash.hexdigest()
+        s3response = self.clients.bucket_client().get_object(Bucket=bucket, Key=key)
+        decoder = Decoder.from_metadata(s3response["Metadata"])
+        s3hash = hashlib.sha256()
+        for chunk in s3response["Body"].iter_chunks(64 * 1024):
+            self.clients.governor.throttle_bytes(len(chunk))
+            s3hash.update(decoder.decode(chunk))
+        s3hash.update(decoder.finish())
+        return wdhash.digest() == s3hash.digest()
+
+    def report(self, finding: dict):
+        if self.output is not None:
+            self.output.write(json.dumps(finding) + "\n")
+        else:
+            logging.warning(f"Verification: {finding}")
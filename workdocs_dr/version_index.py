@@ -0,0 +1,162 @@
+import json
+import logging
+import threading
+import time
+
+from workdocs_dr.aws_clients import AwsClients
+from workdocs_dr.document import DocumentHelper
+from workdocs_dr.user import UserKeyHelper
+
+
+class VersionIndex:
+    """
+    Per user record of which WorkDocs version (id and signature) is stored in the bucket for each
+    document. It is kept in a single object next to `.userinfo`, so planning can compare versions
+    without a HEAD per document. Entries are only recorded once a copy has succeeded.
+
+    With version history, the earlier versions stored of each document are kept in `.versionhistory`
+    the same way. It's apart from the entries, so moving or removing a document doesn't lose track of
+    versions already stored.
+
+    Other runs (a subtree backup alongside a full one, say) may save the same index meanwhile, so saving
+    reads it again and only applies the changes made here. Recorded entries are also saved every
+    `save_interval` seconds during a run, so an interrupted run doesn't lose track of what it copied.
+    """
+
+    save_interval = 300
+
+    def __init__(self, clients: AwsClients, userkeys: UserKeyHelper) -> None:
+        self.clients = clients
+        self.bucket = userkeys.bucket
+        self.key = userkeys.bucket_folderprefix(DocumentHelper.VERSIONINDEXNAME)
+        self.history_key = userkeys.bucket_folderprefix(DocumentHelper.VERSIONHISTORYNAME)
+        self.entries = None
+        self.history = None
+        self.changes = {}  # Entries recorded or forgotten (None) since loading or saving
+        self.dirty = False
+        self.history_dirty = False
+        self.last_saved = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _load(self, key=None):
+        client = self.clients.bucket_client()
+        try:
+            response = client.get_object(Bucket=self.bucket, Key=key or self.key)
+            return json.loads(response["Body"].read())
+        except client.exceptions.NoSuchKey:
+            return {}
+
+    def _ensure_loaded(self):
+        if self.entries is None:
+            with self._lock:
+                if self.entries is None:
+                    self.entries = self._load()
+
+    def get(self, document_id):
+        self._ensure_loaded()
+        return self.entries.get(document_id, None)
+
+    def record(self, document_id, folder_id, version_metadata, sha256: str = None):
+        """
+        Records the version described by WorkDocs `DocumentVersionMetadata` as stored in `folder_id`,
+        with the SHA-256 of its content if known
+        """
+        self._ensure_loaded()
+        entry = {
+            "FolderId": folder_id,
+            "VersionId": version_metadata["Id"],
+            "Signature": version_metadata.get("Signature", None),
+            "Size": version_metadata.get("Size", None),
+        }
+        previous = self.entries.get(document_id, {})
+        # Keep a known checksum when the same version is recorded again
+        sha256 = sha256 or (previous.get("Sha256", None) if previous.get("VersionId") == entry["VersionId"] else None)
+        if sha256 is not None:
+            entry["Sha256"] = sha256
+        with self._lock:
+            if self.entries.get(document_id) != entry:
+                self.entries[document_id] = entry
+                self.changes[document_id] = entry
+                self.dirty = True
+        self.save_if_due()
+
+    def save_if_due(self):
+        """Saves if `save_interval` has passed since the last save. Only one caller saves at a time"""
+        with self._lock:
+            if time.monotonic() - self.last_saved < self.save_interval:
+                return
+            self.last_saved = time.monotonic()
+        self.save()
+
+    def forget(self, document_id, folder_id):
+        """Drops the entry if it refers to the copy in `folder_id` (a moved document keeps its new entry)"""
+        self._ensure_loaded()
+        with self._lock:
+            if self.entries.get(document_id, {}).get("FolderId") == folder_id:
+                del self.entries[document_id]
+                self.changes[document_id] = None
+                self.dirty = True
+
+    def get_history(self, document_id) -> list:
+        """Ids of the earlier versions of a document stored under `.versions`, or None if not known"""
+        if self.history is None:
+            with self._lock:
+                if self.history is None:
+                    self.history = self._load(self.history_key)
+        return self.history.get(document_id, None)
+
+    def record_history(self, document_id, version_ids):
+        """Records that the versions with `version_ids` are stored, adding to those recorded before"""
+        known = self.get_history(document_id) or []
+        with self._lock:
+            stored = sorted(set(known).union(version_ids))
+            if self.history.get(document_id) != stored:
+                self.history[document_id] = stored
+                self.history_dirty = True
+
+    @staticmethod
+    def is_same_version(entry, version_metadata):
+        # Compared as strings, as values read back from S3 metadata may have been parsed as numbers
+        if str(entry["VersionId"]) != str(version_metadata["Id"]):
+            return False
+        signature = version_metadata.get("Signature", None)
+        return entry.get("Signature") is None or signature is None or str(entry["Signature"]) == str(signature)
+
+    @staticmethod
+    def _apply(entries: dict, changes: dict) -> dict:
+        for document_id, entry in changes.items():
+            if entry is None:
+                entries.pop(document_id, None)
+            else:
+                entries[document_id] = entry
+        return entries
+
+    def save(self):
+        """Saves what's changed on top of what is stored now, so changes saved by other runs are kept"""
+        if self.history_dirty:
+            with self._lock:
+                history = dict(self.history)
+                self.history_dirty = False
+            stored = self._load(self.history_key)
+            for document_id, version_ids in history.items():
+                stored[document_id] = sorted(set(stored.get(document_id, [])).union(version_ids))
+            body = json.dumps(stored, separators=(",", ":")).encode("utf-8")
+            self.clients.bucket_client().put_object(Bucket=self.bucket, Key=self.history_key, Body=body,
+                                                    ContentType="application/json")
+            with self._lock:
+                stored.update((k, v) for k, v in self.history.items() if v != history.get(k))
+                self.history = stored
+        if not self.dirty:
+            return
+        with self._lock:
+            self.last_saved = time.monotonic()
+            changes, self.changes = self.changes, {}
+            self.dirty = False
+        entries = self._apply(self._load(), changes)
+        body = json.dumps(entries, separators=(",", ":")).encode("utf-8")
+        self.clients.bucket_client().put_object(Bucket=self.bucket, Key=self.key, Body=body,
+                                                ContentType="application/json")
+        with self._lock:
+            # Changes made while saving are kept for the next save
+            self.entries = self._apply(entries, self.changes)
+        logging.info(f"Saved version index with {len(self.entries)} documents to {self.key}")
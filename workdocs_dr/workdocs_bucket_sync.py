@@ -1,17 +1,44 @@
-import requests
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import TemporaryFile
+import hashlib
 import logging
 import datetime
+import threading
 
-from yaml import dump
-from botocore.exceptions import ClientError
-import botocore.exceptions
 #from botocore.exceptions import EntityNotExistsException
 
 from workdocs_dr.aws_clients import AwsClients
+from workdocs_dr.backup_options import BackupOptions
+from workdocs_dr.checksums import CHECKSUM_METADATA_KEY, s3_checksum
+from workdocs_dr.codec import CODEC_METADATA_KEY, Encoder
 from workdocs_dr.document import DocumentHelper
+from workdocs_dr.document_packs import PackBuilder, PackIndex, merge_packed
 from workdocs_dr.listings import Listings
+from workdocs_dr.profiling import profiled
 from workdocs_dr.user import UserHelper, UserKeyHelper
+from workdocs_dr.version_index import VersionIndex
+
+
+class SyncAction():
+    """
+    A unit of sync work: a plain record naming a `WorkDocs2BucketSync` method and its arguments, plus
+    hints such as `Size` and `ModifiedTimestamp`. Calling it runs the record against the syncer.
+    """
+
+    actions = {"copy_to_bucket", "remove_from_bucket", "update_folder_summary",
+               "sync_document_to_bucket", "remove_folder_from_bucket", "pack_documents",
+               "copy_versions_to_bucket"}
+
+    def __init__(self, syncer, record: dict) -> None:
+        self.syncer = syncer
+        self.record = record
+
+    def __call__(self):
+        return self.syncer.run_action(self.record)
+
+    @staticmethod
+    def make_record(action: str, args: dict, **hints) -> dict:
+        return {"Action": action, "Args": args, **hints}
 
 
 class WorkDocs2BucketSync():
@@ -20,11 +47,21 @@ class WorkDocs2BucketSync():
     This is the "worker" class
     """
 
-    def __init__(self, clients: AwsClients, user: UserHelper, userkeys: UserKeyHelper) -> None:
+    "Number of earlier versions of a document downloaded at a time"
+    version_workers = 4
+
+    def __init__(self, clients: AwsClients, user: UserHelper, userkeys: UserKeyHelper,
+                 version_index: VersionIndex = None, options: BackupOptions = None) -> None:
         self.clients = clients
         self.listings = Listings(self.clients)
         self.user = user
         self.userkeys = userkeys
+        self.version_index = version_index or VersionIndex(clients, userkeys)
+        self.options = options or BackupOptions()
+        # Pack indexes of folders with pack actions still to run, and how many are left
+        self.pack_indexes = {}
+        self.pending_packs = {}
+        self._pack_lock = threading.Lock()
 
     def bucket_documentkey(self, folder_id, document_id):
         return self.userkeys.bucket_documentkey(folder_id, document_id)
@@ -48,44 +85,71 @@ class WorkDocs2BucketSync():
     #     return actions
 
     def get_folder_syncactions(self, folder_def, wdfolders, wddocuments):
-        s3documents = self.listings.list_s3_documents(
-            self.userkeys.bucket, self.userkeys.bucket_folderprefix(folder_def["Id"]))
-        actions = self.make_syncactions(folder_def, wdfolders, wddocuments, s3documents)
+        folderprefix = self.userkeys.bucket_folderprefix(folder_def["Id"])
+        s3documents = self.listings.list_s3_documents(self.userkeys.bucket, folderprefix)
+        packindex = None
+        if any(k["Key"] == f"{folderprefix}/{DocumentHelper.PACKINDEXNAME}" for k in s3documents):
+            packindex = PackIndex(self.clients, self.userkeys.bucket, folderprefix)
+        actions = self.make_syncactions(folder_def, wdfolders, wddocuments, s3documents, packindex)
         return actions
 
-    def make_syncactions(self, folder_def, wdfolders, wddocuments, s3documents):
+    @profiled("make_syncactions")
+    def make_syncactions(self, folder_def, wdfolders, wddocuments, s3documents, packindex: PackIndex = None):
+        records = self.plan_syncactions(folder_def, wdfolders, wddocuments, s3documents, packindex)
+        pack_count = len([r for r in records if r["Action"] == "pack_documents"])
+        if pack_count > 0:
+            with self._pack_lock:
+                self.pending_packs[folder_def["Id"]] = self.pending_packs.get(folder_def["Id"], 0) + pack_count
+                if packindex is not None:
+                    self.pack_indexes.setdefault(folder_def["Id"], packindex)
+        return [SyncAction(self, record) for record in records]
+
+    def plan_syncactions(self, folder_def, wdfolders, wddocuments, s3documents, packindex: PackIndex = None):
+        """
+        Works out what it takes to bring a folder in the bucket up to date, as plain action records.
+        Packed documents in `packindex` count as stored
+        """
         folder_id = folder_def["Id"]
         wds = {d["Id"]: d for d in wddocuments}
-        s3s = {
+        # Packs are below the folder, so are left out by only taking objects directly in it
+        standalone = {
             k["Key"].split("/")[-1]: k
-            for k in s3documents if "/" in k["Key"]
+            for k in s3documents if "/" in k["Key"] and k["Key"].split("/")[-2] == folder_id
         }
+        packed = packindex.as_s3objects() if packindex is not None else {}
+        s3s = merge_packed(standalone, packed)
         common = set(wds.keys()).intersection(s3s.keys())
         s3only = set(s3s.keys()).difference(wds.keys())
         wdonly = set(wds.keys()).difference(s3s.keys())
-        insertreqs = [{
-            "folder_id": doc["ParentFolderId"],
-            "document_id": id,
-            "version_id": doc["LatestVersionMetadata"]["Id"]
-        } for id, doc in wds.items() if id in wdonly]
-        updatereqs = [{
-            "folder_id": doc["ParentFolderId"],
-            "document_id": doc["Id"],
-            "version_id": doc["LatestVersionMetadata"]["Id"]
-        } for id, doc in wds.items() if id in common and (
-            wds[id]["LatestVersionMetadata"]["Size"] != s3s[id]["Size"]
-            or wds[id]["LatestVersionMetadata"]["ModifiedTimestamp"] > s3s[id]
-            ["LastModified"])]
+        copyids = [id for id in wds.keys() if id in wdonly or (
+            id in common and self.is_document_changed(folder_id, wds[id], s3s[id]))]
+        threshold = self.options.pack_threshold
+        packids = [id for id in copyids
+                   if threshold is not None and wds[id]["LatestVersionMetadata"].get("Size", 0) < threshold]
 
         deletions = [
-            lambda f=folder_id, s=s3id: self.remove_from_bucket(f, s)
-            for s3id in s3only if s3id != DocumentHelper.FOLDERINFONAME
+            SyncAction.make_record("remove_from_bucket", {"folder_id": folder_id, "document_id": s3id},
+                              Size=s3s[s3id].get("Size", 0))
+            for s3id in s3only if not s3id.startswith(".") and s3id in standalone
         ]
         inserts = [
-            lambda r=req: self.copy_to_bucket(**r)
-            for req in insertreqs + updatereqs
+            SyncAction.make_record("copy_to_bucket", {
+                "folder_id": wds[id]["ParentFolderId"],
+                "document_id": id,
+                "version_id": wds[id]["LatestVersionMetadata"]["Id"]
+            }, Size=wds[id]["LatestVersionMetadata"].get("Size", 0),
+                ModifiedTimestamp=wds[id]["LatestVersionMetadata"]["ModifiedTimestamp"])
+            for id in copyids if id not in packids
         ]
-        actions = deletions + inserts
+        # Pack entries for documents gone from WorkDocs, or stored as an object of their own since (or about to be)
+        forget_ids = [id for id in packed if id not in packids and (
+            id in s3only or id in copyids or s3s[id] is standalone.get(id))]
+        # Objects of their own that are replaced by packed copies, including ones left by an interrupted pack
+        replaced_ids = [id for id in standalone if id in packids or (
+            id in packed and s3s[id] is packed[id] and id not in s3only and id not in copyids)]
+        packing = self.plan_packing(folder_id, [wds[id] for id in packids], forget_ids, replaced_ids,
+                                    packindex.sparse_packs() if packindex is not None else [])
+        actions = deletions + inserts + packing + self.plan_history(wds, copyids)
         writenewfolderinfo = len(actions) > 0
         writenewfolderinfo = writenewfolderinfo or (
             DocumentHelper.FOLDERINFONAME not in s3s and (len(wdfolders) > 0 or len(wddocuments) > 0))
@@ -94,12 +158,85 @@ class WorkDocs2BucketSync():
         writenewfolderinfo = writenewfolderinfo or (
             DocumentHelper.FOLDERINFONAME in s3s and s3s[DocumentHelper.FOLDERINFONAME]["LastModified"] <= folder_lastmodified)
         if writenewfolderinfo:
-            actions.append(lambda f=folder_id, w=wdfolders, d=wddocuments: self.update_folder_summary(f, w, d))
+            actions.append(SyncAction.make_record("update_folder_summary", {
+                "folder_id": folder_id, "wdfolders": wdfolders, "wddocuments": wddocuments},
+                ModifiedTimestamp=folder_lastmodified))
             logging.info(f"Doing {len(actions)} on folder {folder_id}")
         else:
             logging.debug(f"Skipped folder {folder_id}")
         return actions
 
+    def plan_history(self, wds, copyids):
+        """
+        Records to store earlier versions, with version history on. Only documents with a new latest version
+        (the one it replaces is now history) or that aren't in the history index yet are looked at
+        """
+        if not self.options.version_history:
+            return []
+        return [
+            SyncAction.make_record("copy_versions_to_bucket", {
+                "document_id": id, "latest_version_id": wds[id]["LatestVersionMetadata"]["Id"]},
+                ModifiedTimestamp=wds[id]["LatestVersionMetadata"]["ModifiedTimestamp"])
+            for id in wds.keys() if id in copyids or self.version_index.get_history(id) is None
+        ]
+
+    def plan_packing(self, folder_id, wddocuments, forget_ids, replaced_ids, sparse_packs):
+        """
+        Records to pack `wddocuments`, in batches of about a pack each so they can run in parallel. Objects
+        of their own for `replaced_ids` are deleted once the packed copies are stored. The first batch also
+        drops `forget_ids` from the pack index. Any record repacks packs that are sparse when it runs, so
+        a record is made for `sparse_packs` even if there is nothing else to do
+        """
+        batches = [[]]
+        batch_size = 0
+        for d in sorted(wddocuments, key=lambda d: d["LatestVersionMetadata"]["Name"]):
+            size = d["LatestVersionMetadata"].get("Size", 0)
+            if batch_size + size > PackIndex.pack_max_bytes and len(batches[-1]) > 0:
+                batches.append([])
+                batch_size = 0
+            batches[-1].append(d)
+            batch_size += size
+        if len(wddocuments) == 0 and len(forget_ids) == 0 and len(replaced_ids) == 0 and len(sparse_packs) == 0:
+            return []
+        records = []
+        for i, batch in enumerate(batches):
+            args = {"folder_id": folder_id,
+                    "documents": [{"document_id": d["Id"], "version_id": d["LatestVersionMetadata"]["Id"]}
+                                  for d in batch],
+                    "replaced_document_ids": [d["Id"] for d in batch if d["Id"] in replaced_ids]}
+            if i == 0:
+                packed_ids = {d["Id"] for d in wddocuments}
+                args = {**args, "forget_document_ids": forget_ids,
+                        "replaced_document_ids": args["replaced_document_ids"] + [
+                            id for id in replaced_ids if id not in packed_ids]}
+            modified = [d["LatestVersionMetadata"]["ModifiedTimestamp"] for d in batch]
+            records.append(SyncAction.make_record(
+                "pack_documents", args, Size=sum(d["LatestVersionMetadata"].get("Size", 0) for d in batch),
+                **({"ModifiedTimestamp": max(modified)} if len(modified) > 0 else {})))
+        return records
+
+    def is_document_changed(self, folder_id, wddocument, s3object):
+        """
+        The stored version id/signature is the change key. Objects from before the version index
+        fall back on size and timestamps, and are adopted into the index if they look current.
+        Compressed objects are listed with their stored size, so with compression on only timestamps tell.
+        """
+        latest = wddocument["LatestVersionMetadata"]
+        entry = self.version_index.get(wddocument["Id"])
+        if entry is not None and entry.get("FolderId") == folder_id:
+            return not VersionIndex.is_same_version(entry, latest)
+        changed = latest["ModifiedTimestamp"] > s3object["LastModified"] or (
+            self.options.compression is None and latest["Size"] != s3object["Size"])
+        if not changed:
+            self.version_index.record(wddocument["Id"], folder_id, latest)
+        return changed
+
+    def run_action(self, record):
+        """Runs an action record from `plan_syncactions` (or `SyncAction.make_record`) against this syncer"""
+        if record["Action"] not in SyncAction.actions:
+            raise RuntimeError(f"Unknown sync action {record['Action']}")
+        return getattr(self, record["Action"])(**record["Args"])
+
     def sync_document_to_bucket(self, document_id, folder_id=None, version_id=None, old_folder_ids=[]):
         """Checks status of document in WorkDocs. returns a delete or copy depending on status. 
         `old_folder_ids` is used to indicated folders the document might have been moved out of"""
@@ -120,8 +257,19 @@ class WorkDocs2BucketSync():
                     return self.remove_from_bucket(folder_id=folder_id, document_id=document_id)
             v_id = version_id or wdmetadata["LatestVersionMetadata"]["Id"]
             f_id = folder_id or wdmetadata["ParentFolderId"]
+            clear_from_folders = [f for f in old_folder_ids if f != f_id]
+            removes = [self.remove_from_bucket(f, document_id) for f in clear_from_folders]
+            entry = self.version_index.get(document_id)
+            latest = wdmetadata["LatestVersionMetadata"]
+            if entry is not None and entry.get("FolderId") == f_id and v_id == latest["Id"]:
+                if VersionIndex.is_same_version(entry, latest):
+                    return self.sync_history(document_id, v_id, copied=False)
+                response = self.copy_to_bucket(f_id, document_id, v_id)
+                self.sync_history(document_id, v_id, copied=True)
+                return response
             s3headrequest = {"Bucket": self.userkeys.bucket, "Key": self.userkeys.bucket_documentkey(f_id, document_id)}
             s3client = self.clients.bucket_client()
+            import botocore.exceptions
             try:
                 s3response = s3client.head_object(**s3headrequest)
                 s3metadata = DocumentHelper.metadata_s32dict(s3response.get("Metadata", {}))
@@ -131,15 +279,21 @@ class WorkDocs2BucketSync():
                 # NOTE: This case is required because of https://github.com/boto/boto3/issues/2442
                 if err.response["Error"]["Code"] == "404":
                     s3metadata = {}
-            should_copy = wdmetadata["LatestVersionMetadata"]["Size"] != s3metadata.get("Size", -1) or \
-                wdmetadata["LatestVersionMetadata"]["ModifiedTimestamp"] > \
-                s3metadata.get("ModifiedTimestamp", datetime.datetime.min.replace(tzinfo=datetime.timezone.utc))
-
-            clear_from_folders = [f for f in old_folder_ids if f != f_id]
-            removes = [self.remove_from_bucket(f, document_id) for f in clear_from_folders]
+            if "Id" in s3metadata:
+                # Stored object carries the version metadata it was copied from
+                should_copy = not VersionIndex.is_same_version(
+                    {"VersionId": s3metadata["Id"], "Signature": s3metadata.get("Signature", None)},
+                    {"Id": v_id, "Signature": wdmetadata["LatestVersionMetadata"].get("Signature", None)})
+            else:
+                should_copy = wdmetadata["LatestVersionMetadata"]["Size"] != s3metadata.get("Size", -1) or \
+                    wdmetadata["LatestVersionMetadata"]["ModifiedTimestamp"] > \
+                    s3metadata.get("ModifiedTimestamp", datetime.datetime.min.replace(tzinfo=datetime.timezone.utc))
             if not should_copy:
-                return {}
-            return self.copy_to_bucket(f_id, document_id, v_id)
+                self.version_index.record(document_id, f_id, wdmetadata["LatestVersionMetadata"])
+                return self.sync_history(document_id, v_id, copied=False)
+            response = self.copy_to_bucket(f_id, document_id, v_id)
+            self.sync_history(document_id, v_id, copied=True)
+            return response
         except (client.exceptions.EntityNotExistsException,
                 client.exceptions.UnauthorizedResourceAccessException):
             if folder_id is not None:
@@ -149,15 +303,25 @@ class WorkDocs2BucketSync():
         except:
             raise
 
+    def sync_history(self, document_id, latest_version_id, copied):
+        """Stores earlier versions after a document was synced, if version history is on and they may be missing"""
+        if self.options.version_history and (copied or self.version_index.get_history(document_id) is None):
+            return self.copy_versions_to_bucket(document_id, latest_version_id)
+        return {}
+
     def remove_folder_from_bucket(self, folder_id):
         folder_prefix = self.userkeys.bucket_folderprefix(folder_id)
         documents = self.listings.list_s3_documents(self.userkeys.bucket, folder_prefix)
+        if any(doc["Key"] == f"{folder_prefix}/{DocumentHelper.PACKINDEXNAME}" for doc in documents):
+            for document_id in PackIndex(self.clients, self.userkeys.bucket, folder_prefix).as_s3objects():
+                self.version_index.forget(document_id, folder_id)
         # Not bothering to make individual deletes async here
         results = []
         for doc in documents:
             document_key = doc["Key"]
             request = {"Bucket": self.userkeys.bucket, "Key": document_key}
             response = self.clients.bucket_client().delete_object(**request)
+            self.version_index.forget(document_key.split("/")[-1], folder_id)
             results.append(response)
         return results
 
@@ -165,10 +329,25 @@ class WorkDocs2BucketSync():
         """Removes object from bucket idempotently (i.e. no error if object was already deleted)"""
         documentpath = self.userkeys.bucket_documentkey(folder_id, document_id)
         request = {"Bucket": self.userkeys.bucket, "Key": documentpath}
-        return self.clients.bucket_client().delete_object(**request)
+        response = self.clients.bucket_client().delete_object(**request)
+        self.version_index.forget(document_id, folder_id)
+        return response
 
+    @profiled("copy_to_bucket")
     def copy_to_bucket(self, folder_id, document_id, version_id):
         """Copies specific version of document to bucket"""
+        wdmetadata, response, sha256 = self.upload_version(
+            document_id, version_id, self.userkeys.bucket_documentkey(folder_id, document_id))
+        self.version_index.record(document_id, folder_id, wdmetadata, sha256=sha256)
+        return response
+
+    def upload_version(self, document_id, version_id, key, version_metadata=None):
+        """
+        Streams a document version from WorkDocs to `key`. `version_metadata` with download URLs (Fields
+        SOURCE) saves looking the version up. Returns its WorkDocs metadata, the S3 response and the SHA-256
+        """
+        import requests
+
         def cleaned_metadata(wdr):
             metda = wdresponse.get('Metadata', {})
             return {**metda, **{"Source": {}}}
@@ -177,38 +356,172 @@ class WorkDocs2BucketSync():
             "VersionId": version_id,
             "Fields": "SOURCE"
         }
-        wdresponse = self.clients.docs_client().get_document_version(**wdrequest)
+        if version_metadata is not None and "Source" in version_metadata:
+            wdresponse = {"Metadata": version_metadata}
+        else:
+            wdresponse = self.clients.docs_client().get_document_version(**wdrequest)
         metadata = DocumentHelper.metadata_dict2s3(wdresponse["Metadata"])
         s3request = {
             "Bucket": self.userkeys.bucket,
-            "Key": self.userkeys.bucket_documentkey(folder_id, document_id),
+            "Key": key,
         }
         documentdownloadurl = wdresponse['Metadata']['Source']['ORIGINAL']
         logging.info(f"Uploading document to {s3request=} from {cleaned_metadata(wdresponse)}")
+        self.clients.count_request("workdocs-content", "GET")
         r = requests.get(documentdownloadurl, stream=True)
         content_length = int(r.headers["content-length"]) if "content-length" in r.headers else 1_000_000
         bucket_client = self.clients.bucket_client()
+        governor = self.clients.governor
         content_type = metadata.get("ContentType", None) or metadata.get(
             "content_type", None) or "application/octet-stream"
+        compression = self.options.compression
+        # Checksum of the original content is computed as it streams through, so restores and
+        # verification can check integrity without another read. S3 checks the stored bytes itself.
+        hasher = hashlib.sha256()
         if content_length > 1_000_000:
             with TemporaryFile() as fp:
-                for chunk in r.iter_content(8192):
-                    fp.write(chunk)
+                chunks = r.iter_content(65536)
+                first_chunk = next(chunks, b"")
+                governor.throttle_bytes(len(first_chunk))
+                hasher.update(first_chunk)
+                codec = compression.choose_codec(content_type, first_chunk) if compression is not None else None
+                encoder = Encoder(codec)
+                fp.write(encoder.encode(first_chunk))
+                for chunk in chunks:
+                    governor.throttle_bytes(len(chunk))
+                    hasher.update(chunk)
+                    fp.write(encoder.encode(chunk))
+                fp.write(encoder.finish())
                 fp.seek(0)
+                if codec is not None:
+                    metadata[CODEC_METADATA_KEY] = codec
+                metadata[CHECKSUM_METADATA_KEY] = hasher.hexdigest()
                 response = bucket_client.upload_fileobj(
-                    fp, ExtraArgs={"Metadata": metadata, "ContentType": content_type}, **s3request)
-                return response
+                    fp, ExtraArgs={"Metadata": metadata, "ContentType": content_type, "ChecksumAlgorithm": "SHA256"},
+                    **s3request)
         else:
+            governor.throttle_bytes(content_length)
             responsebytes = r.content
-            response = bucket_client.put_object(Body=responsebytes, Metadata=metadata,
-                                                ContentType=content_type, **s3request)
-            return response
+            hasher.update(responsebytes)
+            metadata[CHECKSUM_METADATA_KEY] = hasher.hexdigest()
+            codec = compression.choose_codec(content_type, responsebytes) if compression is not None else None
+            if codec is not None:
+                encoder = Encoder(codec)
+                responsebytes = encoder.encode(responsebytes) + encoder.finish()
+                metadata[CODEC_METADATA_KEY] = codec
+            response = bucket_client.put_object(Body=responsebytes, Metadata=metadata, ContentType=content_type,
+                                                ChecksumSHA256=s3_checksum(responsebytes), **s3request)
+        return wdresponse["Metadata"], response, hasher.hexdigest()
 
-    def update_folder_summary(self, folder_id, wdfolders=[], wddocuments=[]):
-        infodump = dict()
-        # Optional info on documents and subfolders
-        infodump["Documents"] = [{"Id": d["Id"], "Name": d["LatestVersionMetadata"]["Name"]} for d in wddocuments]
-        infodump["Folders"] = [{"Id": f["Id"], "Name": f["Name"]} for f in wdfolders]
+    def bucket_versionkey(self, document_id, version_id):
+        return self.userkeys.bucket_documentkey(DocumentHelper.VERSIONSNAME, f"{document_id}/{version_id}")
+
+    @profiled("copy_versions_to_bucket")
+    def copy_versions_to_bucket(self, document_id, latest_version_id):
+        """
+        Stores the versions of a document before `latest_version_id` under `.versions/{document id}/{version id}`.
+        Only versions not stored before are downloaded, `version_workers` at a time
+        """
+        stored = self.version_index.get_history(document_id)
+        if stored is None:
+            # Not tracked yet (or lost when the index was), so take what's in the bucket as stored
+            prefix = f"{self.userkeys.bucket_documentkey(DocumentHelper.VERSIONSNAME, document_id)}/"
+            stored = [o["Key"].split("/")[-1] for o in
+                      self.listings.list_s3_objects({"Bucket": self.userkeys.bucket, "Prefix": prefix})]
+        versions = [v for v in self.listings.generate_wd_document_versions(document_id)
+                    if v["Id"] != latest_version_id]
+        missing = [v for v in versions if v["Id"] not in stored]
+        self.version_index.record_history(document_id, stored)
+
+        def copy_version(version):
+            self.upload_version(document_id, version["Id"], self.bucket_versionkey(document_id, version["Id"]),
+                                version)
+            # Recorded one at a time, so versions copied before another fails aren't copied again
+            self.version_index.record_history(document_id, [version["Id"]])
+            return version["Id"]
+        with ThreadPoolExecutor(max_workers=self.version_workers) as executor:
+            copied = list(executor.map(copy_version, missing))
+        if len(copied) > 0:
+            logging.info(f"Stored {len(copied)} earlier versions of document {document_id}")
+        return {"Versions": len(copied), "Bytes": sum(v.get("Size", 0) for v in missing)}
+
+    def pack_index(self, folder_id) -> PackIndex:
+        with self._pack_lock:
+            if folder_id not in self.pack_indexes:
+                self.pack_indexes[folder_id] = PackIndex(self.clients, self.userkeys.bucket,
+                                                         self.userkeys.bucket_folderprefix(folder_id))
+            return self.pack_indexes[folder_id]
+
+    def done_packing(self, folder_id):
+        """Drops the cached pack index of a folder once its last planned pack action has run"""
+        with self._pack_lock:
+            pending = self.pending_packs.get(folder_id, 1) - 1
+            if pending > 0:
+                self.pending_packs[folder_id] = pending
+            else:
+                self.pending_packs.pop(folder_id, None)
+                self.pack_indexes.pop(folder_id, None)
+
+    @profiled("pack_documents")
+    def pack_documents(self, folder_id, documents=[], forget_document_ids=[], replaced_document_ids=[]):
+        """
+        Stores small documents together in a new pack in the folder. Downloads run in parallel with other
+        actions, and only the pack index update holds the folder's lock. Packs left sparse are repacked, and
+        objects replaced by packed copies and packs emptied by repacking are deleted once the index is saved
+        """
+        builder = PackBuilder()
+        versions = {}
+        try:
+            for d in documents:
+                wdmetadata, metadata, stored = self.fetch_for_pack(d["document_id"], d["version_id"])
+                builder.add(d["document_id"], stored, wdmetadata.get("Size", 0),
+                            datetime.datetime.now(tz=datetime.timezone.utc), metadata)
+                versions[d["document_id"]] = wdmetadata
+            packindex = self.pack_index(folder_id)
+            with packindex.lock:
+                for document_id in forget_document_ids:
+                    packindex.remove(document_id)
+                if len(builder.entries) > 0:
+                    packindex.write_pack(builder)
+                sparse_packs = packindex.sparse_packs()
+                emptied = packindex.repack(sparse_packs) if len(sparse_packs) > 0 else []
+                packindex.save()
+        finally:
+            self.done_packing(folder_id)
+        for document_id, wdmetadata in versions.items():
+            self.version_index.record(document_id, folder_id, wdmetadata,
+                                      sha256=builder.entries[document_id]["Metadata"][CHECKSUM_METADATA_KEY])
+        client = self.clients.bucket_client()
+        for key in emptied + [self.bucket_documentkey(folder_id, id) for id in replaced_document_ids]:
+            client.delete_object(Bucket=self.userkeys.bucket, Key=key)
+        logging.info(f"Packed {len(builder.entries)} documents ({len(builder)} bytes) in folder {folder_id}")
+        return {"Packed": len(builder.entries), "Bytes": len(builder)}
+
+    def fetch_for_pack(self, document_id, version_id):
+        """Downloads a small document version. Returns its WorkDocs metadata, its S3 metadata and the bytes to store"""
+        import requests
+        wdresponse = self.clients.docs_client().get_document_version(
+            DocumentId=document_id, VersionId=version_id, Fields="SOURCE")
+        metadata = DocumentHelper.metadata_dict2s3(wdresponse["Metadata"])
+        self.clients.count_request("workdocs-content", "GET")
+        r = requests.get(wdresponse["Metadata"]["Source"]["ORIGINAL"])
+        r.raise_for_status()
+        content = r.content
+        self.clients.governor.throttle_bytes(len(content))
+        metadata[CHECKSUM_METADATA_KEY] = hashlib.sha256(content).hexdigest()
+        content_type = metadata.get("ContentType", None) or metadata.get(
+            "content_type", None) or "application/octet-stream"
+        compression = self.options.compression
+        codec = compression.choose_codec(content_type, content) if compression is not None else None
+        if codec is not None:
+            encoder = Encoder(codec)
+            content = encoder.encode(content) + encoder.finish()
+            metadata[CODEC_METADATA_KEY] = codec
+        return wdresponse["Metadata"], metadata, content
+
+    def update_folder_summary(self, folder_id, wdfolders=None, wddocuments=None):
+        """Writes `.folderinfo` for the folder. Its contents are listed from WorkDocs if not given"""
+        from yaml import dump
         s3request = {
             "Bucket": self.userkeys.bucket,
             "Key": self.userkeys.bucket_documentkey(folder_id, DocumentHelper.FOLDERINFONAME),
@@ -218,11 +531,20 @@ class WorkDocs2BucketSync():
         if metadata.get("ResourceState", metadata.get("resource_state", None)) in ["RECYCLING", "RECYCLED"]:
             response = self.clients.bucket_client().delete_object(**s3request)
             return response
+        if wdfolders is None or wddocuments is None:
+            contents = self.listings.list_wd_folder(folder_id)
+            wdfolders, wddocuments = contents["Folders"], contents["Documents"]
+        infodump = dict()
+        # Optional info on documents and subfolders
+        infodump["Documents"] = [{"Id": d["Id"], "Name": d["LatestVersionMetadata"]["Name"]} for d in wddocuments]
+        infodump["Folders"] = [{"Id": f["Id"], "Name": f["Name"]} for f in wdfolders]
         dirinfo = dump(infodump).encode("utf-8")
         response = self.clients.bucket_client().put_object(Body=dirinfo, Metadata=metadata, **s3request)
         return response
 
     def update_user_info(self):
+        from botocore.exceptions import ClientError
+        from yaml import dump
         userinfokey = self.userkeys.bucket_folderprefix(DocumentHelper.USERINFONAME)
         lastuserupdate = self.user.modified_timestamp
         client = self.clients.bucket_client()
@@ -0,0 +1,299 @@
+import hashlib
+import logging
+import queue
+import random
+import threading
+from contextlib import contextmanager
+from tempfile import SpooledTemporaryFile
+from time import sleep
+
+from workdocs_dr.aws_clients import AwsClients
+from workdocs_dr.checksums import CHECKSUM_METADATA_KEY
+from workdocs_dr.codec import Decoder
+from workdocs_dr.directory_restore import DirectoryRestoreRunner
+from workdocs_dr.document import DocumentHelper
+from workdocs_dr.document_packs import generate_folder_documents, read_packed_document
+from workdocs_dr.listings import Listings, S3FolderTree, WdFilter
+from workdocs_dr.queue_pool import QueueWorkPool
+from workdocs_dr.user import UserHelper, UserKeyHelper
+from workdocs_dr.user_restore import UserRestoreInfo
+
+THROTTLING_ERROR_CODES = {"ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException",
+                          "SlowDown", "RequestLimitExceeded"}
+THROTTLING_STATUS_CODES = {429, 503}
+
+
+def is_throttling(err) -> bool:
+    """True for botocore client errors and requests HTTP errors that ask the caller to slow down"""
+    response = getattr(err, "response", None)
+    if isinstance(response, dict):
+        return response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+    return getattr(response, "status_code", None) in THROTTLING_STATUS_CODES
+
+
+class AdaptiveConcurrency:
+    """
+    Limits how many uploads run at once. The limit grows by one after each `limit` successful
+    uploads and is halved when WorkDocs throttles, so the restore settles near what the service allows.
+    """
+
+    def __init__(self, initial: int = 4, minimum: int = 1, maximum: int = 16) -> None:
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.active = 0
+        self.successes = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.active >= self.limit:
+                self._condition.wait()
+            self.active += 1
+
+    def release(self, throttled: bool = False):
+        with self._condition:
+            self.active -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit // 2)
+                self.successes = 0
+                logging.info(f"Throttled by WorkDocs, concurrent uploads now {self.limit}")
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.maximum:
+                    self.limit += 1
+                    self.successes = 0
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        throttled = False
+        try:
+            yield
+        except Exception as err:
+            throttled = is_throttling(err)
+            raise
+        finally:
+            self.release(throttled)
+
+
+class WorkDocsFolders:
+    """Finds or creates folders in WorkDocs and lists what they already contain, so reruns resume"""
+
+    def __init__(self, clients: AwsClients) -> None:
+        self.clients = clients
+        self.contents = {}
+        self._lock = threading.Lock()
+
+    def folder_contents(self, folder_id):
+        with self._lock:
+            if folder_id not in self.contents:
+                listing = Listings(self.clients).list_wd_folder(folder_id)
+                self.contents[folder_id] = {
+                    "Folders": {f["Name"]: f["Id"] for f in listing["Folders"]},
+                    "Documents": {d["LatestVersionMetadata"]["Name"]: d for d in listing["Documents"]},
+                }
+            return self.contents[folder_id]
+
+    def ensure_folder(self, parent_id, name) -> str:
+        name = str(name)
+        subfolders = self.folder_contents(parent_id)["Folders"]
+        if name not in subfolders:
+            response = self.clients.docs_client().create_folder(Name=name, ParentFolderId=parent_id)
+            subfolders[name] = response["Metadata"]["Id"]
+            with self._lock:
+                self.contents[subfolders[name]] = {"Folders": {}, "Documents": {}}
+        return subfolders[name]
+
+    def existing_document(self, folder_id, name):
+        return self.folder_contents(folder_id)["Documents"].get(str(name), None)
+
+
+class RunWorkDocsUploads:
+    """
+    Uploads documents from the bucket into WorkDocs: initiate the version upload, PUT the content to
+    the signed URL and activate the version. Documents already in the target folder with the same name,
+    size and content are skipped, and a changed one gets a new version instead of a duplicate document.
+    Content is compared by signature when both sides have one, otherwise by the SHA-256 recorded at backup.
+    Without either, the document is uploaded again.
+    """
+
+    worker_count = 16
+    put_attempts = 5
+    "Objects larger than this are spooled to disk between download and upload"
+    spool_size = 8 * 1024 * 1024
+
+    def __init__(self, upload_queue, clients: AwsClients, folders: WorkDocsFolders,
+                 concurrency: AdaptiveConcurrency = None) -> None:
+        self.task_queue = upload_queue
+        self.clients = clients
+        self.folders = folders
+        self.concurrency = concurrency or AdaptiveConcurrency(maximum=self.worker_count)
+        self.results = []
+
+    def _setup(self):
+        def task_work(uploaddef, lock):
+            try:
+                status = self.upload(uploaddef)
+                self.results.append({**uploaddef, **{"Status": status}})
+            except Exception as err:
+                logging.warning(f"Could not restore {uploaddef['S3Object']['Key']} to WorkDocs: {err}")
+                self.results.append({**uploaddef, **{"Status": "Error", "ErrorInfo": err}})
+        self.queue_helper = QueueWorkPool(task_queue=self.task_queue, worker_count=self.worker_count,
+                                          worker_action=task_work)
+
+    def upload(self, uploaddef) -> str:
+        client = self.clients.bucket_client()
+        request_kwargs = {"Bucket": uploaddef["Bucket"], "Key": uploaddef["S3Object"]["Key"]}
+        packed = uploaddef["S3Object"].get("Packed", None)
+        s3metadata = packed["Metadata"] if packed is not None else client.head_object(**request_kwargs)["Metadata"]
+        latest = DocumentHelper.document_metadata_s32dict(s3metadata)["LatestVersionMetadata"]
+        parent_id = uploaddef["ParentFolderId"]
+        existing = self.folders.existing_document(parent_id, latest["Name"])
+        if existing is not None and self.is_restored(existing["Id"], existing["LatestVersionMetadata"], latest,
+                                                     s3metadata.get(CHECKSUM_METADATA_KEY, None)):
+            return "Skipped"
+        with self._fetch(request_kwargs, uploaddef["S3Object"]) as content:
+            size = content.tell()
+            content.seek(0)
+            with self.concurrency.slot():
+                self._upload_version(parent_id, latest, size, content, existing)
+        return "OK"
+
+    def is_restored(self, document_id, existing, latest, sha256: str = None) -> bool:
+        """Whether the `existing` version in WorkDocs has the content of the backed up `latest` version"""
+        if existing.get("Size") != latest.get("Size"):
+            return False
+        signature = existing.get("Signature", None)
+        if signature is not None and str(signature) == str(latest.get("Signature", None)):
+            return True
+        if sha256 is not None:
+            return self.content_sha256(document_id, existing["Id"]) == sha256
+        return False
+
+    def content_sha256(self, document_id, version_id) -> str:
+        """SHA-256 of the content of a WorkDocs document version"""
+        import requests
+        version = self.clients.docs_client().get_document_version(
+            DocumentId=document_id, VersionId=version_id, Fields="SOURCE")
+        wdhash = hashlib.sha256()
+        self.clients.count_request("workdocs-content", "GET")
+        with requests.get(version["Metadata"]["Source"]["ORIGINAL"], stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                self.clients.governor.throttle_bytes(len(chunk))
+                wdhash.update(chunk)
+        return wdhash.hexdigest()
+
+    def _fetch(self, request_kwargs, s3object=None):
+        spooled = SpooledTemporaryFile(max_size=self.spool_size)
+        if s3object is not None and "Packed" in s3object:
+            spooled.write(read_packed_document(self.clients, request_kwargs["Bucket"], s3object))
+            return spooled
+        response = self.clients.bucket_client().get_object(**request_kwargs)
+        decoder = Decoder.from_metadata(response["Metadata"])
+        for chunk in response["Body"].iter_chunks(1024 * 1024):
+            self.clients.governor.throttle_bytes(len(chunk))
+            spooled.write(decoder.decode(chunk))
+        spooled.write(decoder.finish())
+        return spooled
+
+    def _upload_version(self, parent_id, latest, size, content, existing):
+        docs_client = self.clients.docs_client()
+        initiate_kwargs = {
+            "ParentFolderId": parent_id,
+            "Name": str(latest["Name"]),
+            "ContentType": latest.get("ContentType", "application/octet-stream"),
+            "DocumentSizeInBytes": size,
+        }
+        for timestamp in ["ContentCreatedTimestamp", "ContentModifiedTimestamp"]:
+            if timestamp in latest:
+                initiate_kwargs[timestamp] = latest[timestamp]
+        if existing is not None:
+            initiate_kwargs["Id"] = existing["Id"]
+        response = docs_client.initiate_document_version_upload(**initiate_kwargs)
+        upload = response["UploadMetadata"]
+        self.put_content(upload["UploadUrl"], upload.get("SignedHeaders", {}), content)
+        docs_client.update_document_version(DocumentId=response["Metadata"]["Id"],
+                                            VersionId=response["Metadata"]["LatestVersionMetadata"]["Id"],
+                                            VersionStatus="ACTIVE")
+
+    def put_content(self, url, headers, content):
+        """PUTs to the signed upload URL, backing off and retrying when throttled"""
+        import requests
+        start = content.tell()
+        for attempt in range(self.put_attempts):
+            content.seek(start)
+            self.clients.count_request("workdocs-content", "PUT")
+            response = requests.put(url, data=content, headers=headers)
+            if response.ok:
+                self.clients.governor.throttle_bytes(content.tell() - start)
+                return
+            if attempt + 1 == self.put_attempts or response.status_code not in THROTTLING_STATUS_CODES:
+                response.raise_for_status()
+            sleep(random.uniform(0, 2 ** attempt))
+
+    def start_uploading(self):
+        self._setup()
+        self.queue_helper.start_tasks()
+
+    def finish_uploading(self):
+        self.queue_helper.finish_tasks()
+
+
+class WorkDocsRestoreRunner(DirectoryRestoreRunner):
+    """
+    Restores backed up users back into WorkDocs. Each user's folders are recreated under
+    `target_folder_id` (with a subfolder per user when several match), or under the user's own root
+    folder if no target is given. Folders are created parents first while documents upload in parallel.
+    """
+
+    upload_queue_size = 1000
+
+    def __init__(self, clients: AwsClients, organization_id: str, bucket_url: str, filter: WdFilter = None,
+                 target_folder_id: str = None) -> None:
+        super().__init__(clients, organization_id, bucket_url, filter)
+        self.target_folder_id = target_folder_id
+        self.results = []
+
+    def runall(self):
+        usernames = self._userlist()
+        uri = UserRestoreInfo(self.clients, self.organization_id, self.bucket_url)
+        folders = WorkDocsFolders(self.clients)
+        for username in usernames:
+            uh, ukh = uri.userhelper_userkeyhelper_from_username(username)
+            if self.target_folder_id is None:
+                target = uh.root_folder_id
+            elif len(usernames) > 1:
+                target = folders.ensure_folder(self.target_folder_id, uh.username)
+            else:
+                target = self.target_folder_id
+            results = self.restore_user(uh, ukh, target, folders)
+            failed = len([r for r in results if r["Status"] == "Error"])
+            logging.info(f"Restored user {uh.username} to WorkDocs with {len(results)} documents, {failed} failed")
+            self.results.extend(results)
+        return self.results
+
+    def restore_user(self, user: UserHelper, userkeys: UserKeyHelper, target_folder_id, folders: WorkDocsFolders):
+        upload_queue = queue.Queue(maxsize=self.upload_queue_size)
+        uploader = RunWorkDocsUploads(upload_queue, self.clients, folders)
+        uploader.start_uploading()
+        foldertree = S3FolderTree(self.clients, userkeys.bucket, userkeys.bucket_userprefix())
+        folder_map = {}
+        # Folders come parents first, and the first one is the user's root (as in UserRestoreRunner)
+        for folderinfo in foldertree.generate_folders():
+            metadata = folderinfo["Metadata"]
+            if "Id" not in metadata:
+                continue
+            if len(folder_map) == 0:
+                folder_map[metadata["Id"]] = target_folder_id
+            else:
+                parent_id = folder_map.get(metadata.get("ParentFolderId"), target_folder_id)
+                folder_map[metadata["Id"]] = folders.ensure_folder(parent_id, metadata["Name"])
+            folderprefix = userkeys.bucket_folderprefix(metadata["Id"])
+            for s3obj in generate_folder_documents(self.clients, userkeys.bucket, folderprefix):
+                upload_queue.put({"S3Object": s3obj, "Bucket": userkeys.bucket,
+                                  "ParentFolderId": folder_map[metadata["Id"]]})
+        uploader.finish_uploading()
+        return uploader.results